@@ -1,20 +1,47 @@
 from decimal import Decimal
-from django.conf import settings
+from shop import caching, coupons
 from shop.models import Product, Coupon
+from .storage import get_storage, summarize
 
 
 class Cart:
     def __init__(self, request):
         """
-        Initialize the cart.
+        Initialize the cart. The lines are read from storage on first use;
+        the item count and subtotal come from a stored summary.
         """
-        self.session = request.session
-        cart = self.session.get(settings.CART_SESSION_ID)
-        if not cart:
-            # save an empty cart in the session
-            cart = self.session[settings.CART_SESSION_ID] = {}
-        self.cart = cart
-        self.coupon_id = self.session.get('coupon_id')
+        self.storage = get_storage(request)
+        self.user = getattr(request, 'user', None)
+        self._cart = None
+        self._coupon_id = None
+        self._meta = {}
+        # Memoized for the lifetime of the request
+        self._products = None
+        self._coupon = None
+
+    @property
+    def cart(self):
+        if self._cart is None:
+            self._cart, self._coupon_id, self._meta = self.storage.load()
+        return self._cart
+
+    @property
+    def coupon_id(self):
+        self.cart
+        return self._coupon_id
+
+    @coupon_id.setter
+    def coupon_id(self, value):
+        self.cart
+        self._coupon_id = value
+
+    def summary(self):
+        """
+        Return {'count', 'subtotal'} without loading the lines if possible.
+        """
+        if self._cart is None:
+            return self.storage.load_summary()
+        return summarize(self._cart)
 
     def add(self, product, quantity=1, update_quantity=False):
         """
@@ -22,20 +49,23 @@ class Cart:
         """
         product_id = str(product.id)
         if product_id not in self.cart:
+            # The new line has the current price, so a cart that was valid
+            # (or empty) stays valid and the next revalidate() is skipped
+            version = caching.get_versions(caching.ALL_PRODUCTS)[0]
+            if not self.cart or self._meta.get('validated') == version:
+                self._meta['validated'] = version
             self.cart[product_id] = {'quantity': 0,
                                      'price': str(product.price)}
         if update_quantity:
             self.cart[product_id]['quantity'] = quantity
         else:
             self.cart[product_id]['quantity'] += quantity
+        if self._products is not None:
+            self._products[product_id] = product
         self.save()
 
     def save(self):
-        # Ensure all prices are strings before saving to session
-        for product_id in self.cart:
-            if isinstance(self.cart[product_id]['price'], Decimal):
-                self.cart[product_id]['price'] = str(self.cart[product_id]['price'])
-        self.session.modified = True
+        self.storage.save(self.cart, self.coupon_id, self._meta)
 
     def remove(self, product):
         """
@@ -44,24 +74,63 @@ class Cart:
         product_id = str(product.id)
         if product_id in self.cart:
             del self.cart[product_id]
+            if self._products is not None:
+                self._products.pop(product_id, None)
             self.save()
 
+    def _product_map(self):
+        """
+        Fetch the products of the cart once per request.
+        """
+        if self._products is None:
+            product_ids = []
+            for id_str in list(self.cart):
+                try:
+                    product_ids.append(int(id_str))
+                except ValueError:
+                    del self.cart[id_str]
+                    self.save()
+            products = Product.objects.filter(id__in=product_ids)
+            self._products = {str(p.id): p for p in products}
+        return self._products
+
+    def revalidate(self):
+        """
+        Check every line against the current product price, availability and
+        stock with one query, fixing the lines that changed. Returns a
+        {product_id: change} dict describing them. The check is skipped when
+        no product changed since the cart was last validated.
+        """
+        version = caching.get_versions(caching.ALL_PRODUCTS)[0]
+        if not self.cart or self._meta.get('validated') == version:
+            return {}
+        product_map = self._product_map()
+        changes = {}
+        for product_id, item in list(self.cart.items()):
+            product = product_map.get(product_id)
+            if product is None or not product.available or product.stock == 0:
+                del self.cart[product_id]
+                product_map.pop(product_id, None)
+                changes[product_id] = {'product': product, 'removed': True}
+                continue
+            change = {}
+            if Decimal(item['price']) != product.price:
+                change['price'] = (Decimal(item['price']), product.price)
+                item['price'] = str(product.price)
+            if item['quantity'] > product.stock:
+                change['quantity'] = (item['quantity'], product.stock)
+                item['quantity'] = product.stock
+            if change:
+                changes[product_id] = dict(change, product=product, removed=False)
+        self._meta['validated'] = version
+        self.save()
+        return changes
+
     def __iter__(self):
         """
-        Iterate over the items in the cart and get the products
-        from the database.
+        Iterate over the items in the cart with their products.
         """
-        product_ids = []
-        for id_str in self.cart.keys():
-            try:
-                product_ids.append(int(id_str))
-            except ValueError:
-                del self.cart[id_str]
-                self.save()
-        
-        products = Product.objects.filter(id__in=product_ids)
-        
-        product_map = {str(p.id): p for p in products}
+        product_map = self._product_map()
 
         cart_copy = self.cart.copy()
         for product_id, item in list(cart_copy.items()):
@@ -80,38 +149,46 @@ class Cart:
         """
         Count all items in the cart.
         """
-        return sum(item['quantity'] for item in self.cart.values())
+        return self.summary()['count']
 
     def get_total_price(self):
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        return Decimal(self.summary()['subtotal'])
 
     def clear(self):
-        # remove cart from session
-        del self.session[settings.CART_SESSION_ID]
-        self.cart = {}
-        self.clear_coupon()
-        self.save()
+        self._cart = {}
+        self._coupon_id = None
+        self._meta = {}
+        self._products = {}
+        self._coupon = None
+        self.storage.clear()
 
     def apply_coupon(self, coupon):
-        self.session['coupon_id'] = coupon.id
+        """
+        Apply the coupon, unless the user already used it up. Returns whether
+        it was applied.
+        """
+        if not coupons.can_use(coupon, user=self.user):
+            return False
         self.coupon_id = coupon.id
-        self.session.modified = True
+        self._coupon = coupon
+        self.save()
+        return True
 
     def clear_coupon(self):
-        if 'coupon_id' in self.session:
-            del self.session['coupon_id']
         self.coupon_id = None
-        self.session.modified = True
+        self._coupon = None
+        self.save()
 
     @property
     def coupon(self):
-        if self.coupon_id:
-            return Coupon.objects.filter(id=self.coupon_id).first()
-        return None
+        if self._coupon is None and self.coupon_id:
+            self._coupon = Coupon.objects.filter(id=self.coupon_id).first()
+        return self._coupon
 
     def get_discount(self):
-        if self.coupon:
-            return self.get_total_price() * (Decimal(self.coupon.discount_percent) / Decimal(100))
+        coupon = self.coupon
+        if coupon:
+            return self.get_total_price() * (Decimal(coupon.discount_percent) / Decimal(100))
         return Decimal(0)
 
     def get_total_price_after_discount(self):
@@ -1,4 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
 from .cart import Cart
 
+
 def cart(request):
-    return {'cart': Cart(request)}
+    # Built on first use, so pages that never show the cart pay nothing
+    return {'cart': SimpleLazyObject(lambda: Cart(request))}
@@ -0,0 +1,91 @@
+import time
+from decimal import Decimal
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from cart.cart import Cart
+from shop.models import Category, Product
+
+BACKENDS = [
+    'cart.storage.SessionCartStorage',
+    'cart.storage.SignedCookieCartStorage',
+    'cart.storage.CacheCartStorage',
+    'cart.storage.DatabaseCartStorage',
+]
+
+
+class Command(BaseCommand):
+    help = 'Compares cart add/view throughput of the cart storage backends.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200)
+        parser.add_argument('--items', type=int, default=10,
+                            help='Number of different products added to the cart.')
+
+    def handle(self, *args, **options):
+        self.factory = RequestFactory()
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        with transaction.atomic():
+            products = self.products(options['items'])
+            self.stdout.write(f'Session engine: {settings.SESSION_ENGINE}, '
+                              f'{options["repeat"]} requests per operation, '
+                              f'{len(products)} cart lines\n')
+            self.stdout.write(f'{"backend":<26}{"add/s":>10}{"view/s":>10}')
+            for backend in BACKENDS:
+                with override_settings(CART_STORAGE=backend):
+                    add, view = self.measure(products, options['repeat'])
+                self.stdout.write(f'{backend.rsplit(".", 1)[1]:<26}'
+                                  f'{options["repeat"] / add:>10.0f}'
+                                  f'{options["repeat"] / view:>10.0f}')
+            transaction.set_rollback(True)
+
+    def products(self, count):
+        category, _ = Category.objects.get_or_create(name='Benchmark', slug='benchmark')
+        return Product.objects.bulk_create(
+            [Product(category=category, name=f'Bench {i}', slug=f'bench-{i}',
+                     price=Decimal('9.99'), stock=100)
+             for i in range(count)])
+
+    def measure(self, products, repeat):
+        """
+        Time `repeat` add requests followed by `repeat` cart header views,
+        replaying the cookies and session between requests like a browser.
+        """
+        visitor = {'cookies': {}, 'session_key': None}
+        start = time.perf_counter()
+        for i in range(repeat):
+            request = self.request(visitor)
+            Cart(request).add(products[i % len(products)])
+            self.respond(request, visitor)
+        add = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            request = self.request(visitor)
+            cart = Cart(request)
+            len(cart)
+            cart.get_total_price()
+            self.respond(request, visitor)
+        view = time.perf_counter() - start
+        return add, view
+
+    def request(self, visitor):
+        request = self.factory.get('/')
+        request.COOKIES = dict(visitor['cookies'])
+        request.session = self.session_store(visitor['session_key'])
+        return request
+
+    def respond(self, request, visitor):
+        # What SessionMiddleware and CartCookieMiddleware do on the way out
+        if request.session.modified:
+            request.session.save()
+            visitor['session_key'] = request.session.session_key
+        value = getattr(request, '_cart_cookie', None)
+        if value:
+            visitor['cookies'][settings.CART_COOKIE_NAME] = value
+        elif value is not None:
+            visitor['cookies'].pop(settings.CART_COOKIE_NAME, None)
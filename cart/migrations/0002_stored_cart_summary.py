@@ -0,0 +1,23 @@
+# Generated by Django 4.2.26 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_stored_cart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedcart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='storedcart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+    ]
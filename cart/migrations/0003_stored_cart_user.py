@@ -0,0 +1,31 @@
+# Generated by Django 4.2.26 on 2026-10-18 15:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cart', '0002_stored_cart_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedcart',
+            name='meta',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='storedcart',
+            name='user',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='stored_cart', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='storedcart',
+            name='token',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
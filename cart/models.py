@@ -1,3 +1,45 @@
+from django.conf import settings
 from django.db import models
+from shop.models import Coupon, Product
 
-# Create your models here.
+
+class StoredCart(models.Model):
+    """
+    A cart kept in the database, either for an anonymous visitor (by cookie
+    token, see cart.storage.DatabaseCartStorage) or for a user.
+    """
+    token = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                related_name='stored_cart',
+                                null=True,
+                                blank=True,
+                                on_delete=models.CASCADE)
+    coupon = models.ForeignKey(Coupon,
+                               null=True,
+                               blank=True,
+                               on_delete=models.SET_NULL)
+    # Header summary, so that pages other than the cart read a single row
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    meta = models.JSONField(default=dict, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Cart of {self.user}' if self.user_id else f'Cart {self.token}'
+
+
+class StoredCartItem(models.Model):
+    cart = models.ForeignKey(StoredCart,
+                             related_name='items',
+                             on_delete=models.CASCADE)
+    product = models.ForeignKey(Product,
+                                related_name='+',
+                                on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        unique_together = ('cart', 'product')
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id}'
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .storage import get_storage
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    if request is not None:
+        get_storage(request, user).merge()
+
+
+@receiver(user_logged_out)
+def forget_cart_on_logout(sender, request, user, **kwargs):
+    # The cart stays with the user; drop the copy kept by this browser
+    if request is not None:
+        import_string(settings.CART_STORAGE)(request).clear()
@@ -0,0 +1,348 @@
+"""
+Where a visitor's cart is kept between requests.
+
+A backend loads and saves the cart lines, a {product_id: {'quantity',
+'price'}} dict with string keys and string prices, together with the id of
+the applied coupon and a small `meta` dict of bookkeeping values owned by
+Cart. The backend used for anonymous visitors is chosen with the
+CART_STORAGE setting:
+
+- SessionCartStorage keeps the cart in the Django session (the default).
+- SignedCookieCartStorage keeps it in a signed cookie; nothing is stored
+  on the server.
+- CacheCartStorage keeps it in the cache under a random cookie token.
+- DatabaseCartStorage keeps it in the StoredCart/StoredCartItem tables
+  under a random cookie token.
+
+The cookie based backends need cart.middleware.CartCookieMiddleware.
+
+For logged-in users the configured backend is wrapped in UserCartStorage,
+which also keeps the cart in the database under the user, so that it
+follows them to other devices.
+"""
+import secrets
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import StoredCart, StoredCartItem
+
+
+def get_storage(request, user=None):
+    storage = import_string(settings.CART_STORAGE)(request)
+    user = user or getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        storage = UserCartStorage(request, storage, user)
+    return storage
+
+
+def _serialize(items):
+    return {product_id: {'quantity': item['quantity'], 'price': str(item['price'])}
+            for product_id, item in items.items()}
+
+
+def summarize(items):
+    """
+    The figures shown in the page header: item count and subtotal.
+    """
+    return {'count': sum(item['quantity'] for item in items.values()),
+            'subtotal': str(sum((Decimal(item['price']) * item['quantity']
+                                 for item in items.values()), Decimal(0)))}
+
+
+def _read_stored_cart(**lookup):
+    """
+    Return (items, coupon_id, meta) of the StoredCart matching the lookup.
+    """
+    cart = (StoredCart.objects.filter(**lookup)
+            .prefetch_related('items').first())
+    if cart is None:
+        return {}, None, {}
+    items = {str(item.product_id): {'quantity': item.quantity, 'price': str(item.price)}
+             for item in cart.items.all()}
+    return items, cart.coupon_id, cart.meta
+
+
+def _write_stored_cart(items, coupon_id, meta=None, **lookup):
+    """
+    Create or replace the StoredCart matching the lookup. Lines are written
+    with a single bulk upsert.
+    """
+    summary = summarize(items)
+    defaults = {'coupon_id': coupon_id,
+                'item_count': summary['count'],
+                'subtotal': Decimal(summary['subtotal'])}
+    if meta is not None:
+        defaults['meta'] = meta
+    with transaction.atomic():
+        cart, _ = StoredCart.objects.update_or_create(defaults=defaults, **lookup)
+        cart.items.exclude(product_id__in=[int(pid) for pid in items]).delete()
+        StoredCartItem.objects.bulk_create(
+            [StoredCartItem(cart=cart, product_id=int(product_id),
+                            quantity=item['quantity'], price=Decimal(item['price']))
+             for product_id, item in items.items()],
+            update_conflicts=True,
+            unique_fields=['cart', 'product'],
+            update_fields=['quantity', 'price'],
+        )
+    return cart
+
+
+class BaseCartStorage:
+    def __init__(self, request):
+        self.request = request
+
+    def load(self):
+        """
+        Return the stored (items, coupon_id, meta).
+        """
+        raise NotImplementedError
+
+    def load_summary(self):
+        """
+        Return the summary of the stored lines; backends that keep it
+        separately avoid reading the lines.
+        """
+        return summarize(self.load()[0])
+
+    def save(self, items, coupon_id, meta):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class SessionCartStorage(BaseCartStorage):
+    def __init__(self, request):
+        super().__init__(request)
+        self.session = request.session
+        self.summary_key = f'{settings.CART_SESSION_ID}_summary'
+        self.meta_key = f'{settings.CART_SESSION_ID}_meta'
+
+    def load(self):
+        # Copy the lines so that Cart can annotate them without the extra
+        # keys ending up in the session
+        items = self.session.get(settings.CART_SESSION_ID) or {}
+        return ({product_id: dict(item) for product_id, item in items.items()},
+                self.session.get('coupon_id'),
+                dict(self.session.get(self.meta_key) or {}))
+
+    def load_summary(self):
+        summary = self.session.get(self.summary_key)
+        if summary is None:
+            return super().load_summary()
+        return summary
+
+    def save(self, items, coupon_id, meta):
+        self.session[settings.CART_SESSION_ID] = _serialize(items)
+        self.session[self.summary_key] = summarize(items)
+        if coupon_id:
+            self.session['coupon_id'] = coupon_id
+        else:
+            self.session.pop('coupon_id', None)
+        if meta:
+            self.session[self.meta_key] = meta
+        else:
+            self.session.pop(self.meta_key, None)
+        self.session.modified = True
+
+    def clear(self):
+        for key in (settings.CART_SESSION_ID, self.summary_key, self.meta_key, 'coupon_id'):
+            self.session.pop(key, None)
+        self.session.modified = True
+
+
+class CookieStorageMixin:
+    """
+    Helpers for backends that keep something in the cart cookie; the
+    cookie itself is written by CartCookieMiddleware.
+    """
+
+    def get_cookie(self):
+        pending = getattr(self.request, '_cart_cookie', None)
+        if pending is not None:
+            return pending or None
+        return self.request.COOKIES.get(settings.CART_COOKIE_NAME)
+
+    def set_cookie(self, value):
+        # An empty string asks the middleware to delete the cookie
+        self.request._cart_cookie = value
+
+    def get_token(self, create=False):
+        token = self.get_cookie()
+        if token is None and create:
+            token = secrets.token_urlsafe(24)
+            self.set_cookie(token)
+        return token
+
+
+class SignedCookieCartStorage(CookieStorageMixin, BaseCartStorage):
+    salt = 'cart.storage'
+
+    def _data(self):
+        value = self.get_cookie()
+        if not value:
+            return {}
+        try:
+            return signing.loads(value, salt=self.salt,
+                                 max_age=settings.CART_COOKIE_AGE)
+        except signing.BadSignature:
+            return {}
+
+    def load(self):
+        data = self._data()
+        return data.get('items', {}), data.get('coupon'), data.get('meta', {})
+
+    def load_summary(self):
+        return self._data().get('summary') or summarize({})
+
+    def save(self, items, coupon_id, meta):
+        if not items and not coupon_id and not meta:
+            self.clear()
+            return
+        data = {'items': _serialize(items), 'coupon': coupon_id, 'meta': meta,
+                'summary': summarize(items)}
+        self.set_cookie(signing.dumps(data, salt=self.salt, compress=True))
+
+    def clear(self):
+        self.set_cookie('')
+
+
+class CacheCartStorage(CookieStorageMixin, BaseCartStorage):
+    def __init__(self, request):
+        super().__init__(request)
+        self.cache = caches[settings.CART_CACHE_ALIAS]
+
+    def _key(self, token, part='items'):
+        return f'cart:{token}:{part}'
+
+    def load(self):
+        token = self.get_token()
+        if not token:
+            return {}, None, {}
+        data = self.cache.get(self._key(token)) or {}
+        return data.get('items', {}), data.get('coupon'), data.get('meta', {})
+
+    def load_summary(self):
+        token = self.get_token()
+        summary = token and self.cache.get(self._key(token, 'summary'))
+        return summary or summarize({})
+
+    def save(self, items, coupon_id, meta):
+        token = self.get_token(create=True)
+        self.cache.set_many({self._key(token): {'items': _serialize(items),
+                                                'coupon': coupon_id,
+                                                'meta': meta},
+                             self._key(token, 'summary'): summarize(items)},
+                            settings.CART_COOKIE_AGE)
+
+    def clear(self):
+        token = self.get_token()
+        if token:
+            self.cache.delete_many([self._key(token), self._key(token, 'summary')])
+            self.set_cookie('')
+
+
+class DatabaseCartStorage(CookieStorageMixin, BaseCartStorage):
+    def load(self):
+        token = self.get_token()
+        if not token:
+            return {}, None, {}
+        return _read_stored_cart(token=token)
+
+    def load_summary(self):
+        token = self.get_token()
+        row = None
+        if token:
+            row = (StoredCart.objects.filter(token=token)
+                   .values_list('item_count', 'subtotal').first())
+        if row is None:
+            return summarize({})
+        return {'count': row[0], 'subtotal': str(row[1])}
+
+    def save(self, items, coupon_id, meta):
+        _write_stored_cart(items, coupon_id, meta, token=self.get_token(create=True))
+
+    def clear(self):
+        token = self.get_token()
+        if token:
+            StoredCart.objects.filter(token=token).delete()
+            self.set_cookie('')
+
+
+class UserCartStorage(BaseCartStorage):
+    """
+    A logged-in user's cart, kept in the database and mirrored in the
+    browser's own storage. Every change is written to both. The version
+    stamp and summary of the stored cart are cached, so a page only costs
+    a cache read: the header uses the cached summary, and the browser copy
+    is reloaded from the database only when its stamp is out of date, i.e.
+    the cart was changed from another device.
+    """
+
+    def __init__(self, request, browser, user):
+        super().__init__(request)
+        self.browser = browser
+        self.user = user
+        self.cache = caches[settings.CART_CACHE_ALIAS]
+
+    def _cache_key(self):
+        return f'cart:user:{self.user.pk}'
+
+    def _remember(self, cart):
+        state = {'version': cart.updated.isoformat(),
+                 'summary': {'count': cart.item_count, 'subtotal': str(cart.subtotal)}}
+        self.cache.set(self._cache_key(), state, settings.CART_COOKIE_AGE)
+        return state
+
+    def _state(self):
+        """
+        Return the cached {'version', 'summary'} of the user's stored cart.
+        """
+        state = self.cache.get(self._cache_key())
+        if state is None:
+            cart = StoredCart.objects.filter(user=self.user).first()
+            if cart is None:
+                return {'version': None, 'summary': summarize({})}
+            state = self._remember(cart)
+        return state
+
+    def load(self):
+        items, coupon_id, meta = self.browser.load()
+        version = self._state()['version']
+        if version is not None and meta.get('synced') != version:
+            items, coupon_id, _ = _read_stored_cart(user=self.user)
+            meta['synced'] = version
+            self.browser.save(items, coupon_id, meta)
+        return items, coupon_id, meta
+
+    def load_summary(self):
+        return self._state()['summary']
+
+    def save(self, items, coupon_id, meta):
+        cart = _write_stored_cart(items, coupon_id, user=self.user)
+        meta['synced'] = self._remember(cart)['version']
+        self.browser.save(items, coupon_id, meta)
+
+    def clear(self):
+        self.save({}, None, {})
+
+    def merge(self):
+        """
+        Add the cart this browser had before logging in to the user's stored
+        cart, with a single bulk upsert of the lines.
+        """
+        items, coupon_id, meta = self.browser.load()
+        if not items or meta.get('synced'):
+            # Nothing to add, or already a copy of a stored cart
+            return
+        stored_items, stored_coupon_id, _ = _read_stored_cart(user=self.user)
+        for product_id, item in items.items():
+            if product_id in stored_items:
+                item = dict(item, quantity=stored_items[product_id]['quantity'] + item['quantity'])
+            stored_items[product_id] = item
+        self.save(stored_items, coupon_id or stored_coupon_id, meta)
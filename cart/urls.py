@@ -10,4 +10,9 @@ urlpatterns = [
     path('clear/', views.cart_clear, name='cart_clear'),
     path('apply-coupon/', views.apply_coupon, name='apply_coupon'),
     path('remove-coupon/', views.remove_coupon, name='remove_coupon'),
+    path('api/add/<int:product_id>/', views.api_cart_add, name='api_cart_add'),
+    path('api/update/<int:product_id>/', views.api_cart_update, name='api_cart_update'),
+    path('api/remove/<int:product_id>/', views.api_cart_remove, name='api_cart_remove'),
+    path('api/apply-coupon/', views.api_apply_coupon, name='api_apply_coupon'),
+    path('api/remove-coupon/', views.api_remove_coupon, name='api_remove_coupon'),
 ]
@@ -1,8 +1,11 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.utils import timezone
-from shop.models import Product, Coupon
+from decimal import Decimal
+from shop.models import Product
+from shop import coupons
 from .cart import Cart
 from .forms import CartAddProductForm
 
@@ -29,11 +32,31 @@ def cart_remove(request, product_id):
     messages.success(request, f'{product.name} removed from your cart.')
     return redirect('cart:cart_detail')
 
+def notify_cart_changes(request, changes):
+    """
+    Tell the buyer about the lines changed by Cart.revalidate().
+    """
+    for change in changes.values():
+        product = change['product']
+        name = product.name if product else 'A product'
+        if change['removed']:
+            messages.warning(request, f'{name} is no longer available and was removed from your cart.')
+            continue
+        if 'price' in change:
+            old, new = change['price']
+            messages.warning(request, f'The price of {name} changed from ${old} to ${new}.')
+        if 'quantity' in change:
+            messages.warning(request, f'Only {change["quantity"][1]} units of {name} are left; '
+                                      f'your cart was updated.')
+
 def cart_detail(request):
     cart = Cart(request)
+    changes = cart.revalidate()
+    notify_cart_changes(request, changes)
     for item in cart:
         item['update_quantity_form'] = CartAddProductForm(initial={'quantity': item['quantity'],
                                                                    'update': True})
+        item['changed'] = str(item['product'].id) in changes
     return render(request, 'cart/detail.html', {'cart': cart})
 
 @require_POST
@@ -43,27 +66,31 @@ def cart_clear(request):
     messages.success(request, 'Your shopping cart has been cleared.')
     return redirect('cart:cart_detail')
 
+def _apply_coupon_code(cart, code):
+    """
+    Apply the coupon with the given code to the cart. Returns the coupon and
+    an error message, one of which is None. The use is only counted when
+    the order is placed.
+    """
+    if not code:
+        return None, 'Please enter a coupon code.'
+    coupon = coupons.lookup(code)
+    if coupon is None:
+        return None, 'Invalid coupon code.'
+    if not coupon.is_valid():
+        return None, 'This coupon is no longer valid.'
+    if not cart.apply_coupon(coupon):
+        return None, 'You have already used this coupon.'
+    return coupon, None
+
 @require_POST
 def apply_coupon(request):
     cart = Cart(request)
-    coupon_code = request.POST.get('coupon_code', '').strip().upper()
-
-    if not coupon_code:
-        messages.error(request, 'Please enter a coupon code.')
-        return redirect('cart:cart_detail')
-
-    try:
-        coupon = Coupon.objects.get(code__iexact=coupon_code)
-        if coupon.is_valid():
-            cart.apply_coupon(coupon)
-            coupon.used_count += 1
-            coupon.save()
-            messages.success(request, f'Coupon "{coupon.code}" applied! You get {coupon.discount_percent}% off.')
-        else:
-            messages.error(request, 'This coupon is no longer valid.')
-    except Coupon.DoesNotExist:
-        messages.error(request, 'Invalid coupon code.')
-
+    coupon, error = _apply_coupon_code(cart, request.POST.get('coupon_code', ''))
+    if error:
+        messages.error(request, error)
+    else:
+        messages.success(request, f'Coupon "{coupon.code}" applied! You get {coupon.discount_percent}% off.')
     return redirect('cart:cart_detail')
 
 @require_POST
@@ -71,4 +98,65 @@ def remove_coupon(request):
     cart = Cart(request)
     cart.clear_coupon()
     messages.success(request, 'Coupon removed from cart.')
-    return redirect('cart:cart_detail')
\ No newline at end of file
+    return redirect('cart:cart_detail')
+
+def _cart_totals(cart):
+    coupon = cart.coupon
+    return {'count': len(cart),
+            'subtotal': str(cart.get_total_price()),
+            'discount': str(cart.get_discount()),
+            'total': str(cart.get_total_price_after_discount()),
+            'coupon': {'code': coupon.code,
+                       'discount_percent': coupon.discount_percent} if coupon else None}
+
+def _cart_line(cart, product):
+    item = cart.cart.get(str(product.id))
+    if item is None:
+        return {'product_id': product.id, 'quantity': 0, 'removed': True}
+    price = Decimal(item['price'])
+    return {'product_id': product.id,
+            'name': product.name,
+            'quantity': item['quantity'],
+            'price': str(price),
+            'total_price': str(price * item['quantity']),
+            'removed': False}
+
+def _change_quantity(request, product_id, update):
+    cart = Cart(request)
+    product = get_object_or_404(Product, id=product_id)
+    form = CartAddProductForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    cart.add(product=product,
+             quantity=form.cleaned_data['quantity'],
+             update_quantity=update)
+    return JsonResponse({'line': _cart_line(cart, product), **_cart_totals(cart)})
+
+@require_POST
+def api_cart_add(request, product_id):
+    return _change_quantity(request, product_id, update=False)
+
+@require_POST
+def api_cart_update(request, product_id):
+    return _change_quantity(request, product_id, update=True)
+
+@require_POST
+def api_cart_remove(request, product_id):
+    cart = Cart(request)
+    product = get_object_or_404(Product, id=product_id)
+    cart.remove(product)
+    return JsonResponse({'line': _cart_line(cart, product), **_cart_totals(cart)})
+
+@require_POST
+def api_apply_coupon(request):
+    cart = Cart(request)
+    coupon, error = _apply_coupon_code(cart, request.POST.get('coupon_code', ''))
+    if error:
+        return JsonResponse({'error': error, **_cart_totals(cart)}, status=400)
+    return JsonResponse(_cart_totals(cart))
+
+@require_POST
+def api_remove_coupon(request):
+    cart = Cart(request)
+    cart.clear_coupon()
+    return JsonResponse(_cart_totals(cart))
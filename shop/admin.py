@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Category, Product, Order, OrderItem, Review, Coupon
+from .models import Category, Product, Order, OrderItem, Review, Coupon, CouponRedemption, PaymentNotification
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -36,6 +36,20 @@ class ReviewAdmin(admin.ModelAdmin):
 @admin.register(Coupon)
 class CouponAdmin(admin.ModelAdmin):
     list_display = ('code', 'discount_percent', 'valid_from', 'valid_to', 'active', 'used_count', 'usage_limit')
-    list_filter = ('active', 'valid_from', 'valid_to')
+    list_filter = ('active', 'once_per_customer', 'valid_from', 'valid_to')
     search_fields = ('code',)
-    date_hierarchy = 'valid_from'
\ No newline at end of file
+    date_hierarchy = 'valid_from'
+
+@admin.register(CouponRedemption)
+class CouponRedemptionAdmin(admin.ModelAdmin):
+    list_display = ('coupon', 'order', 'user', 'email', 'created')
+    list_filter = ('coupon', 'created')
+    search_fields = ('coupon__code', 'email', 'user__username')
+    raw_id_fields = ('order', 'user')
+
+@admin.register(PaymentNotification)
+class PaymentNotificationAdmin(admin.ModelAdmin):
+    list_display = ('topic', 'resource_id', 'status', 'attempts', 'order', 'received', 'processed')
+    list_filter = ('topic', 'status', 'received')
+    search_fields = ('resource_id',)
+    raw_id_fields = ('order',)
@@ -0,0 +1,155 @@
+"""
+In-process prefix index for search-as-you-type suggestions.
+
+Every product and category name is stored once per word start in a sorted
+list, so a prefix lookup is a bisect plus a short scan and never touches
+the database. The index is built lazily on first use and kept up to date
+by the signals in shop.signals; each worker process holds its own copy.
+Like the facet index (see shop.facets), it remembers the catalog cache
+versions it was built from and is rebuilt when another process, or an
+update that bypassed the signals, moves them.
+"""
+import threading
+from bisect import bisect_left, insort
+
+from . import caching, search
+from .models import Category, Product
+
+PRODUCT = 'product'
+CATEGORY = 'category'
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Drop everything; the index is rebuilt on the next lookup.
+        """
+        with self._lock:
+            self._keys = []
+            self._items = {}
+            self._loaded = False
+            self._versions = None
+            # Scopes this process updated the index for, until they are bumped
+            self._updated = set()
+
+    def _scopes(self):
+        return [caching.ALL_PRODUCTS, caching.CATEGORIES]
+
+    def _load(self, versions):
+        products = list(Product.objects.filter(available=True)
+                        .values_list('id', 'name', 'slug'))
+        categories = list(Category.objects.values_list('id', 'name', 'slug'))
+        with self._lock:
+            if self._loaded and self._versions == versions:
+                return
+            self._keys = []
+            self._items = {}
+            self._updated = set()
+            for pk, name, slug in products:
+                self._add(PRODUCT, pk, name, Product(id=pk, slug=slug).get_absolute_url())
+            for pk, name, slug in categories:
+                self._add(CATEGORY, pk, name, Category(slug=slug).get_absolute_url())
+            self._keys.sort()
+            self._loaded = True
+            self._versions = versions
+
+    def adopt(self, scope, version):
+        """
+        Called with the new version of a scope after this process bumped
+        it, see FacetIndex.adopt().
+        """
+        with self._lock:
+            if scope not in self._scopes():
+                return
+            position = self._scopes().index(scope)
+            if (self._loaded and scope in self._updated and
+                    self._versions[position] == version - 1):
+                self._versions[position] = version
+            self._updated.discard(scope)
+
+    def _add(self, kind, pk, label, url, keep_sorted=False):
+        words = search.normalize(label).split()
+        keys = [(' '.join(words[i:]), i, kind, pk) for i in range(len(words))]
+        self._items[(kind, pk)] = (label, url, keys)
+        for key in keys:
+            if keep_sorted:
+                insort(self._keys, key)
+            else:
+                self._keys.append(key)
+
+    def _remove(self, kind, pk):
+        item = self._items.pop((kind, pk), None)
+        if item is None:
+            return
+        for key in item[2]:
+            position = bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+
+    def update(self, kind, pk, label=None, url=None):
+        """
+        Replace the entry for one object, or remove it when label is None.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            self._updated.add(caching.ALL_PRODUCTS if kind == PRODUCT else caching.CATEGORIES)
+            self._remove(kind, pk)
+            if label is not None:
+                self._add(kind, pk, label, url, keep_sorted=True)
+
+    def update_product(self, product):
+        if product.available:
+            self.update(PRODUCT, product.id, product.name, product.get_absolute_url())
+        else:
+            self.update(PRODUCT, product.id)
+
+    def remove_product(self, pk):
+        self.update(PRODUCT, pk)
+
+    def update_category(self, category, deleted=False):
+        if deleted:
+            self.update(CATEGORY, category.id)
+        else:
+            self.update(CATEGORY, category.id, category.name, category.get_absolute_url())
+
+    def suggest(self, prefix, limit):
+        """
+        Return up to `limit` products and `limit` categories whose name (or a
+        word in it) starts with the prefix. Whole-name matches come first.
+        """
+        # Read before loading, so changes made meanwhile trigger another load
+        versions = caching.get_versions(*self._scopes())
+        if not self._loaded or self._versions != versions:
+            self._load(versions)
+        prefix = search.normalize(prefix)
+        if not prefix:
+            return {PRODUCT: [], CATEGORY: []}
+        results = {PRODUCT: {}, CATEGORY: {}}
+        with self._lock:
+            keys = self._keys
+            position = bisect_left(keys, (prefix,))
+            scanned = 0
+            while (position < len(keys) and keys[position][0].startswith(prefix)
+                   and scanned < limit * 10):
+                key, offset, kind, pk = keys[position]
+                found = results[kind]
+                if pk not in found or offset < found[pk]:
+                    found[pk] = offset
+                position += 1
+                scanned += 1
+            for kind, found in results.items():
+                ranked = sorted(found.items(),
+                                key=lambda match: (match[1], self._items[(kind, match[0])][0]))
+                results[kind] = [{'id': pk,
+                                  'name': self._items[(kind, pk)][0],
+                                  'url': self._items[(kind, pk)][1]}
+                                 for pk, _ in ranked[:limit]]
+        return results
+
+
+index = PrefixIndex()
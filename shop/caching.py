@@ -0,0 +1,120 @@
+"""
+Versioned caching for the public catalog.
+
+Cached entries embed the current value of one or more version counters in
+their key. The counters are bumped by the signals in shop.signals once a
+change to a Product, Category or Review commits, so an entry is never
+served after its data changed: the next request simply builds a key that
+does not exist yet. Works with any Django cache backend (local memory, file, ...).
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import autocomplete, facets
+from .models import Category
+
+# Scope bumped by any product change; pages that list the whole catalog use it
+ALL_PRODUCTS = 'products'
+# Scope bumped by any category change
+CATEGORIES = 'categories'
+# Scope bumped by any coupon change or redemption
+COUPONS = 'coupons'
+
+
+def category_scope(category_id):
+    return f'category:{category_id}'
+
+
+def product_scope(product_id):
+    return f'product:{product_id}'
+
+
+def _version_key(scope):
+    return f'catalog:version:{scope}'
+
+
+def _fresh_version():
+    # A counter that was evicted must not restart at a value an old entry
+    # might still be stored under, so new counters start at the clock.
+    return time.time_ns()
+
+
+def get_versions(*scopes):
+    keys = [_version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _fresh_version(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_now(*scopes):
+    for scope in set(scopes):
+        key = _version_key(scope)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), None)
+            continue
+        # Scopes are bumped after the change reached the in-memory indexes
+        facets.index.adopt(scope, version)
+        autocomplete.index.adopt(scope, version)
+
+
+def bump(*scopes):
+    """
+    Bump the scopes once the current transaction commits, or right away
+    outside of one. Bumping earlier would let a concurrent request cache
+    the old committed rows under the new version.
+    """
+    transaction.on_commit(lambda: bump_now(*scopes))
+
+
+def make_key(name, scopes, *parts):
+    """
+    Build a cache key for `name` that changes whenever any of the scopes is
+    bumped. Extra parts (query strings, ids...) are hashed into the key.
+    """
+    versions = '.'.join(str(v) for v in get_versions(*scopes))
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return f'catalog:{name}:{versions}:{digest}'
+
+
+def get_or_set(key, builder):
+    value = cache.get(key)
+    if value is None:
+        value = builder()
+        cache.set(key, value, settings.CATALOG_CACHE_TIMEOUT)
+    return value
+
+
+def categories():
+    """
+    Return all categories, cached until a category changes.
+    """
+    return get_or_set(make_key('categories', [CATEGORIES]),
+                      lambda: list(Category.objects.all()))
+
+
+def refresh_products(products):
+    """
+    Propagate changes made with queryset.update(), which bypasses the
+    Product signals, to the catalog caches and the in-memory indexes once the
+    current transaction commits; a rolled-back update never reaches them.
+    The refresh is robust: failing it must not turn the committed change
+    into an error for the caller.
+    """
+    def refresh():
+        scopes = [ALL_PRODUCTS]
+        for product in products.only('category_id', 'available', 'price', 'stock',
+                                     'average_rating', 'name', 'slug'):
+            facets.index.update_product(product)
+            autocomplete.index.update_product(product)
+            scopes += [category_scope(product.category_id), product_scope(product.id)]
+        bump_now(*scopes)
+    transaction.on_commit(refresh, robust=True)
@@ -0,0 +1,81 @@
+"""
+Coupon lookup and redemption.
+
+The coupons that can still be used are cached as a {code: Coupon} dict, so
+validating a code is usually a cache hit; other codes fall back to the
+unique index on `Coupon.code_normalized`, an upper case copy of the code.
+Applying a coupon to a cart only checks it; a use is counted when an order
+is placed, with a single conditional UPDATE, so concurrent checkouts can
+never push `used_count` past `usage_limit`. Every use is also recorded in
+the CouponRedemption ledger, which is what "once per customer" coupons are
+checked against.
+"""
+from django.db.models import F
+from django.utils import timezone
+
+from . import caching
+from .models import Coupon, CouponRedemption
+
+
+def active():
+    """
+    Return the active, unexpired coupons by normalized code.
+    """
+    def build():
+        coupons = Coupon.objects.filter(active=True, valid_to__gte=timezone.now())
+        return {coupon.code_normalized: coupon for coupon in coupons}
+    return caching.get_or_set(caching.make_key('coupons', [caching.COUPONS]), build)
+
+
+def lookup(code):
+    code = Coupon.normalize_code(code)
+    if not code:
+        return None
+    coupon = active().get(code)
+    if coupon is None:
+        coupon = Coupon.objects.filter(code_normalized=code).first()
+    return coupon
+
+
+def used_by(coupon, user=None, email=None):
+    """
+    Whether the customer, identified by user and/or email, already used the
+    coupon. Each check is a lookup on one of the ledger indexes.
+    """
+    redemptions = CouponRedemption.objects.filter(coupon=coupon)
+    if user is not None and user.is_authenticated:
+        if redemptions.filter(user=user).exists():
+            return True
+    return bool(email) and redemptions.filter(email=email.lower()).exists()
+
+
+def can_use(coupon, user=None, email=None):
+    return not coupon.once_per_customer or not used_by(coupon, user, email)
+
+
+def redeem(coupon):
+    """
+    Count one use of the coupon. Returns False if the coupon can no longer
+    be used, e.g. because other orders used it up first.
+    """
+    now = timezone.now()
+    redeemed = bool(Coupon.objects.filter(pk=coupon.pk,
+                                          active=True,
+                                          valid_from__lte=now,
+                                          valid_to__gte=now,
+                                          used_count__lt=F('usage_limit'))
+                    .update(used_count=F('used_count') + 1))
+    if redeemed:
+        # The cached coupons carry used_count
+        caching.bump(caching.COUPONS)
+    return redeemed
+
+
+def record(order):
+    """
+    Add the use of the order's coupon to the ledger.
+    """
+    return CouponRedemption.objects.create(coupon=order.coupon,
+                                           user=order.user,
+                                           email=order.email.lower(),
+                                           order=order)
@@ -0,0 +1,319 @@
+"""
+Precomputed facet bitmaps for the catalog filters.
+
+Every facet value (a category, a price range, a minimum rating, "in
+stock") keeps a bitmap of the available products that have it, stored as
+a Python int with bit N set for product id N. A filter combination is the
+AND of its bitmaps and a facet count is the popcount of that intersection,
+so counts never need a GROUP BY. Bitmaps are built lazily from the
+database and kept current by the Product signals in shop.signals.
+
+The bitmaps are local to the process, so they remember the catalog cache
+version of shop.caching.ALL_PRODUCTS they reflect and are rebuilt when
+another process moves it. Bumps that follow this process's own updates
+are adopted without a rebuild, see `adopt()`.
+"""
+import threading
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import Q
+from django.urls import reverse
+
+from . import caching
+from .models import Product
+
+
+# Catalog orderings selectable with ?sort=, besides the default one
+SORTS = {
+    'rating': ['-weighted_rating', 'id'],
+}
+
+
+def price_key(low, high):
+    return f'{low}-{high}' if high is not None else f'{low}-'
+
+
+def price_bucket(price):
+    for low, high in settings.PRICE_FACETS:
+        if price >= low and (high is None or price < high):
+            return price_key(low, high)
+    return None
+
+
+def parse_filters(params):
+    """
+    Read the facet filters from a QueryDict, ignoring invalid values.
+    """
+    filters = {'price': None, 'rating': None, 'in_stock': False, 'sort': None}
+    price = params.get('price')
+    if price in {price_key(low, high) for low, high in settings.PRICE_FACETS}:
+        filters['price'] = price
+    try:
+        rating = int(params.get('rating', ''))
+    except ValueError:
+        rating = None
+    if rating in settings.RATING_FACETS:
+        filters['rating'] = rating
+    filters['in_stock'] = params.get('in_stock') == '1'
+    if params.get('sort') in SORTS:
+        filters['sort'] = params.get('sort')
+    return filters
+
+
+def filter_q(filters, prefix=''):
+    """
+    Return the price, rating and stock filters as a Q object; `prefix`
+    reaches the product through a relation, e.g. 'product__'.
+    """
+    q = Q()
+    if filters['price']:
+        low, high = filters['price'].split('-')
+        q &= Q(**{f'{prefix}price__gte': Decimal(low)})
+        if high:
+            q &= Q(**{f'{prefix}price__lt': Decimal(high)})
+    if filters['rating']:
+        q &= Q(**{f'{prefix}average_rating__gte': filters['rating']})
+    if filters['in_stock']:
+        q &= Q(**{f'{prefix}stock__gt': 0})
+    return q
+
+
+def filter_queryset(queryset, filters):
+    queryset = queryset.filter(filter_q(filters))
+    if filters['sort']:
+        queryset = queryset.order_by(*SORTS[filters['sort']])
+    return queryset
+
+
+def bitmap(ids):
+    """
+    Return the bitmap of a list of ids. The bits are set in a bytearray and
+    turned into an int once, since OR-ing them into an int one by one
+    copies the whole number every time.
+    """
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        bits[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FacetIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._loaded = False
+        self._version = None
+        # Set by this process's own updates until the bump that follows them
+        self._updated = False
+        self._state = {}
+        self._all = 0
+        self._category = {}
+        self._price = {}
+        self._rating = {}
+        self._in_stock = 0
+
+    def _load(self, version):
+        rows = list(Product.objects.filter(available=True)
+                    .values_list('id', 'category_id', 'price', 'stock', 'average_rating'))
+        with self._lock:
+            if self._loaded and self._version == version:
+                return
+            self._reset()
+            for row in rows:
+                self._set(*row)
+            self._loaded = True
+            self._version = version
+
+    def adopt(self, scope, version):
+        """
+        Called with the new version of a scope after this process bumped
+        it; only ALL_PRODUCTS matters here. When the bump follows an update
+        made here the bitmaps already hold the change, so they are only
+        rebuilt if another process bumped the version in between, or if
+        nothing was updated here.
+        """
+        if scope != caching.ALL_PRODUCTS:
+            return
+        with self._lock:
+            if self._loaded and self._updated and self._version == version - 1:
+                self._version = version
+            self._updated = False
+
+    def _set(self, product_id, category_id, price, stock, average_rating):
+        try:
+            rating = Decimal(average_rating)
+        except (InvalidOperation, TypeError):
+            rating = Decimal(0)
+        state = (category_id,
+                 price_bucket(Decimal(price)),
+                 tuple(n for n in settings.RATING_FACETS if rating >= n),
+                 stock > 0)
+        if self._state.get(product_id) == state:
+            return
+        self._unset(product_id)
+        bit = 1 << product_id
+        self._state[product_id] = state
+        self._all |= bit
+        self._category[category_id] = self._category.get(category_id, 0) | bit
+        if state[1] is not None:
+            self._price[state[1]] = self._price.get(state[1], 0) | bit
+        for n in state[2]:
+            self._rating[n] = self._rating.get(n, 0) | bit
+        if state[3]:
+            self._in_stock |= bit
+
+    def _unset(self, product_id):
+        state = self._state.pop(product_id, None)
+        if state is None:
+            return
+        mask = ~(1 << product_id)
+        category_id, price, ratings, in_stock = state
+        self._all &= mask
+        self._category[category_id] &= mask
+        if price is not None:
+            self._price[price] &= mask
+        for n in ratings:
+            self._rating[n] &= mask
+        if in_stock:
+            self._in_stock &= mask
+
+    def update_product(self, product):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._updated = True
+            if product.available:
+                self._set(product.id, product.category_id, product.price,
+                          product.stock, product.average_rating)
+            else:
+                self._unset(product.id)
+
+    def remove_product(self, product_id):
+        with self._lock:
+            if self._loaded:
+                self._updated = True
+                self._unset(product_id)
+
+    def _mask(self, category_id, filters, candidates, exclude=None):
+        mask = self._all if candidates is None else self._all & candidates
+        if category_id and exclude != 'category':
+            mask &= self._category.get(category_id, 0)
+        if filters['price'] and exclude != 'price':
+            mask &= self._price.get(filters['price'], 0)
+        if filters['rating'] and exclude != 'rating':
+            mask &= self._rating.get(filters['rating'], 0)
+        if filters['in_stock'] and exclude != 'in_stock':
+            mask &= self._in_stock
+        return mask
+
+    def _refresh(self):
+        # Read before loading, so changes made meanwhile trigger another load
+        version = caching.get_versions(caching.ALL_PRODUCTS)[0]
+        if not self._loaded or self._version != version:
+            self._load(version)
+
+    def count(self, candidates):
+        """
+        Return how many of the candidates are available products.
+        """
+        self._refresh()
+        with self._lock:
+            return (self._all & candidates).bit_count()
+
+    def counts(self, category_id, filters, candidates=None):
+        """
+        Return the number of matching products for every facet value. Each
+        facet is counted with all the other active filters applied, so the
+        numbers show what selecting that value would return.
+        """
+        self._refresh()
+        with self._lock:
+            by_category = self._mask(category_id, filters, candidates, 'category')
+            by_price = self._mask(category_id, filters, candidates, 'price')
+            by_rating = self._mask(category_id, filters, candidates, 'rating')
+            by_stock = self._mask(category_id, filters, candidates, 'in_stock')
+            return {
+                'total': self._mask(category_id, filters, candidates).bit_count(),
+                'all_categories': by_category.bit_count(),
+                'category': {cid: (bits & by_category).bit_count()
+                             for cid, bits in self._category.items()},
+                'price': {key: (bits & by_price).bit_count()
+                          for key, bits in self._price.items()},
+                'rating': {n: (bits & by_rating).bit_count()
+                           for n, bits in self._rating.items()},
+                'in_stock': (self._in_stock & by_stock).bit_count(),
+            }
+
+
+def facet_choices(request, categories, category, filters, counts):
+    """
+    Build the links shown next to each facet value, keeping the other
+    filters (and the search query) of the current request.
+    """
+    def query(**changes):
+        params = request.GET.copy()
+        params.pop('cursor', None)
+        for name, value in changes.items():
+            if value is None:
+                params.pop(name, None)
+            else:
+                params[name] = value
+        encoded = params.urlencode()
+        return f'?{encoded}' if encoded else ''
+
+    def link(**changes):
+        # An empty href would keep the current query string
+        return query(**changes) or request.path
+
+    same_filters = query()
+    choices = {
+        'all_categories': {'url': reverse('shop:product_list') + same_filters,
+                           'count': counts['all_categories'],
+                           'selected': category is None},
+        'categories': [{'label': c.name,
+                        'url': c.get_absolute_url() + same_filters,
+                        'count': counts['category'].get(c.id, 0),
+                        'selected': category is not None and c.id == category.id}
+                       for c in categories],
+        'price': [],
+        'rating': [],
+        'in_stock': {'count': counts['in_stock'],
+                     'selected': filters['in_stock'],
+                     'url': link(in_stock=None if filters['in_stock'] else '1')},
+        'sort': [{'label': 'Relevancia' if request.GET.get('q') else 'Nombre',
+                  'selected': filters['sort'] is None,
+                  'url': link(sort=None)},
+                 {'label': 'Mejor valorados',
+                  'selected': filters['sort'] == 'rating',
+                  'url': link(sort='rating')}],
+    }
+    for low, high in settings.PRICE_FACETS:
+        key = price_key(low, high)
+        selected = filters['price'] == key
+        choices['price'].append({
+            'label': f'${low} - ${high}' if high is not None else f'${low}+',
+            'count': counts['price'].get(key, 0),
+            'selected': selected,
+            'url': link(price=None if selected else key),
+        })
+    for n in settings.RATING_FACETS:
+        selected = filters['rating'] == n
+        choices['rating'].append({
+            'label': f'{n}★ o más',
+            'count': counts['rating'].get(n, 0),
+            'selected': selected,
+            'url': link(rating=None if selected else str(n)),
+        })
+    return choices
+
+
+index = FacetIndex()
@@ -0,0 +1,109 @@
+"""
+A local stand-in for the MercadoPago API, for tests and benchmarks.
+
+It answers checkout preference creation and payment / merchant order
+lookups after an optional delay, so checkout can be exercised without
+network access or credentials. Point MERCADOPAGO_API_URL at it:
+
+    with FakeMercadoPago(latency=0.2) as server:
+        settings.MERCADOPAGO_API_URL = server.url
+        ...
+
+`python manage.py fake_mercadopago` runs it in the foreground.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeMercadoPago:
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.latency = latency
+        # Payments and merchant orders served by id; tests add their own
+        self.preferences = {}
+        self.payments = {}
+        self.merchant_orders = {}
+        self.requests = []
+        self.connections = set()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def create_preference(self, data):
+        with self._lock:
+            preference_id = f'fake-{next(self._ids)}'
+        preference = dict(data, id=preference_id,
+                          init_point=f'{self.url}/checkout?pref_id={preference_id}',
+                          sandbox_init_point=f'{self.url}/sandbox/checkout?pref_id={preference_id}')
+        self.preferences[preference_id] = preference
+        return preference
+
+    def handle(self, method, path, data):
+        """
+        Return (status, body) for an API call.
+        """
+        with self._lock:
+            self.requests.append((method, path))
+        time.sleep(self.latency)
+        if method == 'POST' and path == '/checkout/preferences':
+            return 201, self.create_preference(data)
+        if method == 'GET':
+            for prefix, objects in (('/v1/payments/', self.payments),
+                                    ('/merchant_orders/', self.merchant_orders)):
+                if path.startswith(prefix) and path[len(prefix):] in objects:
+                    return 200, objects[path[len(prefix):]]
+        return 404, {'message': 'resource not found', 'status': 404}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open like the real API
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _serve(self):
+                fake.connections.add(self.client_address)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, response = fake.handle(self.command, self.path.split('?')[0],
+                                               json.loads(body) if body else {})
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = _serve
+
+        return Handler
@@ -0,0 +1,248 @@
+"""
+Process-wide MercadoPago client.
+
+`get_gateway()` returns one gateway per process, built from the class named
+in MERCADOPAGO_GATEWAY:
+
+- MercadoPagoGateway calls the real API (or MERCADOPAGO_API_URL) through a
+  single pooled requests session, so calls reuse keep-alive connections
+  instead of paying a TLS handshake each, and every call has a timeout.
+  A circuit breaker stops calling the API for MERCADOPAGO_BREAKER_RESET
+  seconds after MERCADOPAGO_BREAKER_THRESHOLD consecutive failures, so a
+  degraded provider makes checkouts and webhooks fail fast instead of
+  tying up every worker.
+- StubGateway answers from memory; the tests use it.
+
+Both return the SDK's {'status', 'response'} dicts and keep call metrics,
+see `stats()`.
+"""
+import itertools
+import threading
+import time
+
+import mercadopago
+import requests
+from mercadopago.http.http_client import HttpClient
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+API_URL = 'https://api.mercadopago.com'
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+class GatewayUnavailable(Exception):
+    """
+    Raised without calling the API while the circuit breaker is open.
+    """
+
+
+class PooledHttpClient(HttpClient):
+    """
+    SDK HTTP client sharing one connection pool between all calls and
+    threads, with a default timeout.
+    """
+
+    def __init__(self, api_url=None, timeout=None, pool_size=10):
+        self.api_url = api_url.rstrip('/') if api_url else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        if self.api_url and url.startswith(API_URL):
+            url = self.api_url + url[len(API_URL):]
+        if self.timeout is not None:
+            # Instead of the SDK's 60 second default
+            kwargs['timeout'] = self.timeout
+        response = self.session.request(method, url, **kwargs)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {'message': response.text}
+        return {'status': response.status_code, 'response': body}
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a call may go through. Once the reset timeout has passed, a
+        single trial call is let through to probe the provider.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    print(f'MercadoPago circuit opened after {self.failures} failures')
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class BaseGateway:
+    def __init__(self):
+        self._metrics_lock = threading.Lock()
+        self._metrics = dict.fromkeys(['calls', 'failures', 'rejected'], 0)
+        self._metrics.update(total_ms=0.0, max_ms=0.0)
+
+    def _count(self, name, elapsed=None):
+        with self._metrics_lock:
+            self._metrics[name] += 1
+            if elapsed is not None:
+                ms = elapsed * 1000
+                self._metrics['total_ms'] += ms
+                self._metrics['max_ms'] = max(self._metrics['max_ms'], ms)
+
+    def stats(self):
+        """
+        Return the call counters and latencies of this process.
+        """
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        finished = metrics['calls'] - metrics['rejected']
+        metrics['avg_ms'] = metrics['total_ms'] / finished if finished else 0.0
+        return metrics
+
+    def create_preference(self, data):
+        raise NotImplementedError
+
+    def get_payment(self, payment_id):
+        raise NotImplementedError
+
+    def get_merchant_order(self, merchant_order_id):
+        raise NotImplementedError
+
+
+class MercadoPagoGateway(BaseGateway):
+    def __init__(self):
+        super().__init__()
+        self.http_client = PooledHttpClient(api_url=settings.MERCADOPAGO_API_URL,
+                                            timeout=settings.MERCADOPAGO_TIMEOUT,
+                                            pool_size=settings.MERCADOPAGO_POOL_SIZE)
+        self.sdk = mercadopago.SDK(settings.MERCADOPAGO_ACCESS_TOKEN,
+                                   http_client=self.http_client)
+        self.breaker = CircuitBreaker(settings.MERCADOPAGO_BREAKER_THRESHOLD,
+                                      settings.MERCADOPAGO_BREAKER_RESET)
+
+    def _call(self, call):
+        if not self.breaker.allow():
+            self._count('calls')
+            self._count('rejected')
+            raise GatewayUnavailable('MercadoPago is failing; not calling it for now.')
+        start = time.perf_counter()
+        try:
+            response = call()
+        except Exception:
+            self.breaker.record(False)
+            self._count('failures')
+            raise
+        finally:
+            self._count('calls', time.perf_counter() - start)
+        failed = response.get('status', 500) >= 500
+        self.breaker.record(not failed)
+        if failed:
+            self._count('failures')
+        return response
+
+    def create_preference(self, data):
+        return self._call(lambda: self.sdk.preference().create(data))
+
+    def get_payment(self, payment_id):
+        return self._call(lambda: self.sdk.payment().get(payment_id))
+
+    def get_merchant_order(self, merchant_order_id):
+        return self._call(lambda: self.sdk.merchant_order().get(merchant_order_id))
+
+
+class StubGateway(BaseGateway):
+    """
+    In-memory gateway. Preferences are always created; payments and
+    merchant orders are served from the dicts of the same name. Setting
+    `error` makes every call raise it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.preferences = {}
+        self.payments = {}
+        self.merchant_orders = {}
+        self.requests = []
+        self.error = None
+        self._ids = itertools.count(1)
+
+    def _call(self, name, key, answer):
+        self.requests.append((name, key))
+        self._count('calls', 0)
+        if self.error is not None:
+            self._count('failures')
+            raise self.error
+        return answer()
+
+    def create_preference(self, data):
+        def answer():
+            preference_id = f'stub-{next(self._ids)}'
+            preference = dict(data, id=preference_id,
+                              init_point=f'https://stub.mercadopago/checkout/{preference_id}',
+                              sandbox_init_point=f'https://stub.mercadopago/sandbox/{preference_id}')
+            self.preferences[preference_id] = preference
+            return {'status': 201, 'response': preference}
+        return self._call('create_preference', None, answer)
+
+    def _lookup(self, objects, key):
+        if str(key) in objects:
+            return {'status': 200, 'response': objects[str(key)]}
+        return {'status': 404, 'response': {'message': 'resource not found'}}
+
+    def get_payment(self, payment_id):
+        return self._call('get_payment', str(payment_id),
+                          lambda: self._lookup(self.payments, payment_id))
+
+    def get_merchant_order(self, merchant_order_id):
+        return self._call('get_merchant_order', str(merchant_order_id),
+                          lambda: self._lookup(self.merchant_orders, merchant_order_id))
+
+
+def get_gateway():
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = import_string(settings.MERCADOPAGO_GATEWAY)()
+        return _gateway
+
+
+@receiver(setting_changed)
+def reset_gateway(setting, **kwargs):
+    global _gateway
+    if setting.startswith('MERCADOPAGO_'):
+        with _gateway_lock:
+            _gateway = None
@@ -0,0 +1,131 @@
+"""
+Stock reservations for orders.
+
+The stock of an order's products is taken when the order is placed
+(reserve), kept when it is paid (commit) and given back when the payment
+fails or the reservation expires (release). Each step changes the stock of
+all the order lines with a single conditional UPDATE of the product table,
+and moves Order.stock_status with a conditional UPDATE too, so a step takes
+effect once even when the payment page, the webhook and the IPN report the
+same payment at the same time.
+"""
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from . import caching
+from .models import Order, Product
+
+
+class InsufficientStock(Exception):
+    """
+    Raised by reserve() when a line asks for more than is left.
+    """
+
+
+def _quantities(lines):
+    quantities = {}
+    for product_id, quantity in lines:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def _order_lines(order):
+    return order.items.values_list('product_id', 'quantity')
+
+
+def _change_stock(quantities, sign, strict=True):
+    """
+    Add `sign * quantity` to the stock of every product in one UPDATE and
+    return the number of products changed. When taking stock, `strict`
+    leaves a product untouched if it has too little left; otherwise its
+    stock drops to zero.
+    """
+    if not quantities:
+        return 0
+    products = Product.objects.filter(pk__in=quantities)
+    whens = []
+    for product_id, quantity in quantities.items():
+        if sign < 0 and not strict:
+            whens.append(When(pk=product_id, stock__lt=quantity, then=Value(0)))
+        whens.append(When(pk=product_id, then=F('stock') + sign * quantity))
+    if sign < 0 and strict:
+        products = products.filter(reduce(or_, (Q(pk=product_id, stock__gte=quantity)
+                                               for product_id, quantity in quantities.items())))
+    changed = products.update(stock=Case(*whens, output_field=IntegerField()),
+                              updated=Now())
+    caching.refresh_products(Product.objects.filter(pk__in=quantities))
+    return changed
+
+
+def _move(order, sources, target, **conditions):
+    """
+    Move the order to the `target` stock status if it is in one of
+    `sources`. Returns whether this call made the move.
+    """
+    moved = (Order.objects.filter(pk=order.pk, stock_status__in=sources, **conditions)
+             .update(stock_status=target, reserved_until=None))
+    if moved:
+        order.stock_status = target
+        order.reserved_until = None
+    return bool(moved)
+
+
+def reserve(order, lines):
+    """
+    Take the stock for the (product_id, quantity) lines of a new, unsaved
+    order and mark it reserved; the caller saves the order. Raises
+    InsufficientStock, changing nothing, if any product has too little
+    left. Must run inside the transaction that creates the order.
+    """
+    quantities = _quantities(lines)
+    with transaction.atomic():
+        if _change_stock(quantities, -1) != len(quantities):
+            # Undo the lines that did fit
+            raise InsufficientStock()
+    order.stock_status = Order.STOCK_RESERVED
+    order.reserved_until = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TIMEOUT)
+
+
+def commit(order):
+    """
+    Keep the stock of a paid order. Orders whose reservation was released
+    (or that never had one) take their stock again; a paid order cannot be
+    refused, so stock that ran out is set to zero. Returns whether this call
+    committed the order.
+    """
+    with transaction.atomic():
+        if _move(order, [Order.STOCK_RESERVED], Order.STOCK_COMMITTED):
+            return True
+        if _move(order, [Order.STOCK_NONE, Order.STOCK_RELEASED], Order.STOCK_COMMITTED):
+            _change_stock(_quantities(_order_lines(order)), -1, strict=False)
+            return True
+    return False
+
+
+def release(order):
+    """
+    Give back the stock reserved by an unpaid order. Returns whether this
+    call released it.
+    """
+    with transaction.atomic():
+        if _move(order, [Order.STOCK_RESERVED], Order.STOCK_RELEASED, paid=False):
+            _change_stock(_quantities(_order_lines(order)), 1)
+            return True
+    return False
+
+
+def release_expired(now=None):
+    """
+    Release every reservation past its deadline. Returns how many orders
+    were released.
+    """
+    expired = Order.objects.filter(stock_status=Order.STOCK_RESERVED, paid=False,
+                                   reserved_until__lt=now or timezone.now())
+    return sum(release(order) for order in expired.only('id'))
@@ -0,0 +1,76 @@
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from shop import search
+from shop.models import Category, Product
+
+WORDS = ['alitas', 'clásicas', 'picantes', 'fuego', 'salsa', 'seúl', 'nocturno',
+         'muslo', 'crujiente', 'tiras', 'pollo', 'combo', 'papas', 'rústicas',
+         'ranch', 'ajo', 'miel', 'mostaza', 'bbq', 'dulcemiel', 'naranja']
+
+
+class Command(BaseCommand):
+    help = 'Compares icontains, full-text and trigram search timings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('queries', nargs='*',
+                            default=['alitas', 'clasicas', 'seul', 'crujinete'])
+        parser.add_argument('--products', type=int, default=0,
+                            help='Generate this many synthetic products '
+                                 '(rolled back afterwards).')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['products']:
+                self.generate(options['products'])
+            total = Product.objects.count()
+            self.stdout.write(f'Catalog size: {total} products, '
+                              f'{options["repeat"]} runs per query\n')
+            self.stdout.write(f'{"query":<14}{"method":<12}{"hits":>8}{"ms/query":>12}')
+            for query in options['queries']:
+                for method, runner in self.methods():
+                    hits, elapsed = self.measure(runner, query, options['repeat'])
+                    self.stdout.write(f'{query:<14}{method:<12}{hits:>8}'
+                                      f'{elapsed * 1000:>12.3f}')
+            transaction.set_rollback(True)
+
+    def methods(self):
+        def icontains(query):
+            return list(Product.objects
+                        .filter(Q(name__icontains=query) |
+                                Q(description__icontains=query))
+                        .values_list('id', flat=True))
+        return [
+            ('icontains', icontains),
+            ('fts', search.ranked_ids),
+            ('trigram', search.fuzzy_ids),
+        ]
+
+    def measure(self, runner, query, repeat):
+        hits = len(runner(query))
+        start = time.perf_counter()
+        for _ in range(repeat):
+            runner(query)
+        return hits, (time.perf_counter() - start) / repeat
+
+    def generate(self, count):
+        self.stdout.write(f'Generating {count} products...')
+        category, _ = Category.objects.get_or_create(name='Benchmark',
+                                                     slug='benchmark')
+        rng = random.Random(42)
+        products = []
+        for i in range(count):
+            name = ' '.join(rng.sample(WORDS, 3)).title()
+            products.append(Product(category=category,
+                                    name=f'{name} {i}',
+                                    slug=f'bench-{i}',
+                                    description=' '.join(rng.sample(WORDS, 8)),
+                                    price=Decimal('9.99')))
+        Product.objects.bulk_create(products, batch_size=1000)
+        search.rebuild()
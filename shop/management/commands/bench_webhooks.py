@@ -0,0 +1,106 @@
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+
+from shop import notifications
+from shop.gateway import get_gateway
+from shop.views import mercadopago_webhook
+
+KINDS = ['genuine', 'replayed', 'forged', 'expired', 'unsigned']
+
+
+class Command(BaseCommand):
+    help = ('Floods the webhook with a mix of genuine, replayed, forged, expired '
+            'and unsigned notifications and reports how many were shed and '
+            'what each kind cost.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--genuine', type=float, default=0.05,
+                            help='Share of genuine notifications.')
+
+    def handle(self, *args, **options):
+        self.secret = settings.MERCADOPAGO_WEBHOOK_SECRET
+        rng = random.Random(42)
+        genuine = options['genuine']
+        weights = [genuine, genuine, *[(1 - 2 * genuine) / 3] * 3]
+        kinds = rng.choices(KINDS, weights, k=options['requests'])
+        # Runs inline against the stub gateway; rows are rolled back afterwards
+        with override_settings(MERCADOPAGO_GATEWAY='shop.gateway.StubGateway',
+                               MERCADOPAGO_WORKERS=0), transaction.atomic():
+            self.stdout.write('With signature verification:')
+            self.report(self.run(kinds))
+            with override_settings(MERCADOPAGO_WEBHOOK_SECRET=''):
+                notifications.recent.clear()
+                self.stdout.write('\nWithout signature verification:')
+                self.report(self.run(kinds))
+            transaction.set_rollback(True)
+
+    def run(self, kinds):
+        factory = RequestFactory()
+        gateway = get_gateway()
+        results = {kind: {'requests': 0, 'shed': 0, 'seconds': 0.0, 'queries': 0, 'api_calls': 0}
+                   for kind in KINDS}
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        last_genuine = None
+        for kind in kinds:
+            if kind == 'replayed' and last_genuine:
+                payment_id, headers = last_genuine
+            else:
+                payment_id = uuid.uuid4().hex[:12]
+                headers = self.headers(kind, payment_id)
+            if kind == 'genuine':
+                last_genuine = payment_id, headers
+            request = factory.post(f'/webhook/?data.id={payment_id}&type=payment',
+                                   content_type='application/json', headers=headers)
+            calls = len(gateway.requests)
+            queries.clear()
+            with connection.execute_wrapper(count_query):
+                start = time.perf_counter()
+                response = mercadopago_webhook(request)
+                elapsed = time.perf_counter() - start
+            result = results[kind]
+            result['requests'] += 1
+            # Answered without touching the database
+            result['shed'] += response.status_code == 401 or not queries
+            result['seconds'] += elapsed
+            result['queries'] += len(queries)
+            result['api_calls'] += len(gateway.requests) - calls
+        return results
+
+    def headers(self, kind, payment_id):
+        if kind == 'unsigned':
+            return {}
+        ts = int(time.time()) - 3600 * (kind == 'expired')
+        request_id = uuid.uuid4().hex
+        if kind == 'forged':
+            signature = uuid.uuid4().hex * 2
+        else:
+            # Signed with the real secret even when verification is off
+            signature = notifications.sign(payment_id, request_id, ts, self.secret)
+        return {'x-request-id': request_id, 'x-signature': f'ts={ts},v1={signature}'}
+
+    def report(self, results):
+        self.stdout.write(f'{"kind":<10}{"requests":>10}{"shed":>8}{"us/req":>10}'
+                          f'{"queries":>10}{"api calls":>11}')
+        for kind, result in results.items():
+            if not result['requests']:
+                continue
+            self.stdout.write(f'{kind:<10}{result["requests"]:>10}{result["shed"]:>8}'
+                              f'{result["seconds"] / result["requests"] * 1e6:>10.1f}'
+                              f'{result["queries"]:>10}{result["api_calls"]:>11}')
+        total = sum(result['requests'] for result in results.values())
+        shed = sum(result['shed'] for result in results.values())
+        calls = sum(result['api_calls'] for result in results.values())
+        self.stdout.write(f'Shed {shed} of {total} requests ({shed / total:.1%}), '
+                          f'{calls} API calls')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from shop.fake_mercadopago import FakeMercadoPago
+
+
+class Command(BaseCommand):
+    help = 'Runs a local fake of the MercadoPago API for development and benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds to wait before every answer.')
+
+    def handle(self, *args, **options):
+        server = FakeMercadoPago(port=options['port'], latency=options['latency'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Fake MercadoPago listening on {server.url}; set MERCADOPAGO_API_URL to it.'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server.server_close()
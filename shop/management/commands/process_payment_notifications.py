@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from shop import notifications
+
+
+class Command(BaseCommand):
+    help = 'Processes the queued MercadoPago webhook notifications.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            # Stops once a batch settles nothing; failed notifications wait
+            # for their next attempt
+            processed = notifications.process_pending(options['batch_size'])
+            if not processed:
+                break
+            total += processed
+        self.stdout.write(self.style.SUCCESS(f'Processed {total} notifications.'))
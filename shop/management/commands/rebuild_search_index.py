@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from shop import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text and trigram search indexes for all products.'
+
+    def handle(self, *args, **options):
+        if not search.fts_enabled() and not search.create_index():
+            self.stdout.write(self.style.WARNING(
+                'FTS5 is not available on this database; exact searches use icontains.'))
+        total = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} products.'))
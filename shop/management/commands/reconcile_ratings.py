@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from shop import ratings
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the review counters and average rating of every product.'
+
+    def handle(self, *args, **options):
+        fixed = ratings.reconcile()
+        self.stdout.write(self.style.SUCCESS(f'Reconciled ratings; {fixed} products were out of date.'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from shop import inventory
+
+
+class Command(BaseCommand):
+    help = 'Gives back the stock reserved by unpaid orders whose reservation expired.'
+
+    def handle(self, *args, **options):
+        released = inventory.release_expired()
+        self.stdout.write(self.style.SUCCESS(f'Released the stock of {released} expired orders.'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from shop import payments
+
+
+class Command(BaseCommand):
+    help = 'Creates the MercadoPago preferences of orders whose background creation was lost.'
+
+    def handle(self, *args, **options):
+        retried = payments.retry_stale()
+        self.stdout.write(self.style.SUCCESS(f'Retried the preference of {retried} orders.'))
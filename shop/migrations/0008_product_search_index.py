@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from shop import search
+    if not search.create_index(schema_editor):
+        return
+    Product = apps.get_model('shop', 'Product')
+    rows = Product.objects.values_list('id', 'name', 'description', 'category__name')
+    with schema_editor.connection.cursor() as cursor:
+        search._insert_many(cursor, list(rows))
+
+
+def drop_search_index(apps, schema_editor):
+    from shop import search
+    search.drop_index(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_order_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
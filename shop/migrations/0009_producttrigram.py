@@ -0,0 +1,38 @@
+# Generated by Django 4.2.26 on 2026-10-18 14:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_trigrams(apps, schema_editor):
+    from shop.search import trigrams
+    Product = apps.get_model('shop', 'Product')
+    ProductTrigram = apps.get_model('shop', 'ProductTrigram')
+    rows = Product.objects.values_list('id', 'name', 'category__name')
+    ProductTrigram.objects.bulk_create(
+        [ProductTrigram(product_id=product_id, trigram=gram)
+         for product_id, name, category_name in rows
+         for gram in trigrams(f'{name} {category_name}')],
+        batch_size=1000
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='shop.product')),
+            ],
+            options={
+                'unique_together': {('trigram', 'product')},
+            },
+        ),
+        migrations.RunPython(populate_trigrams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.26 on 2026-10-18 14:53
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def populate_counters(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    Review = apps.get_model('shop', 'Review')
+    stats = (Review.objects.order_by().values('product_id')
+             .annotate(total=Sum('rating'),
+                       **{f'rating_{n}': Count('id', filter=Q(rating=n)) for n in range(1, 6)}))
+    for row in stats:
+        product_id = row.pop('product_id')
+        Product.objects.filter(id=product_id).update(rating_sum=row.pop('total'), **row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_conditional_get_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.26 on 2026-10-18 14:55
+
+from django.db import migrations, models
+
+
+def populate_weighted_rating(apps, schema_editor):
+    from shop.ratings import weighted
+    Product = apps.get_model('shop', 'Product')
+    products = list(Product.objects.filter(total_reviews__gt=0))
+    for product in products:
+        product.weighted_rating = weighted(product.rating_sum, product.total_reviews)
+    Product.objects.bulk_update(products, ['weighted_rating'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_product_rating_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='weighted_rating',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=5),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-weighted_rating', 'id'], name='shop_produc_weighte_797b03_idx'),
+        ),
+        migrations.RunPython(populate_weighted_rating, migrations.RunPython.noop),
+    ]
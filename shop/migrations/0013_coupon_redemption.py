@@ -0,0 +1,43 @@
+# Generated by Django 4.2.26 on 2026-10-18 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_code_normalized(apps, schema_editor):
+    Coupon = apps.get_model('shop', 'Coupon')
+    for coupon in Coupon.objects.all():
+        coupon.code_normalized = coupon.code.strip().upper()
+        coupon.save(update_fields=['code_normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_product_weighted_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='code_normalized',
+            field=models.CharField(default='', editable=False, max_length=50),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_code_normalized, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code_normalized',
+            field=models.CharField(editable=False, max_length=50, unique=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='coupon',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='shop.coupon'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+    ]
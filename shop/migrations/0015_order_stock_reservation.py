@@ -0,0 +1,34 @@
+# Generated by Django 4.2.26 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+def mark_paid_orders_committed(apps, schema_editor):
+    # Paid orders already had their stock taken by the old payment views
+    Order = apps.get_model('shop', 'Order')
+    Order.objects.filter(paid=True).update(stock_status='committed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_coupon_redemption_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='stock_status',
+            field=models.CharField(choices=[('none', 'Not reserved'), ('reserved', 'Reserved'), ('committed', 'Committed'), ('released', 'Released')], default='none', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['stock_status', 'reserved_until'], name='shop_order_stock_s_d77067_idx'),
+        ),
+        migrations.RunPython(mark_paid_orders_committed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.26 on 2026-10-18 19:15
+
+from django.db import migrations, models
+
+
+def set_existing_preference_status(apps, schema_editor):
+    # Older orders created their preference during checkout
+    Order = apps.get_model('shop', 'Order')
+    Order.objects.exclude(preference_id='').update(preference_status='ready')
+    Order.objects.filter(preference_id='').update(preference_status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='preference_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.RunPython(set_existing_preference_status, migrations.RunPython.noop),
+    ]
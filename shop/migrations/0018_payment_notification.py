@@ -0,0 +1,37 @@
+# Generated by Django 4.2.26 on 2026-10-18 15:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_order_preference_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=20)),
+                ('resource_id', models.CharField(max_length=64)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claim', models.CharField(blank=True, max_length=32)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notifications', to='shop.order')),
+            ],
+            options={
+                'ordering': ['received'],
+                'indexes': [models.Index(fields=['status', 'received'], name='shop_paymen_status_e8df32_idx'), models.Index(fields=['claim'], name='shop_paymen_claim_ed45fb_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='paymentnotification',
+            constraint=models.UniqueConstraint(fields=('topic', 'resource_id'), name='unique_payment_notification'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.26 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0018_payment_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentnotification',
+            name='claimed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='paymentnotification',
+            name='dirty',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -6,6 +6,7 @@ from django.core.validators import MinValueValidator, MaxValueValidator
 class Category(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True)
+    updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['name']
@@ -35,6 +36,15 @@ class Product(models.Model):
     stock = models.PositiveIntegerField(default=0)
     average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.00)
     total_reviews = models.PositiveIntegerField(default=0)
+    # Running review statistics, maintained by shop.ratings
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    # Bayesian average used to sort by best rated; 0 until the first review
+    weighted_rating = models.DecimalField(max_digits=5, decimal_places=4, default=0)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -44,6 +54,8 @@ class Product(models.Model):
             models.Index(fields=['id', 'slug']),
             models.Index(fields=['name']),
             models.Index(fields=['-created']),
+            models.Index(fields=['updated']),
+            models.Index(fields=['-weighted_rating', 'id']),
         ]
 
     def __str__(self):
@@ -52,6 +64,30 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('shop:product_detail', args=[self.id, self.slug])
 
+    def rating_distribution(self):
+        """
+        Number and share of reviews for each star, from 5 down to 1.
+        """
+        distribution = []
+        for stars in (5, 4, 3, 2, 1):
+            count = getattr(self, f'rating_{stars}')
+            percent = round(100 * count / self.total_reviews) if self.total_reviews else 0
+            distribution.append({'stars': stars, 'count': count, 'percent': percent})
+        return distribution
+
+
+class ProductTrigram(models.Model):
+    product = models.ForeignKey(Product,
+                                related_name='trigrams',
+                                on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        unique_together = ('trigram', 'product')
+
+    def __str__(self):
+        return self.trigram
+
 
 class Review(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
@@ -63,6 +99,9 @@ class Review(models.Model):
     class Meta:
         ordering = ['-created_at']
         unique_together = ('product', 'user') # One review per user per product
+        indexes = [
+            models.Index(fields=['product', '-created_at']),
+        ]
 
     def __str__(self):
         return f'Review by {self.user.username} for {self.product.name}'
@@ -85,6 +124,30 @@ class Order(models.Model):
         (STATUS_CANCELLED, 'Cancelled'),
     ]
 
+    # What happened to the stock of the order lines, see shop.inventory
+    STOCK_NONE = 'none'
+    STOCK_RESERVED = 'reserved'
+    STOCK_COMMITTED = 'committed'
+    STOCK_RELEASED = 'released'
+
+    STOCK_STATUS_CHOICES = [
+        (STOCK_NONE, 'Not reserved'),
+        (STOCK_RESERVED, 'Reserved'),
+        (STOCK_COMMITTED, 'Committed'),
+        (STOCK_RELEASED, 'Released'),
+    ]
+
+    # MercadoPago checkout preference, see shop.payments
+    PREFERENCE_PENDING = 'pending'
+    PREFERENCE_READY = 'ready'
+    PREFERENCE_FAILED = 'failed'
+
+    PREFERENCE_STATUS_CHOICES = [
+        (PREFERENCE_PENDING, 'Pending'),
+        (PREFERENCE_READY, 'Ready'),
+        (PREFERENCE_FAILED, 'Failed'),
+    ]
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.SET_NULL,
                              null=True, blank=True,
@@ -99,18 +162,34 @@ class Order(models.Model):
     updated = models.DateTimeField(auto_now=True)
     paid = models.BooleanField(default=False)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    coupon = models.ForeignKey('Coupon',
+                               on_delete=models.SET_NULL,
+                               null=True, blank=True,
+                               related_name='orders')
+    discount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    stock_status = models.CharField(max_length=10, choices=STOCK_STATUS_CHOICES,
+                                    default=STOCK_NONE)
+    reserved_until = models.DateTimeField(null=True, blank=True)
+    # Issued with the checkout form, so a resubmitted form finds this order
+    idempotency_key = models.CharField(max_length=64, unique=True,
+                                       null=True, blank=True, editable=False)
+    preference_status = models.CharField(max_length=10, choices=PREFERENCE_STATUS_CHOICES,
+                                         default=PREFERENCE_PENDING)
+    preference_id = models.CharField(max_length=100, blank=True)
+    init_point = models.URLField(max_length=500, blank=True)
 
     class Meta:
         ordering = ['-created']
         indexes = [
             models.Index(fields=['-created']),
+            models.Index(fields=['stock_status', 'reserved_until']),
         ]
 
     def __str__(self):
         return f'Order {self.id}'
 
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        return sum(item.get_cost() for item in self.items.all()) - self.discount
 
 
 class OrderItem(models.Model):
@@ -132,12 +211,15 @@ class OrderItem(models.Model):
 
 class Coupon(models.Model):
     code = models.CharField(max_length=50, unique=True)
+    # Upper case copy of `code`, so lookups can use an index
+    code_normalized = models.CharField(max_length=50, unique=True, editable=False)
     discount_percent = models.IntegerField(validators=[MinValueValidator(0), MaxValueValidator(100)])
     valid_from = models.DateTimeField()
     valid_to = models.DateTimeField()
     active = models.BooleanField(default=True)
     usage_limit = models.PositiveIntegerField(default=1)
     used_count = models.PositiveIntegerField(default=0)
+    once_per_customer = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['-valid_from']
@@ -145,9 +227,94 @@ class Coupon(models.Model):
     def __str__(self):
         return f'{self.code} ({self.discount_percent}% off)'
 
+    @staticmethod
+    def normalize_code(code):
+        return (code or '').strip().upper()
+
+    def save(self, *args, **kwargs):
+        self.code_normalized = self.normalize_code(self.code)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'code' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'code_normalized'}
+        super().save(*args, **kwargs)
+
     def is_valid(self):
         from django.utils import timezone
         now = timezone.now()
         return (self.active and
                 self.valid_from <= now <= self.valid_to and
                 self.used_count < self.usage_limit)
+
+
+class CouponRedemption(models.Model):
+    """
+    One use of a coupon, recorded when the order is placed.
+    """
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='redemptions')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.SET_NULL,
+                             null=True, blank=True,
+                             related_name='coupon_redemptions')
+    # Lower case, so that guest checkouts can be matched exactly
+    email = models.EmailField()
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='coupon_redemption')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['coupon', 'user']),
+            models.Index(fields=['coupon', 'email']),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon.code} used in order {self.order_id}'
+
+
+class PaymentNotification(models.Model):
+    """
+    A MercadoPago webhook notification, stored once per resource and
+    processed in the background by shop.notifications.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    topic = models.CharField(max_length=20)
+    resource_id = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Marks the rows picked by one processing run
+    claim = models.CharField(max_length=32, blank=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    # A failed notification is not retried before this time
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    # Notified again while being processed; queued again afterwards
+    dirty = models.BooleanField(default=False)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name='notifications')
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['received']
+        constraints = [
+            models.UniqueConstraint(fields=['topic', 'resource_id'],
+                                    name='unique_payment_notification'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received']),
+            models.Index(fields=['claim']),
+        ]
+
+    def __str__(self):
+        return f'{self.topic} {self.resource_id}'
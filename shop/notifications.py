@@ -0,0 +1,314 @@
+"""
+Ingestion and processing of MercadoPago webhook notifications. IPN
+notifications are unsigned and no longer queued, see views.mercadopago_ipn.
+
+The webhook view only calls `ingest()`, which stores the notification and
+returns so MercadoPago gets its 200 at once. PaymentNotification keeps one
+row per (topic, resource_id):
+
+- a notification for a resource whose row is still pending is a repeat
+  and needs nothing; repeats seen by this process are dropped by an
+  in-memory LRU without a query. The LRU is emptied whenever any process
+  claims rows, so it never hides a notification that arrived after the
+  resource was fetched.
+- a row that is done or failed is queued again: MercadoPago notifies the
+  same payment when it is created and again when it is approved.
+- a row that is being processed is marked dirty and queued again once the
+  run ends, since its fetch may predate the change.
+
+`process_pending()` runs in the background (see shop.tasks) and from the
+process_payment_notifications command. It handles merchant orders first:
+their answer lists the order's payments, so payment notifications for
+those payments are settled without fetching each payment. Rows claimed
+by a worker that never finished are claimed again after
+MERCADOPAGO_NOTIFICATION_CLAIM_TIMEOUT seconds. A notification that failed
+waits before its next attempt, longer after every failure, so an outage
+does not use up its attempts; while the circuit breaker keeps the API
+from being called no attempt is counted at all.
+
+Webhooks are signed by MercadoPago; `verify()` checks the signature before
+anything else is done with the request, see there.
+"""
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import caching, inventory, tasks
+from .gateway import GatewayUnavailable, get_gateway
+from .models import Order, PaymentNotification
+
+TOPICS = ('payment', 'merchant_order')
+
+# Version bumped every time rows are claimed for processing
+CLAIMS = 'payment-notification-claims'
+
+
+class RecentKeys:
+    """
+    Thread-safe LRU of recently seen keys that forgets them after
+    `window` seconds, or all at once when the generation passed to `add()`
+    changes.
+    """
+
+    def __init__(self, size, window):
+        self.size = size
+        self.window = window
+        self.generation = None
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, generation=None):
+        """
+        Remember the key; returns False if it was already seen recently.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if generation != self.generation:
+                self._keys.clear()
+                self.generation = generation
+            seen = self._keys.get(key)
+            if seen is not None and now - seen < self.window:
+                return False
+            self._keys[key] = now
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self.generation = None
+
+
+recent = RecentKeys(settings.MERCADOPAGO_NOTIFICATION_CACHE_SIZE,
+                    settings.MERCADOPAGO_NOTIFICATION_WINDOW)
+
+
+def parse(request):
+    """
+    Return (topic, resource_id, payload) for a webhook or IPN request, or
+    None if it does not name a resource. Both the query string styles
+    (?topic=&id=, ?type=&data.id=) and JSON bodies are understood.
+    """
+    body = {}
+    if request.body:
+        try:
+            body = json.loads(request.body)
+        except ValueError:
+            body = {}
+    if not isinstance(body, dict):
+        body = {}
+    params = request.GET
+    topic = (params.get('topic') or params.get('type') or
+             body.get('type') or body.get('topic'))
+    resource_id = (params.get('id') or params.get('data.id') or
+                   (body.get('data') or {}).get('id'))
+    if request.method == 'POST' and not body:
+        topic = topic or request.POST.get('topic')
+        resource_id = resource_id or request.POST.get('id')
+    if topic not in TOPICS or not resource_id:
+        return None
+    return topic, str(resource_id)[:64], {'query': params.dict(), 'body': body}
+
+
+def sign(resource_id, request_id, ts, secret=None):
+    """
+    The v1 signature MercadoPago sends for a webhook: an HMAC-SHA256 of the
+    resource id, the x-request-id header and the timestamp.
+    """
+    manifest = ''
+    if resource_id:
+        manifest += f'id:{str(resource_id).lower()};'
+    if request_id:
+        manifest += f'request-id:{request_id};'
+    manifest += f'ts:{ts};'
+    secret = settings.MERCADOPAGO_WEBHOOK_SECRET if secret is None else secret
+    return hmac.new(secret.encode(), manifest.encode(), hashlib.sha256).hexdigest()
+
+
+def verify(request):
+    """
+    Check the x-signature header of a webhook request. Returns None if the
+    request is genuine, otherwise why it was rejected: 'missing',
+    'expired', 'invalid' or 'replayed'.
+
+    Only the request itself is looked at, plus one cache write for a valid
+    signature, so forged and flooding requests cost no database query or
+    API call. A signature is accepted once, and only within
+    MERCADOPAGO_SIGNATURE_TOLERANCE seconds of its timestamp. Verification
+    is off while MERCADOPAGO_WEBHOOK_SECRET is empty.
+    """
+    if not settings.MERCADOPAGO_WEBHOOK_SECRET:
+        return None
+    parts = dict(part.strip().split('=', 1)
+                 for part in request.headers.get('x-signature', '').split(',')
+                 if '=' in part)
+    ts, signature = parts.get('ts', ''), parts.get('v1', '')
+    if not ts.isdigit() or not signature:
+        return 'missing'
+    # Sent in seconds or milliseconds
+    sent = int(ts) / 1000 if len(ts) > 11 else int(ts)
+    tolerance = settings.MERCADOPAGO_SIGNATURE_TOLERANCE
+    if abs(time.time() - sent) > tolerance:
+        return 'expired'
+    parsed = parse(request)
+    expected = sign(parsed[1] if parsed else None, request.headers.get('x-request-id'), ts)
+    if not hmac.compare_digest(expected, signature):
+        return 'invalid'
+    if not cache.add(f'mercadopago:signature:{signature}', True, 2 * tolerance):
+        return 'replayed'
+    return None
+
+
+def ingest(request):
+    """
+    Queue the notification in the request for processing. Returns the
+    (topic, resource_id) queued, or None for repeats and requests that are
+    not notifications.
+    """
+    parsed = parse(request)
+    if parsed is None:
+        return None
+    topic, resource_id, payload = parsed
+    if not recent.add((topic, resource_id), caching.get_versions(CLAIMS)[0]):
+        return None
+    rows = PaymentNotification.objects.filter(topic=topic, resource_id=resource_id)
+    if rows.filter(status=PaymentNotification.STATUS_PROCESSING).update(dirty=True,
+                                                                        payload=payload):
+        return topic, resource_id
+    reopened = (rows.filter(status__in=[PaymentNotification.STATUS_DONE,
+                                        PaymentNotification.STATUS_FAILED])
+                .update(status=PaymentNotification.STATUS_PENDING, attempts=0,
+                        payload=payload, processed=None, next_attempt=None))
+    if not reopened:
+        PaymentNotification.objects.bulk_create(
+            [PaymentNotification(topic=topic, resource_id=resource_id, payload=payload)],
+            ignore_conflicts=True)
+    tasks.submit(process_pending)
+    return topic, resource_id
+
+
+def _mark_paid(external_reference):
+    """
+    Mark the order paid and keep its stock. Returns the order id, or None if
+    there is no such order.
+    """
+    try:
+        order_id = int(external_reference)
+    except (TypeError, ValueError):
+        return None
+    if Order.objects.filter(pk=order_id, paid=False).update(
+            paid=True, status=Order.STATUS_PAID, updated=timezone.now()):
+        inventory.commit(Order(pk=order_id))
+        return order_id
+    return order_id if Order.objects.filter(pk=order_id).exists() else None
+
+
+def _settle_payment(payment):
+    if payment.get('status') == 'approved' and payment.get('external_reference'):
+        return _mark_paid(payment['external_reference'])
+    return None
+
+
+def _settle_merchant_order(merchant_order, known_payments):
+    reference = merchant_order.get('external_reference')
+    order_payments = merchant_order.get('payments') or []
+    for payment in order_payments:
+        known_payments[str(payment.get('id'))] = dict(payment, external_reference=reference)
+    paid_amount = sum(p['transaction_amount'] for p in order_payments if p['status'] == 'approved')
+    if reference and paid_amount >= merchant_order.get('total_amount', 0):
+        return _mark_paid(reference)
+    return None
+
+
+def _process(notification, gateway, known_payments):
+    if notification.topic == 'payment' and notification.resource_id in known_payments:
+        # Already listed by a merchant order of this batch
+        return _settle_payment(known_payments[notification.resource_id])
+    if notification.topic == 'merchant_order':
+        response = gateway.get_merchant_order(notification.resource_id)
+        settle = lambda data: _settle_merchant_order(data, known_payments)
+    else:
+        response = gateway.get_payment(notification.resource_id)
+        settle = _settle_payment
+    if response.get('status') == 200:
+        return settle(response['response'])
+    if response.get('status', 500) >= 500:
+        raise RuntimeError(f'MercadoPago answered {response.get("status")}')
+    return None
+
+
+def _retry_delay(attempts):
+    return timedelta(seconds=settings.MERCADOPAGO_NOTIFICATION_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def process_pending(limit=100):
+    """
+    Process up to `limit` queued notifications. Returns how many were
+    settled; failed ones are retried by later runs, after a growing delay,
+    up to MERCADOPAGO_NOTIFICATION_ATTEMPTS times.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.MERCADOPAGO_NOTIFICATION_CLAIM_TIMEOUT)
+    claimable = ((Q(status=PaymentNotification.STATUS_PENDING) &
+                  (Q(next_attempt__isnull=True) | Q(next_attempt__lte=now))) |
+                 Q(status=PaymentNotification.STATUS_PROCESSING, claimed__lt=stale))
+    ids = list(PaymentNotification.objects.filter(claimable)
+               .values_list('id', flat=True)[:limit])
+    if not ids:
+        return 0
+    claim = uuid.uuid4().hex
+    PaymentNotification.objects.filter(claimable, pk__in=ids).update(
+        status=PaymentNotification.STATUS_PROCESSING, claim=claim, claimed=now,
+        dirty=False, attempts=F('attempts') + 1)
+    # Before fetching anything, so no process keeps dropping notifications
+    # for these resources as repeats
+    caching.bump_now(CLAIMS)
+    batch = list(PaymentNotification.objects.filter(claim=claim))
+
+    gateway = get_gateway()
+    known_payments = {}
+    settled = 0
+    for notification in sorted(batch, key=lambda n: n.topic != 'merchant_order'):
+        try:
+            notification.order_id = _process(notification, gateway, known_payments)
+            notification.status = PaymentNotification.STATUS_DONE
+            notification.processed = timezone.now()
+            notification.next_attempt = None
+            settled += 1
+        except Exception as e:
+            print(f"Notification {notification} failed: {e}")
+            if isinstance(e, GatewayUnavailable):
+                # The API was not called: wait for the breaker to close
+                notification.attempts -= 1
+                notification.next_attempt = now + timedelta(
+                    seconds=settings.MERCADOPAGO_BREAKER_RESET)
+                notification.status = PaymentNotification.STATUS_PENDING
+            elif notification.attempts >= settings.MERCADOPAGO_NOTIFICATION_ATTEMPTS:
+                notification.status = PaymentNotification.STATUS_FAILED
+            else:
+                notification.next_attempt = now + _retry_delay(notification.attempts)
+                notification.status = PaymentNotification.STATUS_PENDING
+        notification.claim = ''
+    # Rows claimed again by another worker meanwhile are left to it
+    PaymentNotification.objects.filter(claim=claim).bulk_update(
+        batch, ['status', 'order', 'processed', 'claim', 'attempts', 'next_attempt'])
+    requeued = (PaymentNotification.objects
+                .filter(pk__in=[notification.pk for notification in batch], dirty=True)
+                .exclude(status=PaymentNotification.STATUS_PROCESSING)
+                .update(status=PaymentNotification.STATUS_PENDING, dirty=False,
+                        attempts=0, processed=None, next_attempt=None))
+    if requeued:
+        tasks.submit(process_pending)
+    return settled
@@ -0,0 +1,123 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(direction, values):
+    data = json.dumps({'d': direction, 'k': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction, values = data['d'], data['k']
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise InvalidCursor(token)
+    if direction not in ('n', 'p') or not isinstance(values, list):
+        raise InvalidCursor(token)
+    return direction, values
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator:
+    """
+    Cursor-based paginator. Pages are located with a WHERE clause on the
+    ordering columns instead of OFFSET, so every page costs the same
+    indexed range scan no matter how deep it is.
+    """
+
+    def __init__(self, queryset, per_page, ordering=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        ordering = list(ordering or queryset.query.order_by or
+                        queryset.model._meta.ordering)
+        if not any(f.lstrip('-') in ('id', 'pk') for f in ordering):
+            ordering.append('id')
+        self.ordering = ordering
+
+    def _keys(self, obj):
+        values = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            if isinstance(value, Decimal):
+                value = str(value)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            values.append(value)
+        return values
+
+    def _after(self, values, reverse=False):
+        """
+        Build the condition selecting rows strictly after `values` in the
+        ordering (or before them, when reverse is True).
+        """
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            lookup = f'{name}__lt' if descending else f'{name}__gt'
+            term = Q(**{lookup: values[i]})
+            for previous, value in zip(self.ordering[:i], values[:i]):
+                term &= Q(**{previous.lstrip('-'): value})
+            condition |= term
+        return condition
+
+    def _reversed_ordering(self):
+        return [f[1:] if f.startswith('-') else f'-{f}' for f in self.ordering]
+
+    def page(self, cursor=None):
+        direction, values = 'n', None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(self.ordering):
+                raise InvalidCursor(cursor)
+
+        queryset = self.queryset
+        if direction == 'n':
+            if values is not None:
+                queryset = queryset.filter(self._after(values))
+            rows = list(queryset.order_by(*self.ordering)[:self.per_page + 1])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_next, has_previous = has_more, values is not None
+        else:
+            queryset = queryset.filter(self._after(values, reverse=True))
+            rows = list(queryset.order_by(*self._reversed_ordering())[:self.per_page + 1])
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next, has_previous = True, has_more
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = encode_cursor('n', self._keys(rows[-1]))
+        if rows and has_previous:
+            previous_cursor = encode_cursor('p', self._keys(rows[0]))
+        return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,107 @@
+"""
+MercadoPago checkout preferences, created off the request path.
+
+Placing an order only schedules the preference: a background task (see
+shop.tasks) calls the API and stores the preference on the order, and the
+payment page polls `payment_status` until it is ready. With
+MERCADOPAGO_WORKERS = 0 the preference is created inline instead, which is
+what the tests use. The API is called through shop.gateway.
+
+A preference whose background task was lost, e.g. because the process
+restarted, is created by `retry_stale()`, which the
+retry_payment_preferences command runs.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import tasks
+from .gateway import get_gateway
+from .models import Order
+
+BASE_URL = 'https://dev.yokotoka.is'
+
+
+def preference_data(order, order_items):
+    """
+    Build the preference for an order from its saved items, which must
+    have their products loaded.
+    """
+    items = []
+    for item in order_items:
+        price = item.price
+        if order.coupon:
+            price = price * (100 - order.coupon.discount_percent) / 100
+        items.append({
+            "title": item.product.name,
+            "quantity": item.quantity,
+            "unit_price": float(round(price, 2)),
+        })
+    return {
+        "items": items,
+        "back_urls": {
+            "success": f"{BASE_URL}/payment-success/{order.id}/",
+            "failure": f"{BASE_URL}/payment-failure/{order.id}/",
+            "pending": f"{BASE_URL}/payment-pending/{order.id}/"
+        },
+        "auto_return": "approved",
+        "notification_url": f"{BASE_URL}/webhook/",
+        "external_reference": str(order.id),
+    }
+
+
+def create_preference(order, data):
+    """
+    Create the preference and store its id and init point on the order.
+    """
+    try:
+        response = get_gateway().create_preference(data)
+    except Exception as e:
+        response = {'status': None, 'error': str(e)}
+    if response.get('status') == 201:
+        preference = response.get('response', {})
+        order.preference_id = preference.get('id') or ''
+        order.init_point = preference.get('sandbox_init_point') or ''
+        order.preference_status = Order.PREFERENCE_READY
+    else:
+        print(f"MercadoPago API Error: {response}")
+        order.preference_status = Order.PREFERENCE_FAILED
+    Order.objects.filter(pk=order.pk).update(preference_id=order.preference_id,
+                                             init_point=order.init_point,
+                                             preference_status=order.preference_status)
+
+
+def _create_preference(order_id, data):
+    create_preference(Order(pk=order_id), data)
+
+
+def schedule_preference(order, data):
+    """
+    Create the order's preference in the background once the current
+    transaction commits, or right away when there are no workers.
+    """
+    if not settings.MERCADOPAGO_WORKERS:
+        create_preference(order, data)
+        return
+    tasks.submit(_create_preference, order.pk, data)
+
+
+def retry_stale(now=None):
+    """
+    Create the preferences of unpaid orders still pending after
+    MERCADOPAGO_PREFERENCE_TIMEOUT seconds. Returns how many were retried.
+    """
+    now = now or timezone.now()
+    stale = Order.objects.filter(
+        preference_status=Order.PREFERENCE_PENDING, paid=False,
+        updated__lt=now - timedelta(seconds=settings.MERCADOPAGO_PREFERENCE_TIMEOUT))
+    retried = 0
+    for order in stale.select_related('coupon'):
+        # Claim the order, so a concurrent run skips it
+        if not Order.objects.filter(pk=order.pk, preference_status=Order.PREFERENCE_PENDING,
+                                    updated=order.updated).update(updated=now):
+            continue
+        create_preference(order, preference_data(order, order.items.select_related('product')))
+        retried += 1
+    return retried
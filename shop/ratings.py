@@ -0,0 +1,119 @@
+"""
+Incremental review statistics for products.
+
+Every Product keeps the number of reviews, the sum of their ratings and a
+1-5 star histogram. A review change is applied as a single UPDATE of those
+columns with F() expressions, so it never reads the other reviews and never
+overwrites unrelated fields such as stock or price. `reconcile()` rebuilds
+all the counters from the Review table in case they ever drift.
+
+The weighted rating pulls products with few reviews towards
+RATING_PRIOR_MEAN, so a single 5-star review does not outrank hundreds of
+4-star ones when sorting by best rated.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.db.models import Case, Count, DecimalField, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast, Now, Round
+from django.utils import timezone
+
+from . import caching
+from .models import Product, Review
+
+STARS = (1, 2, 3, 4, 5)
+
+COUNTER_FIELDS = ['total_reviews', 'rating_sum'] + [f'rating_{n}' for n in STARS]
+
+RATING_FIELDS = ['average_rating', 'weighted_rating'] + COUNTER_FIELDS
+
+
+def average(rating_sum, count):
+    if not count:
+        return Decimal('0.00')
+    return (Decimal(rating_sum) / count).quantize(Decimal('0.01'), ROUND_HALF_UP)
+
+
+def weighted(rating_sum, count):
+    if not count:
+        return Decimal('0.0000')
+    prior = settings.RATING_PRIOR_WEIGHT
+    score = (Decimal(settings.RATING_PRIOR_MEAN * prior + rating_sum) /
+             (prior + count))
+    return score.quantize(Decimal('0.0001'), ROUND_HALF_UP)
+
+
+def record(product_id, added=None, removed=None):
+    """
+    Apply a review change to the product counters: `added` is the rating of
+    a new (or edited) review and `removed` the rating it replaced or that
+    was deleted.
+    """
+    if added == removed:
+        return
+    delta_count = (added is not None) - (removed is not None)
+    delta_sum = (added or 0) - (removed or 0)
+    count = F('total_reviews') + delta_count
+    rating_sum = F('rating_sum') + delta_sum
+    prior = settings.RATING_PRIOR_WEIGHT
+    prior_sum = settings.RATING_PRIOR_MEAN * prior
+    changes = {
+        'total_reviews': count,
+        'rating_sum': rating_sum,
+        # Expressions in an UPDATE see the old row, so the new average is
+        # computed from the same deltas. Rounded in SQL, as SQLite's CAST
+        # does not round: the stored value must equal the one read back,
+        # which pagination cursors and rating filters compare against.
+        'average_rating': Case(
+            When(total_reviews__gt=-delta_count,
+                 then=Round(Cast(Cast(rating_sum, FloatField()) / count,
+                                 DecimalField(max_digits=3, decimal_places=2)), 2)),
+            default=Value(Decimal('0.00')),
+            output_field=DecimalField(max_digits=3, decimal_places=2)),
+        'weighted_rating': Case(
+            When(total_reviews__gt=-delta_count,
+                 then=Round(Cast((Cast(rating_sum, FloatField()) + prior_sum) /
+                                 (Cast(count, FloatField()) + prior),
+                                 DecimalField(max_digits=5, decimal_places=4)), 4)),
+            default=Value(Decimal('0.0000')),
+            output_field=DecimalField(max_digits=5, decimal_places=4)),
+        'updated': Now(),
+    }
+    if added is not None:
+        changes[f'rating_{added}'] = F(f'rating_{added}') + 1
+    if removed is not None:
+        changes[f'rating_{removed}'] = F(f'rating_{removed}') - 1
+    Product.objects.filter(pk=product_id).update(**changes)
+    caching.refresh_products(Product.objects.filter(pk=product_id))
+
+
+def reconcile(batch_size=500):
+    """
+    Recompute the counters of every product from its reviews with one
+    grouped query. Returns the number of products that were out of date.
+    """
+    stats = {
+        row['product_id']: row for row in
+        Review.objects.order_by().values('product_id').annotate(
+            total_reviews=Count('id'),
+            rating_sum=Sum('rating'),
+            **{f'rating_{n}': Count('id', filter=Q(rating=n)) for n in STARS})
+    }
+    empty = dict.fromkeys(COUNTER_FIELDS, 0)
+    now = timezone.now()
+    stale = []
+    for product in Product.objects.only(*RATING_FIELDS).iterator():
+        row = stats.get(product.id, empty)
+        values = {field: row[field] for field in COUNTER_FIELDS}
+        values['average_rating'] = average(row['rating_sum'], row['total_reviews'])
+        values['weighted_rating'] = weighted(row['rating_sum'], row['total_reviews'])
+        if any(getattr(product, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(product, field, value)
+            product.updated = now
+            stale.append(product)
+    Product.objects.bulk_update(stale, ['updated'] + RATING_FIELDS,
+                                batch_size=batch_size)
+    if stale:
+        caching.refresh_products(Product.objects.filter(pk__in=[product.id for product in stale]))
+    return len(stale)
@@ -0,0 +1,329 @@
+import math
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+from . import facets
+from .models import Product, ProductTrigram
+
+FTS_TABLE = 'shop_product_fts'
+
+# Column weights for bm25(): name, description, category
+FTS_WEIGHTS = (10.0, 1.0, 4.0)
+
+_fts_enabled = None
+
+
+def normalize(text):
+    """
+    Fold accents and case and collapse punctuation, so that
+    'Salsa "Seúl Nocturno"' becomes 'salsa seul nocturno'.
+    """
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'\w+', stripped.casefold()))
+
+
+def trigrams(text):
+    """
+    Return the set of trigrams of the normalized text. Every word is padded
+    with two leading spaces and one trailing space, like pg_trgm does.
+    """
+    grams = set()
+    for word in normalize(text).split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def fts_enabled():
+    """
+    Return True when the FTS5 index table is available on this database.
+    """
+    global _fts_enabled
+    if _fts_enabled is None:
+        _fts_enabled = (connection.vendor == 'sqlite' and
+                        FTS_TABLE in connection.introspection.table_names())
+    return _fts_enabled
+
+
+def create_index(schema_editor=None):
+    """
+    Create the FTS5 virtual table. Returns False when FTS5 is not supported.
+    """
+    global _fts_enabled
+    conn = schema_editor.connection if schema_editor else connection
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+                'USING fts5(name, description, category, '
+                'tokenize="unicode61 remove_diacritics 2")'
+            )
+        except Exception:
+            return False
+    _fts_enabled = None
+    return True
+
+
+def drop_index(schema_editor=None):
+    global _fts_enabled
+    conn = schema_editor.connection if schema_editor else connection
+    if conn.vendor == 'sqlite':
+        with conn.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    _fts_enabled = None
+
+
+def _trigram_rows(product_id, name, category_name):
+    return [ProductTrigram(product_id=product_id, trigram=gram)
+            for gram in trigrams(f'{name} {category_name}')]
+
+
+def _index_rows(rows):
+    """
+    (Re)index (id, name, description, category name) rows in both the
+    FTS table and the trigram table.
+    """
+    ids = [row[0] for row in rows]
+    ProductTrigram.objects.filter(product_id__in=ids).delete()
+    ProductTrigram.objects.bulk_create(
+        [trigram for product_id, name, _, category_name in rows
+         for trigram in _trigram_rows(product_id, name, category_name)],
+        ignore_conflicts=True
+    )
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+                               [[product_id] for product_id in ids])
+            _insert_many(cursor, rows)
+
+
+def index_product(product):
+    """
+    Add or refresh a single product in the search index.
+    """
+    _index_rows([(product.id, product.name, product.description,
+                  product.category.name)])
+
+
+def index_category(category):
+    """
+    Refresh every product of a category, e.g. after it was renamed.
+    """
+    rows = [(product_id, name, description, category.name)
+            for product_id, name, description
+            in category.products.values_list('id', 'name', 'description')]
+    if rows:
+        _index_rows(rows)
+
+
+def remove_product(product_id):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+
+def rebuild(batch_size=1000):
+    """
+    Rebuild the whole index from the Product table. Returns the number of
+    indexed products.
+    """
+    rows = (Product.objects
+            .values_list('id', 'name', 'description', 'category__name')
+            .order_by('id'))
+    ProductTrigram.objects.all().delete()
+    if fts_enabled():
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    total = 0
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            _index_rows(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        _index_rows(batch)
+        total += len(batch)
+    return total
+
+
+def _insert_many(cursor, rows):
+    cursor.executemany(
+        f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) '
+        'VALUES (%s, %s, %s, %s)',
+        rows
+    )
+
+
+def match_expression(query):
+    """
+    Turn free text into a safe FTS5 MATCH expression: every word is quoted
+    and used as a prefix, and all words must match.
+    """
+    terms = normalize(query).split()
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+# The search functions below return every available product that matches,
+# unless given a limit, so that the category and facet filters are applied
+# before the limit and never drop matches that would fit in it.
+# fuzzy_ids() and contains_ids() skip the ranking with ordered=False, for
+# when only the set of matches is needed.
+
+def _products_q(category_id, filters, prefix=''):
+    q = Q(**{f'{prefix}available': True})
+    if category_id is not None:
+        q &= Q(**{f'{prefix}category_id': category_id})
+    if filters:
+        q &= facets.filter_q(filters, prefix)
+    return q
+
+
+def ranked_ids(query, limit=None, category_id=None, filters=None):
+    """
+    Return product ids matching the query, best match first.
+    """
+    expression = match_expression(query)
+    if not expression or not fts_enabled():
+        return []
+    weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+    ids = (Product.objects.filter(_products_q(category_id, filters))
+           .extra(select={'fts_rank': f'bm25({FTS_TABLE}, {weights})'},
+                  tables=[FTS_TABLE],
+                  where=[f'{FTS_TABLE}.rowid = shop_product.id', f'{FTS_TABLE} MATCH %s'],
+                  params=[expression])
+           .order_by('fts_rank')
+           .values_list('id', flat=True))
+    return list(ids[:limit] if limit else ids)
+
+
+def _indexed_ids(query):
+    """
+    Return the ids of every product in the full-text index that matches,
+    unranked and unavailable ones included: reading the index alone is
+    several times cheaper than ranked_ids().
+    """
+    expression = match_expression(query)
+    if not expression or not fts_enabled():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+                       [expression])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def fuzzy_ids(query, limit=None, category_id=None, filters=None, ordered=True):
+    """
+    Return product ids whose name or category shares enough trigrams with
+    the query, most similar first. Tolerates typos and missing accents.
+
+    Every trigram is read for its first SEARCH_TRIGRAM_MAX_PRODUCTS
+    products only, so a query of common trigrams costs no more than a
+    rare one; the trigram index is ordered by product, so the cut keeps
+    the same products for every trigram.
+    """
+    grams = sorted(trigrams(query))
+    if not grams:
+        return []
+    min_hits = max(1, math.ceil(len(grams) * settings.SEARCH_TRIGRAM_SIMILARITY))
+    table = ProductTrigram._meta.db_table
+    postings = ' UNION ALL '.join(
+        f'SELECT * FROM (SELECT product_id FROM {table} WHERE trigram = %s '
+        f'ORDER BY product_id LIMIT %s) AS gram{i}'
+        for i in range(len(grams)))
+    params = [param for gram in grams
+              for param in (gram, settings.SEARCH_TRIGRAM_MAX_PRODUCTS)]
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT product_id, COUNT(*) FROM ({postings}) AS postings '
+                       'GROUP BY product_id HAVING COUNT(*) >= %s', params + [min_hits])
+        hits = dict(cursor.fetchall())
+    if not hits:
+        return []
+    ids = list(Product.objects.filter(_products_q(category_id, filters), id__in=list(hits))
+               .order_by().values_list('id', flat=True))
+    if ordered:
+        ids.sort(key=lambda product_id: (-hits[product_id], product_id))
+    return ids[:limit] if limit else ids
+
+
+def contains_ids(query, limit=None, category_id=None, filters=None, ordered=True):
+    """
+    Portable exact search for databases without FTS5: every word must
+    appear in the name, description or category name, as typed or with its
+    accents folded. Name matches come first.
+    """
+    terms = normalize(query).split()
+    if not terms:
+        return []
+    typed = re.findall(r'\w+', query.casefold())
+    if len(typed) != len(terms):
+        typed = terms
+    matches, in_name = _products_q(category_id, filters), Q()
+    for term, raw in zip(terms, typed):
+        name = Q(name__icontains=term) | Q(name__icontains=raw)
+        matches &= (name | Q(description__icontains=term) | Q(description__icontains=raw) |
+                    Q(category__name__icontains=term) | Q(category__name__icontains=raw))
+        in_name &= name
+    products = Product.objects.filter(matches).order_by()
+    if ordered:
+        rank = Case(When(in_name, then=Value(0)), default=Value(1), output_field=IntegerField())
+        products = products.annotate(name_rank=rank).order_by('name_rank', 'id')
+    ids = products.values_list('id', flat=True)
+    return list(ids[:limit] if limit else ids)
+
+
+def catalog_search(query, category_id=None, filters=None):
+    """
+    Return (candidates, page_ids) for a catalog search: the bitmap of every
+    product matching the query, which the facet counts are computed over,
+    and the best SEARCH_RESULTS_LIMIT matches in the category and passing
+    the facet filters, which get listed. Only the page is ranked.
+
+    Exact (accent-insensitive) matches come from the full-text index, or
+    from contains_ids() where it is not available; only when no available
+    product matches exactly is the trigram index used to find near matches,
+    so both results always come from the same kind of match.
+    """
+    if fts_enabled():
+        finder, ids = ranked_ids, _indexed_ids(query)
+    else:
+        finder, ids = contains_ids, contains_ids(query, ordered=False)
+    candidates = facets.bitmap(ids)
+    if not facets.index.count(candidates):
+        finder = fuzzy_ids
+        candidates = facets.bitmap(fuzzy_ids(query, ordered=False))
+        if not candidates:
+            return 0, []
+    return candidates, finder(query, settings.SEARCH_RESULTS_LIMIT, category_id, filters)
+
+
+def matching_ids(query, category_id=None, filters=None):
+    """
+    Return the ids of the best SEARCH_RESULTS_LIMIT matches, see catalog_search().
+    """
+    return catalog_search(query, category_id, filters)[1]
+
+
+def search_products(queryset, query, ids=None):
+    """
+    Filter a Product queryset by a text query, ordered by relevance.
+    """
+    if ids is None:
+        ids = matching_ids(query)
+    if not ids:
+        return queryset.none()
+    rank = Case(*[When(id=product_id, then=Value(position))
+                  for position, product_id in enumerate(ids)],
+                output_field=IntegerField())
+    return (queryset.filter(id__in=ids)
+            .annotate(search_rank=rank)
+            .order_by('search_rank', 'id'))
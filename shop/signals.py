@@ -1,19 +1,107 @@
-from django.db.models.signals import post_save, post_delete
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from django.db.models import Avg
-from .models import Review, Product
+from .models import Review, Product, Category, Coupon
+from . import caching, ratings, search
+from .autocomplete import index as autocomplete_index
+from .facets import index as facet_index
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_rating = (Review.objects.filter(pk=instance.pk)
+                                     .values_list('rating', flat=True)
+                                     .first())
+
 
 @receiver(post_save, sender=Review)
+def update_product_rating(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = None if created else getattr(instance, '_previous_rating', None)
+    ratings.record(instance.product_id, added=instance.rating, removed=previous)
+    instance._previous_rating = instance.rating
+
+
 @receiver(post_delete, sender=Review)
-def update_product_rating(sender, instance, **kwargs):
-    product = instance.product
-    reviews = Review.objects.filter(product=product)
-    
-    if reviews.exists():
-        product.average_rating = reviews.aggregate(Avg('rating'))['rating__avg']
-        product.total_reviews = reviews.count()
-    else:
-        product.average_rating = 0.00
-        product.total_reviews = 0
-    
-    product.save()
\ No newline at end of file
+def remove_product_rating(sender, instance, **kwargs):
+    ratings.record(instance.product_id, removed=instance.rating)
+
+
+# The search index is a table and rolls back with the change; the
+# in-memory indexes are only updated once the change is committed.
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_product(instance)
+
+        def update_indexes():
+            autocomplete_index.update_product(instance)
+            facet_index.update_product(instance)
+        transaction.on_commit(update_indexes)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    # The instance loses its id once deleted
+    product_id = instance.id
+    search.remove_product(product_id)
+
+    def update_indexes():
+        autocomplete_index.remove_product(product_id)
+        facet_index.remove_product(product_id)
+    transaction.on_commit(update_indexes)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if not created:
+        search.index_category(instance)
+    transaction.on_commit(lambda: autocomplete_index.update_category(instance))
+
+
+@receiver(post_delete, sender=Category)
+def unindex_category(sender, instance, **kwargs):
+    category = Category(id=instance.id)
+    transaction.on_commit(lambda: autocomplete_index.update_category(category, deleted=True))
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_category(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_category_id = (Product.objects.filter(pk=instance.pk)
+                                          .values_list('category_id', flat=True)
+                                          .first())
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    scopes = [caching.ALL_PRODUCTS,
+              caching.category_scope(instance.category_id),
+              caching.product_scope(instance.id)]
+    previous_category_id = getattr(instance, '_previous_category_id', None)
+    if previous_category_id:
+        scopes.append(caching.category_scope(previous_category_id))
+    caching.bump(*scopes)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_cache(sender, instance, **kwargs):
+    caching.bump(caching.CATEGORIES, caching.category_scope(instance.id))
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_cache(sender, instance, **kwargs):
+    caching.bump(caching.product_scope(instance.product_id))
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def invalidate_coupon_cache(sender, instance, **kwargs):
+    caching.bump(caching.COUPONS)
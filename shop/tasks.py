@@ -0,0 +1,46 @@
+"""
+Background work for the payment integration, without a message broker.
+
+`submit()` runs a function on a small process-wide thread pool of
+MERCADOPAGO_WORKERS threads once the current transaction commits, so the
+worker sees the rows the request wrote. With MERCADOPAGO_WORKERS = 0 the
+function runs right away in the calling thread, which is what the tests
+use. Queued jobs are lost if the process stops, so anything that must
+survive a restart is kept in the database by the caller and picked up
+again by a management command: retry_payment_preferences and
+process_payment_notifications.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _executor_instance():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.MERCADOPAGO_WORKERS,
+                                           thread_name_prefix='mercadopago')
+        return _executor
+
+
+def _run(func, args):
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"Background task {func.__name__} failed: {e}")
+    finally:
+        # Worker threads open their own connection
+        connection.close()
+
+
+def submit(func, *args):
+    if not settings.MERCADOPAGO_WORKERS:
+        func(*args)
+        return
+    transaction.on_commit(lambda: _executor_instance().submit(_run, func, args))
@@ -6,11 +6,17 @@ app_name = 'shop'
 urlpatterns = [
     path('', views.product_list, name='product_list'),
     path('order/create/', views.order_create, name='order_create'),
+    path('order/<int:order_id>/payment-status/', views.payment_status, name='payment_status'),
     path('payment-success/<int:order_id>/', views.payment_success, name='payment_success'),
     path('payment-failure/<int:order_id>/', views.payment_failure, name='payment_failure'),
     path('payment-pending/<int:order_id>/', views.payment_pending, name='payment_pending'),
     path('webhook/', views.mercadopago_webhook, name='mercadopago_webhook'),
     path('ipn/', views.mercadopago_ipn, name='mercadopago_ipn'),
+    path('autocomplete/', views.autocomplete, name='autocomplete'),
+    path('api/products/', views.product_list_json, name='product_list_json'),
+    path('api/products/<slug:category_slug>/', views.product_list_json,
+         name='product_list_json_by_category'),
+    path('api/products/<int:id>/reviews/', views.product_reviews, name='product_reviews'),
     path('<slug:category_slug>/', views.product_list, name='product_list_by_category'),
     path('<int:id>/<slug:slug>/', views.product_detail, name='product_detail'),
 ]
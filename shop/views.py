@@ -1,60 +1,280 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.db.models import Q
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
-import mercadopago
+from django.views.decorators.http import condition
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.http import HttpResponse, JsonResponse, Http404
+from django.utils.safestring import mark_safe
+from django.utils import dateformat, timezone
 import json
-import hmac
 import hashlib
+import re
+import secrets
+from decimal import Decimal
 
 from .models import Category, Product, Order, OrderItem, Review
 from .forms import OrderCreateForm, ReviewForm
+from .search import catalog_search, search_products
+from . import caching, coupons, facets, inventory, notifications, payments
+from .pagination import KeysetPaginator, InvalidCursor
+from .autocomplete import index as autocomplete_index, PRODUCT, CATEGORY
 from cart.cart import Cart
 from cart.forms import CartAddProductForm
+from cart.views import notify_cart_changes
 
 
-def product_list(request, category_slug=None):
-    category = None
-    categories = Category.objects.all()
+def _get_category(categories, category_slug):
+    if not category_slug:
+        return None
+    for category in categories:
+        if category.slug == category_slug:
+            return category
+    raise Http404('No Category matches the given query.')
+
+
+def _catalog_scopes(category):
+    # Category names are searchable, so renaming any category changes
+    # search results on every page
+    scope = caching.category_scope(category.id) if category else caching.ALL_PRODUCTS
+    return [scope, caching.CATEGORIES]
+
+
+def _catalog_page(request, category, filters):
     products = Product.objects.filter(available=True)
     query = request.GET.get('q')
+    candidates = None
 
-    if query:
-        products = products.filter(Q(name__icontains=query) | Q(description__icontains=query))
-
-    if category_slug:
-        category = get_object_or_404(Category, slug=category_slug)
+    if category:
         products = products.filter(category=category)
 
+    if query:
+        # Facets count every match; the page lists the best ones that pass
+        # the category and facet filters
+        candidates, page_ids = catalog_search(query, category.id if category else None,
+                                              filters)
+        products = search_products(products, query, page_ids)
+
+    products = facets.filter_queryset(products, filters)
+
+    paginator = KeysetPaginator(products, settings.PRODUCTS_PER_PAGE)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.page()
+    return candidates, page
+
+
+def _facet_counts(category, filters, candidates):
+    return facets.index.counts(category.id if category else None, filters, candidates)
+
+
+def _without_cursor(params):
+    params = params.copy()
+    params.pop('cursor', None)
+    return params.urlencode()
+
+
+def _visitor_state(request):
+    """
+    Return what makes the page shell differ between visitors (user, cart),
+    or None when the page carries one-off messages and must not be reused.
+    """
+    if len(messages.get_messages(request)):
+        return None
+    return [request.user.pk, Cart(request).summary()]
+
+
+def _make_etag(*parts):
+    return hashlib.md5(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _catalog_state(request, category_slug=None):
+    """
+    Compute the (etag, last_modified) of a catalog page. The ETag follows
+    the catalog cache versions, which deletions bump too, plus the latest
+    Product.updated, read with one aggregate over its index.
+    """
+    if not hasattr(request, '_catalog_state'):
+        request._catalog_state = (None, None)
+        visitor = _visitor_state(request) if request.method in ('GET', 'HEAD') else None
+        if visitor is not None:
+            updated = Product.objects.aggregate(updated=Max('updated'))['updated']
+            categories = caching.categories()
+            last_modified = max([updated] + [c.updated for c in categories if c.updated],
+                                default=None)
+            versions = caching.get_versions(caching.ALL_PRODUCTS, caching.CATEGORIES)
+            etag = _make_etag(versions, updated, visitor)
+            request._catalog_state = (etag, last_modified)
+    return request._catalog_state
+
+
+def _product_state(request, id, slug):
+    """
+    Compute the (etag, last_modified) of a product page from the product
+    and its category in one primary key lookup. The ETag also follows the
+    product's cache version, which every review change bumps, even one that
+    leaves the rating and Product.updated alone.
+    """
+    if not hasattr(request, '_product_state'):
+        request._product_state = (None, None)
+        visitor = _visitor_state(request) if request.method in ('GET', 'HEAD') else None
+        state = None
+        if visitor is not None:
+            state = (Product.objects.filter(id=id)
+                     .values('updated', 'category__updated', 'slug', 'available')
+                     .order_by().first())
+        if state is not None:
+            last_modified = max(t for t in (state['updated'], state['category__updated']) if t)
+            version = caching.get_versions(caching.product_scope(id))
+            request._product_state = (_make_etag(state, version, visitor), last_modified)
+    return request._product_state
+
+
+@condition(etag_func=lambda request, **kwargs: _catalog_state(request, **kwargs)[0],
+           last_modified_func=lambda request, **kwargs: _catalog_state(request, **kwargs)[1])
+def product_list(request, category_slug=None):
+    categories = caching.categories()
+    category = _get_category(categories, category_slug)
+    filters = facets.parse_filters(request.GET)
+
+    def build():
+        candidates, page = _catalog_page(request, category, filters)
+        grid = render_to_string('shop/product/grid.html',
+                                {'products': page,
+                                 'page': page,
+                                 'page_query': _without_cursor(request.GET)})
+        return {'grid': grid, 'page': page, 'candidates': candidates}
+
+    key = caching.make_key('list', _catalog_scopes(category), sorted(request.GET.lists()))
+    cached = caching.get_or_set(key, build)
+    counts = _facet_counts(category, filters, cached['candidates'])
+
     return render(request,
                   'shop/product/list.html',
                   {'category': category,
                    'categories': categories,
-                   'products': products})
-
-
+                   'products': cached['page'],
+                   'page': cached['page'],
+                   'grid': mark_safe(cached['grid']),
+                   'query': request.GET.get('q'),
+                   'result_count': counts['total'],
+                   'facets': facets.facet_choices(request, categories, category,
+                                                  filters, counts)})
+
+
+def product_list_json(request, category_slug=None):
+    category = _get_category(caching.categories(), category_slug)
+    filters = facets.parse_filters(request.GET)
+
+    def build():
+        candidates, page = _catalog_page(request, category, filters)
+        results = [{'id': product.id,
+                    'name': product.name,
+                    'price': str(product.price),
+                    'image': product.image.url if product.image else None,
+                    'average_rating': str(product.average_rating),
+                    'total_reviews': product.total_reviews,
+                    'url': product.get_absolute_url()}
+                   for product in page]
+        return {'results': results,
+                'next': page.next_cursor,
+                'previous': page.previous_cursor,
+                'candidates': candidates}
+
+    key = caching.make_key('json', _catalog_scopes(category), sorted(request.GET.lists()))
+    cached = caching.get_or_set(key, build)
+    counts = _facet_counts(category, filters, cached['candidates'])
+    return JsonResponse({'results': cached['results'],
+                         'count': counts['total'],
+                         'facets': {'category': counts['category'],
+                                    'price': counts['price'],
+                                    'rating': counts['rating'],
+                                    'in_stock': counts['in_stock']},
+                         'next': cached['next'],
+                         'previous': cached['previous']})
+
+
+def autocomplete(request):
+    try:
+        limit = min(int(request.GET.get('limit', settings.AUTOCOMPLETE_LIMIT)),
+                    settings.AUTOCOMPLETE_LIMIT)
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_LIMIT
+    suggestions = autocomplete_index.suggest(request.GET.get('q', ''), max(limit, 1))
+    return JsonResponse({'products': suggestions[PRODUCT],
+                         'categories': suggestions[CATEGORY]})
+
+
+def _get_product(id, slug):
+    key = caching.make_key('product', [caching.product_scope(id), caching.CATEGORIES], id)
+    product = caching.get_or_set(
+        key, lambda: Product.objects.select_related('category').filter(id=id).first())
+    if product is None or product.slug != slug or not product.available:
+        raise Http404('No Product matches the given query.')
+    return product
+
+
+def _review_page(product_id, cursor=None):
+    """
+    One page of a product's reviews, newest first. Pages are located by
+    (created_at, id) cursor, so any page costs one indexed query no matter
+    how many reviews the product has.
+    """
+    reviews = (Review.objects.filter(product_id=product_id)
+               .select_related('user')
+               .only('rating', 'comment', 'created_at', 'user__username'))
+    paginator = KeysetPaginator(reviews, settings.REVIEWS_PER_PAGE, ['-created_at', '-id'])
+    try:
+        return paginator.page(cursor)
+    except InvalidCursor:
+        return paginator.page()
+
+
+def product_reviews(request, id):
+    cursor = request.GET.get('cursor')
+
+    def build():
+        if not Product.objects.filter(id=id, available=True).exists():
+            raise Http404('No Product matches the given query.')
+        page = _review_page(id, cursor)
+        results = [{'id': review.id,
+                    'user': review.user.username,
+                    'rating': review.rating,
+                    'comment': review.comment,
+                    'created_at': review.created_at.isoformat(),
+                    'date': dateformat.format(timezone.localtime(review.created_at), 'd M Y')}
+                   for review in page]
+        return {'results': results, 'next': page.next_cursor}
+
+    key = caching.make_key('reviews-json', [caching.product_scope(id)], id, cursor)
+    return JsonResponse(caching.get_or_set(key, build))
+
+
+@condition(etag_func=lambda request, **kwargs: _product_state(request, **kwargs)[0],
+           last_modified_func=lambda request, **kwargs: _product_state(request, **kwargs)[1])
 def product_detail(request, id, slug):
-    product = get_object_or_404(Product,
-                                id=id,
-                                slug=slug,
-                                available=True)
+    product = _get_product(id, slug)
     cart_product_form = CartAddProductForm()
-    
-    reviews = product.reviews.all()
-    
-    if request.method == 'POST' and request.user.is_authenticated:
-        # Check if user already reviewed this product
+
+    reviews_html = caching.get_or_set(
+        caching.make_key('reviews', [caching.product_scope(id)], id),
+        lambda: render_to_string('shop/product/reviews.html',
+                                 {'product': product,
+                                  'reviews': _review_page(id)}))
+
+    # The user's own review, if any, is edited instead of creating another one
+    existing_review = None
+    if request.user.is_authenticated:
         existing_review = Review.objects.filter(product=product, user=request.user).first()
 
-        if existing_review:
-            review_form = ReviewForm(request.POST, instance=existing_review)
-        else:
-            review_form = ReviewForm(request.POST)
+    if request.method == 'POST' and request.user.is_authenticated:
+        review_form = ReviewForm(request.POST, instance=existing_review)
 
         if review_form.is_valid():
             new_review = review_form.save(commit=False)
@@ -66,92 +286,128 @@ def product_detail(request, id, slug):
         else:
             messages.error(request, 'Hubo un error al enviar tu reseña. Por favor, verifica los datos.')
     else:
-        # If user already reviewed, pre-fill the form with their review
-        if request.user.is_authenticated:
-            existing_review = Review.objects.filter(product=product, user=request.user).first()
-            if existing_review:
-                review_form = ReviewForm(instance=existing_review)
-            else:
-                review_form = ReviewForm()
-        else:
-            review_form = ReviewForm()
+        review_form = ReviewForm(instance=existing_review)
 
     return render(request,
                   'shop/product/detail.html',
                   {'product': product,
                    'cart_product_form': cart_product_form,
-                   'reviews': reviews,
+                   'reviews_html': mark_safe(reviews_html),
                    'review_form': review_form})
 
 
+IDEMPOTENCY_KEY_RE = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+def _idempotency_key(request):
+    key = request.POST.get('idempotency_key', '')
+    return key if IDEMPOTENCY_KEY_RE.match(key) else None
+
+
+def _checkout_cache_key(key):
+    return f'checkout:{key}'
+
+
+def _remember_checkout(key, context):
+    if key:
+        cache.set(_checkout_cache_key(key), context, settings.CHECKOUT_IDEMPOTENCY_TIMEOUT)
+
+
+def _placed_checkout(key):
+    """
+    Return the payment page context of the order already placed with the
+    idempotency key, or None.
+    """
+    context = cache.get(_checkout_cache_key(key))
+    if context is None:
+        order = Order.objects.filter(idempotency_key=key).first()
+        if order is None:
+            return None
+        context = {'order': order, 'total': order.get_total_cost()}
+        _remember_checkout(key, context)
+    return context
+
+
+def _payment_page(request, context):
+    return render(request, 'shop/order/payment.html',
+                  dict(context, public_key=settings.MERCADOPAGO_PUBLIC_KEY))
+
+
 def order_create(request):
+    key = _idempotency_key(request) if request.method == 'POST' else None
+    if key:
+        # A resubmitted form gets the order it already placed
+        context = _placed_checkout(key)
+        if context is not None:
+            return _payment_page(request, context)
+
     cart = Cart(request)
+    changes = cart.revalidate()
+    notify_cart_changes(request, changes)
     if not cart:
         return redirect('shop:product_list')
+    if changes and request.method == 'POST':
+        # Let the buyer review the new prices before paying them
+        return redirect('cart:cart_detail')
 
     if request.method == 'POST':
         form = OrderCreateForm(request.POST)
         if form.is_valid():
-            order = form.save(commit=False)
-            if request.user.is_authenticated:
-                order.user = request.user
-            order.save()
-
-            for item in cart:
-                product = item['product']
-                quantity = item['quantity']
-
-                OrderItem.objects.create(order=order,
-                                         product=product,
-                                         price=item['price'],
-                                         quantity=quantity)
-
-            # Create MercadoPago preference
-            sdk = mercadopago.SDK(settings.MERCADOPAGO_ACCESS_TOKEN)
-
-            items = []
-            for item in order.items.all():
-                items.append({
-                    "title": item.product.name,
-                    "quantity": item.quantity,
-                    "unit_price": float(item.price),
-                })
-
-            base_url = "https://dev.yokotoka.is"
-            preference_data = {
-                "items": items,
-                "back_urls": {
-                    "success": f"{base_url}/payment-success/{order.id}/",
-                    "failure": f"{base_url}/payment-failure/{order.id}/",
-                    "pending": f"{base_url}/payment-pending/{order.id}/"
-                },
-                "auto_return": "approved",
-                "notification_url": f"{base_url}/webhook/",
-                "external_reference": str(order.id),
-            }
-
-            preference_response = sdk.preference().create(preference_data)
-
-            # Log the response for debugging
-            print(f"MercadoPago Response: {preference_response}")
-            print(f"Response status: {preference_response.get('status')}")
-            print(f"Response body: {preference_response.get('response')}")
-
-            if preference_response.get('status') == 201:
-                preference = preference_response.get("response", {})
-                preference_id = preference.get('id')
-                sandbox_init_point = preference.get('sandbox_init_point')
-            else:
-                print(f"MercadoPago API Error: {preference_response}")
-                preference_id = None
-                sandbox_init_point = None
-
-            return render(request, 'shop/order/payment.html', {
+            coupon = cart.coupon
+            user = request.user if request.user.is_authenticated else None
+            try:
+                with transaction.atomic():
+                    # Counting the use first means a failed order gives it back
+                    if coupon:
+                        error = None
+                        if not coupons.can_use(coupon, user, form.cleaned_data['email']):
+                            error = 'You have already used this coupon.'
+                        elif not coupons.redeem(coupon):
+                            error = 'This coupon is no longer valid.'
+                        if error:
+                            cart.clear_coupon()
+                            messages.error(request, error)
+                            return redirect('cart:cart_detail')
+                    order = form.save(commit=False)
+                    order.user = user
+                    order.idempotency_key = key
+                    if coupon:
+                        order.coupon = coupon
+                        order.discount = cart.get_discount().quantize(Decimal('0.01'))
+                    inventory.reserve(order, [(item['product'].id, item['quantity'])
+                                              for item in cart])
+                    order.save()
+
+                    # The cart already loaded the products, so the items are
+                    # written and priced without querying them again
+                    order_items = OrderItem.objects.bulk_create([
+                        OrderItem(order=order,
+                                  product=item['product'],
+                                  price=item['price'],
+                                  quantity=item['quantity'])
+                        for item in cart
+                    ])
+                    if coupon:
+                        coupons.record(order)
+            except inventory.InsufficientStock:
+                messages.error(request, 'Some products in your cart are no longer in stock.')
+                return redirect('cart:cart_detail')
+            except IntegrityError:
+                # A concurrent submission of the same form placed it first
+                context = key and _placed_checkout(key)
+                if not context:
+                    raise
+                return _payment_page(request, context)
+
+            payments.schedule_preference(order, payments.preference_data(order, order_items))
+            request.session['order_id'] = order.id
+
+            context = {
                 'order': order,
-                'preference_id': preference_id,
-                'sandbox_init_point': sandbox_init_point,
-                'public_key': settings.MERCADOPAGO_PUBLIC_KEY
-            })
+                'total': sum(item.get_cost() for item in order_items) - order.discount,
+            }
+            _remember_checkout(key, context)
+            return _payment_page(request, context)
     else:
         # Pre-fill form for authenticated users
         if request.user.is_authenticated:
@@ -167,21 +423,40 @@ def order_create(request):
             form = OrderCreateForm()
     return render(request,
                   'shop/order/create.html',
-                  {'cart': cart, 'form': form})
+                  {'cart': cart, 'form': form,
+                   'idempotency_key': key or secrets.token_urlsafe(24)})
+
+
+def _get_own_order(request, order_id):
+    """
+    Return the order if it belongs to the visitor: their account, or the
+    session that placed it. Order ids are sequential, so anything else is
+    a 404.
+    """
+    order = get_object_or_404(Order, id=order_id)
+    owner = (order.user_id == request.user.id if order.user_id
+             else request.session.get('order_id') == order.id)
+    if not owner:
+        raise Http404('No Order matches the given query.')
+    return order
+
+
+def payment_status(request, order_id):
+    """
+    Polled by the payment page until the order's preference is created.
+    """
+    order = _get_own_order(request, order_id)
+    return JsonResponse({'status': order.preference_status,
+                         'preference_id': order.preference_id or None,
+                         'init_point': order.init_point or None})
 
 
 def payment_success(request, order_id):
     order = get_object_or_404(Order, id=order_id)
     order.paid = True
     order.status = Order.STATUS_PAID
-    order.save()
-
-    # Reduce stock
-    for item in order.items.all():
-        product = item.product
-        if product.stock >= item.quantity:
-            product.stock -= item.quantity
-            product.save()
+    order.save(update_fields=['paid', 'status', 'updated'])
+    inventory.commit(order)
 
     # Clear cart
     cart = Cart(request)
@@ -198,7 +473,9 @@ def payment_success(request, order_id):
 
 
 def payment_failure(request, order_id):
-    order = get_object_or_404(Order, id=order_id)
+    # Only the buyer may give the reserved stock back
+    order = _get_own_order(request, order_id)
+    inventory.release(order)
     messages.error(request, 'Payment failed. Please try again.')
     return render(request, 'shop/payment/failure.html', {'order': order})
 
@@ -212,127 +489,24 @@ def payment_pending(request, order_id):
 @csrf_exempt
 def mercadopago_webhook(request):
     if request.method == 'POST':
+        rejected = notifications.verify(request)
+        if rejected == 'replayed':
+            return HttpResponse(status=200)  # Already accepted
+        if rejected:
+            return HttpResponse(status=401)
         try:
-            sdk = mercadopago.SDK(settings.MERCADOPAGO_ACCESS_TOKEN)
-
-            # Check query params first (IPN style)
-            topic = request.GET.get('topic')
-            resource_id = request.GET.get('id')
-
-            if topic == 'merchant_order' and resource_id:
-                # Get merchant order details
-                merchant_order = sdk.merchant_order().get(resource_id)
-                if merchant_order['status'] == 200:
-                    order_data = merchant_order['response']
-                    external_reference = order_data.get('external_reference')
-
-                    # Check if all payments are approved
-                    payments = order_data.get('payments', [])
-                    paid_amount = sum(p['transaction_amount'] for p in payments if p['status'] == 'approved')
-
-                    if paid_amount >= order_data.get('total_amount', 0) and external_reference:
-                        try:
-                            order = Order.objects.get(id=external_reference)
-                            if not order.paid:
-                                order.paid = True
-                                order.status = Order.STATUS_PAID
-                                order.save()
-                                for item in order.items.all():
-                                    product = item.product
-                                    product.stock -= item.quantity
-                                    product.save()
-                        except Order.DoesNotExist:
-                            pass
-                return HttpResponse(status=200)
-
-            # Check body for webhook v2 style
-            data = json.loads(request.body.decode('utf-8')) if request.body else {}
-
-            if data.get('type') == 'payment':
-                payment_id = data.get('data', {}).get('id')
-                payment_info = sdk.payment().get(payment_id)
-
-                if payment_info['status'] == 200:
-                    payment = payment_info['response']
-                    external_reference = payment.get('external_reference')
-
-                    if external_reference:
-                        try:
-                            order = Order.objects.get(id=external_reference)
-                            if payment['status'] == 'approved' and not order.paid:
-                                order.paid = True
-                                order.status = Order.STATUS_PAID
-                                order.save()
-                                for item in order.items.all():
-                                    product = item.product
-                                    product.stock -= item.quantity
-                                    product.save()
-                        except Order.DoesNotExist:
-                            pass
-
-            return HttpResponse(status=200)
+            notifications.ingest(request)
         except Exception as e:
             print(f"Webhook error: {e}")
-            return HttpResponse(status=200)  # Always return 200 to avoid retries
+        return HttpResponse(status=200)  # Always return 200 to avoid retries
 
     return HttpResponse(status=405)
 
 
 @csrf_exempt
 def mercadopago_ipn(request):
-    if request.method in ('POST', 'GET'):
-        topic = request.GET.get('topic') or request.POST.get('topic')
-        resource_id = request.GET.get('id') or request.POST.get('id')
-
-        if not topic or not resource_id:
-            return HttpResponse(status=200)
-
-        try:
-            sdk = mercadopago.SDK(settings.MERCADOPAGO_ACCESS_TOKEN)
-
-            if topic == 'payment':
-                payment_info = sdk.payment().get(resource_id)
-                if payment_info.get('status') == 200:
-                    payment = payment_info['response']
-                    external_reference = payment.get('external_reference')
-                    if external_reference and payment.get('status') == 'approved':
-                        try:
-                            order = Order.objects.get(id=external_reference)
-                            if not order.paid:
-                                order.paid = True
-                                order.status = Order.STATUS_PAID
-                                order.save()
-                                for item in order.items.all():
-                                    product = item.product
-                                    product.stock -= item.quantity
-                                    product.save()
-                        except Order.DoesNotExist:
-                            pass
-
-            elif topic == 'merchant_order':
-                merchant_order = sdk.merchant_order().get(resource_id)
-                if merchant_order.get('status') == 200:
-                    order_data = merchant_order['response']
-                    external_reference = order_data.get('external_reference')
-                    payments = order_data.get('payments', [])
-                    paid_amount = sum(p['transaction_amount'] for p in payments if p['status'] == 'approved')
-                    if paid_amount >= order_data.get('total_amount', 0) and external_reference:
-                        try:
-                            order = Order.objects.get(id=external_reference)
-                            if not order.paid:
-                                order.paid = True
-                                order.status = Order.STATUS_PAID
-                                order.save()
-                                for item in order.items.all():
-                                    product = item.product
-                                    product.stock -= item.quantity
-                                    product.save()
-                        except Order.DoesNotExist:
-                            pass
-
-        except Exception as e:
-            print(f"IPN error: {e}")
-
-        return HttpResponse(status=200)
-
-    return HttpResponse(status=200)
\ No newline at end of file
+    # Retired: preferences send their notifications to the signed webhook.
+    # IPN requests carry no signature, so queuing them would let anyone
+    # make the shop write a row and call MercadoPago per request; they are
+    # acknowledged so MercadoPago stops resending them.
+    return HttpResponse(status=200)
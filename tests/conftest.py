@@ -1,6 +1,5 @@
 import pytest
 from decimal import Decimal
-from unittest.mock import Mock, patch
 
 
 @pytest.fixture
@@ -159,16 +158,55 @@ def wishlist_item(db, user, product):
 
 
 @pytest.fixture(autouse=True)
-def mock_mercadopago():
-    with patch('shop.views.mercadopago') as mock_mp:
-        mock_sdk = Mock()
-        mock_preference = Mock()
-        mock_preference.create.return_value = {
-            'response': {
-                'id': 'test_preference_id_123',
-                'init_point': 'https://www.mercadopago.com.ar/checkout/v1/redirect?pref_id=test_preference_id_123'
-            }
-        }
-        mock_sdk.preference.return_value = mock_preference
-        mock_mp.SDK.return_value = mock_sdk
-        yield mock_mp
+def clear_cache():
+    from django.core.cache import cache
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_in_memory_indexes():
+    from shop.autocomplete import index as autocomplete_index
+    from shop.facets import index as facet_index
+    from shop.notifications import recent as recent_notifications
+    autocomplete_index.clear()
+    facet_index.clear()
+    recent_notifications.clear()
+    yield
+    autocomplete_index.clear()
+    facet_index.clear()
+    recent_notifications.clear()
+
+
+@pytest.fixture(autouse=True)
+def inline_payment_workers(settings):
+    settings.MERCADOPAGO_WORKERS = 0
+
+
+@pytest.fixture(autouse=True)
+def payment_gateway(settings):
+    from shop.gateway import get_gateway
+    settings.MERCADOPAGO_GATEWAY = 'shop.gateway.StubGateway'
+    return get_gateway()
+
+
+@pytest.fixture
+def signed_webhook(client):
+    """
+    Post a webhook signed like MercadoPago does, for a payment by default.
+    """
+    import time
+    import uuid
+    from django.urls import reverse
+    from shop.notifications import sign
+
+    def post(payment_id, topic='payment', **headers):
+        ts = str(int(time.time()))
+        request_id = uuid.uuid4().hex
+        headers.setdefault('x-request-id', request_id)
+        headers.setdefault('x-signature', f'ts={ts},v1={sign(payment_id, request_id, ts)}')
+        return client.post(reverse('shop:mercadopago_webhook'),
+                           data={'type': topic, 'data': {'id': payment_id}},
+                           content_type='application/json', headers=headers)
+    return post
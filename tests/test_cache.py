@@ -0,0 +1,231 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from decimal import Decimal
+from shop.models import Category, Product, Review
+from shop import caching
+
+
+def catalog_queries(queries):
+    """
+    Queries against the catalog tables, except the single query used to
+    answer conditional GETs.
+    """
+    return [q['sql'] for q in queries.captured_queries
+            if '"shop_' in q['sql'] and 'MAX(' not in q['sql']
+            and not q['sql'].startswith('SELECT "shop_product"."updated"')]
+
+
+@pytest.mark.django_db
+def test_product_list_served_from_cache(client, product):
+    client.get(reverse('shop:product_list'))
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('shop:product_list'))
+    assert catalog_queries(queries) == []
+    assert product.name in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_product_list_cache_invalidated_on_product_change(client, product,
+                                                         django_capture_on_commit_callbacks):
+    client.get(reverse('shop:product_list'))
+    product.name = 'Renamed Product'
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+    response = client.get(reverse('shop:product_list'))
+    assert 'Renamed Product' in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_category_cache_invalidated_when_product_moves(client, product, category,
+                                                       django_capture_on_commit_callbacks):
+    other = Category.objects.create(name='Other', slug='other')
+    client.get(reverse('shop:product_list_by_category', args=[category.slug]))
+    client.get(reverse('shop:product_list_by_category', args=[other.slug]))
+
+    product.category = other
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+
+    response = client.get(reverse('shop:product_list_by_category', args=[category.slug]))
+    assert product.name not in response.content.decode()
+    response = client.get(reverse('shop:product_list_by_category', args=[other.slug]))
+    assert product.name in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_product_change_keeps_other_categories_cached(product, category,
+                                                      django_capture_on_commit_callbacks):
+    other = Category.objects.create(name='Other', slug='other')
+    before = caching.get_versions(caching.category_scope(other.id),
+                                  caching.category_scope(category.id))
+    product.price = Decimal('9.99')
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+    after = caching.get_versions(caching.category_scope(other.id),
+                                 caching.category_scope(category.id))
+    assert after[0] == before[0]
+    assert after[1] != before[1]
+
+
+@pytest.mark.django_db
+def test_product_detail_served_from_cache(client, product):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    client.get(url)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    assert catalog_queries(queries) == []
+    assert product.name in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_product_detail_cache_invalidated_on_review(client, product, user,
+                                                    django_capture_on_commit_callbacks):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    client.get(url)
+    with django_capture_on_commit_callbacks(execute=True):
+        Review.objects.create(product=product, user=user, rating=5, comment='Crujientes!')
+    assert 'Crujientes!' in client.get(url).content.decode()
+
+
+@pytest.mark.django_db
+def test_product_detail_cache_respects_availability(client, product,
+                                                    django_capture_on_commit_callbacks):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    client.get(url)
+    product.available = False
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+    assert client.get(url).status_code == 404
+
+
+@pytest.mark.django_db
+def test_catalog_cache_with_file_backend(client, product, settings, tmp_path,
+                                         django_capture_on_commit_callbacks):
+    settings.CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': str(tmp_path),
+    }}
+    client.get(reverse('shop:product_list'))
+    product.name = 'Renamed Product'
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+    response = client.get(reverse('shop:product_list'))
+    assert 'Renamed Product' in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_product_list_conditional_get(client, product):
+    response = client.get(reverse('shop:product_list'))
+    etag = response['ETag']
+    assert not etag.startswith('W/')
+    assert response.has_header('Last-Modified')
+
+    response = client.get(reverse('shop:product_list'), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response.content == b''
+
+    product.price = Decimal('1.00')
+    product.save()
+    response = client.get(reverse('shop:product_list'), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_product_list_etag_changes_with_categories(client, product,
+                                                   django_capture_on_commit_callbacks):
+    etag = client.get(reverse('shop:product_list'))['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        Category.objects.create(name='Nueva', slug='nueva')
+    response = client.get(reverse('shop:product_list'), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_product_list_etag_changes_on_delete(client, product, category,
+                                             django_capture_on_commit_callbacks):
+    older = Product.objects.create(category=category, name='Older', slug='older',
+                                   price=Decimal('1.00'))
+    Product.objects.filter(pk=older.pk).update(updated=product.updated.replace(year=2000))
+    etag = client.get(reverse('shop:product_list'))['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        older.delete()
+    response = client.get(reverse('shop:product_list'), HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_product_detail_conditional_get(client, product, user):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    response = client.get(url)
+    etag, last_modified = response['ETag'], response['Last-Modified']
+
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+    assert client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code == 304
+
+    Review.objects.create(product=product, user=user, rating=3)
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test_product_etag_changes_with_review_comment(client, product, user,
+                                                  django_capture_on_commit_callbacks):
+    review = Review.objects.create(product=product, user=user, rating=4, comment='Rica')
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    etag = client.get(url)['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        review.comment = 'Muy rica'
+        review.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert 'Muy rica' in response.content.decode()
+
+
+@pytest.mark.django_db
+def test_conditional_get_varies_with_cart(client, product):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    etag = client.get(url)['ETag']
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1})
+    client.get(reverse('cart:cart_detail'))  # consume the "added" message
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test_conditional_get_costs_one_catalog_query(client, product):
+    url = reverse('shop:product_detail', args=[product.id, product.slug])
+    etag = client.get(url)['ETag']
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert len([q for q in queries.captured_queries if '"shop_' in q['sql']]) == 1
+
+
+@pytest.mark.django_db
+def test_versions_are_bumped_when_the_change_commits(product, django_capture_on_commit_callbacks):
+    scope = caching.product_scope(product.id)
+    before = caching.get_versions(scope)
+    with django_capture_on_commit_callbacks() as callbacks:
+        product.save()
+        assert caching.get_versions(scope) == before
+    for callback in callbacks:
+        callback()
+    assert caching.get_versions(scope) != before
+
+
+@pytest.mark.django_db
+def test_rolled_back_changes_leave_caches_alone(product, django_capture_on_commit_callbacks):
+    from django.db import transaction
+    from shop import facets
+    filters = facets.parse_filters({})
+    versions = caching.get_versions(caching.ALL_PRODUCTS, caching.product_scope(product.id))
+    in_stock = facets.index.counts(None, filters)['in_stock']
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with pytest.raises(RuntimeError), transaction.atomic():
+            product.stock = 0
+            product.save()
+            raise RuntimeError()
+
+    assert caching.get_versions(caching.ALL_PRODUCTS, caching.product_scope(product.id)) == versions
+    assert facets.index.counts(None, filters)['in_stock'] == in_stock == 1
@@ -2,7 +2,13 @@ import pytest
 from django.urls import reverse
 from django.conf import settings
 from decimal import Decimal
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import Client
+from django.contrib.messages import get_messages
 from cart.cart import Cart
+from cart.models import StoredCart, StoredCartItem
 from shop.models import Product
 
 
@@ -154,3 +160,220 @@ def test_remove_coupon(client, product, valid_coupon):
 
     cart = Cart(client)
     assert cart.coupon is None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('backend', [
+    'cart.storage.SessionCartStorage',
+    'cart.storage.SignedCookieCartStorage',
+    'cart.storage.CacheCartStorage',
+    'cart.storage.DatabaseCartStorage',
+])
+def test_cart_storage_backends(client, product, valid_coupon, settings, backend):
+    settings.CART_STORAGE = backend
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+
+    response = client.get(reverse('cart:cart_detail'))
+    cart = response.context['cart']
+    assert len(cart) == 2
+    assert cart.coupon == valid_coupon
+    assert product.name in response.content.decode()
+
+    client.post(reverse('cart:cart_clear'))
+    response = client.get(reverse('cart:cart_detail'))
+    assert len(response.context['cart']) == 0
+
+
+@pytest.mark.django_db
+def test_signed_cookie_cart_rejects_tampering(client, product, settings):
+    settings.CART_STORAGE = 'cart.storage.SignedCookieCartStorage'
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    assert settings.CART_SESSION_ID not in client.session
+
+    client.cookies[settings.CART_COOKIE_NAME] = client.cookies[settings.CART_COOKIE_NAME].value + 'x'
+    response = client.get(reverse('cart:cart_detail'))
+    assert len(response.context['cart']) == 0
+
+
+@pytest.mark.django_db
+def test_anonymous_browsing_creates_no_session(client, product):
+    response = client.get(reverse('shop:product_list'))
+    assert response.status_code == 200
+    assert settings.SESSION_COOKIE_NAME not in response.cookies
+    assert not Session.objects.exists()
+
+
+@pytest.mark.django_db
+def test_cart_header_reads_stored_summary(client, product):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 3, 'update': False})
+    summary = client.session[settings.CART_SESSION_ID + '_summary']
+    assert summary == {'count': 3, 'subtotal': str(product.price * 3)}
+
+    response = client.get(reverse('shop:product_list'))
+    cart = response.context['cart']
+    assert f'>{product.price * 3:.2f}</span>)' in response.content.decode()
+    # The header was rendered without reading the cart lines
+    assert cart._cart is None
+
+
+@pytest.mark.django_db
+def test_cart_detail_query_count(client, product, category, valid_coupon):
+    another = Product.objects.create(category=category, name='Another Product',
+                                     slug='another-product', price=Decimal('15.00'), stock=10)
+    for item in (product, another):
+        client.post(reverse('cart:cart_add', args=[item.id]), {'quantity': 1, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('cart:cart_detail'))
+    assert response.status_code == 200
+    sql = [q['sql'] for q in queries.captured_queries]
+    assert len([q for q in sql if 'FROM "shop_product"' in q]) == 1
+    assert len([q for q in sql if 'FROM "shop_coupon"' in q]) == 1
+    assert len(sql) == 3
+
+
+@pytest.mark.django_db
+def test_cart_api_add_update_remove(client, product):
+    response = client.post(reverse('cart:api_cart_add', args=[product.id]), {'quantity': 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['line'] == {'product_id': product.id, 'name': product.name, 'quantity': 2,
+                            'price': str(product.price), 'total_price': str(product.price * 2),
+                            'removed': False}
+    assert data['count'] == 2
+    assert data['subtotal'] == str(product.price * 2)
+
+    data = client.post(reverse('cart:api_cart_update', args=[product.id]), {'quantity': 5}).json()
+    assert data['line']['quantity'] == 5
+    assert data['count'] == 5
+
+    data = client.post(reverse('cart:api_cart_remove', args=[product.id])).json()
+    assert data['line']['removed']
+    assert data['count'] == 0
+    assert len(Cart(client)) == 0
+
+
+@pytest.mark.django_db
+def test_cart_api_validation_errors(client, product):
+    response = client.post(reverse('cart:api_cart_add', args=[product.id]), {'quantity': 99})
+    assert response.status_code == 400
+    assert 'quantity' in response.json()['errors']
+    assert client.get(reverse('cart:api_cart_add', args=[product.id])).status_code == 405
+
+
+@pytest.mark.django_db
+def test_cart_api_coupons(client, product, valid_coupon):
+    client.post(reverse('cart:api_cart_add', args=[product.id]), {'quantity': 1})
+
+    response = client.post(reverse('cart:api_apply_coupon'), {'coupon_code': 'NOPE'})
+    assert response.status_code == 400
+    assert response.json()['error'] == 'Invalid coupon code.'
+
+    data = client.post(reverse('cart:api_apply_coupon'), {'coupon_code': valid_coupon.code.lower()}).json()
+    assert data['coupon'] == {'code': valid_coupon.code, 'discount_percent': 20}
+    assert Decimal(data['total']) == product.price - product.price * Decimal('0.20')
+
+    data = client.post(reverse('cart:api_remove_coupon')).json()
+    assert data['coupon'] is None
+    assert data['total'] == data['subtotal']
+
+
+@pytest.mark.django_db
+def test_anonymous_cart_merged_on_login(client, user, product, category):
+    another = Product.objects.create(category=category, name='Another Product',
+                                     slug='another-product', price=Decimal('15.00'), stock=10)
+    stored = StoredCart.objects.create(user=user)
+    StoredCartItem.objects.create(cart=stored, product=product, quantity=1, price=product.price)
+    StoredCartItem.objects.create(cart=stored, product=another, quantity=1, price=another.price)
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+
+    with CaptureQueriesContext(connection) as queries:
+        client.post(reverse('users:login'), {'username': 'testuser', 'password': 'testpass123'})
+    inserts = [q for q in queries.captured_queries
+               if q['sql'].startswith('INSERT INTO "cart_storedcartitem"')]
+    assert len(inserts) == 1
+
+    quantities = dict(stored.items.values_list('product_id', 'quantity'))
+    assert quantities == {product.id: 3, another.id: 1}
+    assert len(Cart(client)) == 4
+
+
+@pytest.mark.django_db
+def test_user_cart_follows_user_across_devices(client, user, product):
+    other_device = Client()
+    client.force_login(user)
+    other_device.force_login(user)
+
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+    response = other_device.get(reverse('cart:cart_detail'))
+    assert len(response.context['cart']) == 2
+    assert product.name in response.content.decode()
+
+    other_device.post(reverse('cart:cart_clear'))
+    response = client.get(reverse('cart:cart_detail'))
+    assert len(response.context['cart']) == 0
+
+
+@pytest.mark.django_db
+def test_user_cart_header_served_from_cache(client, user, product):
+    client.force_login(user)
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('shop:product_list'))
+    assert f'>{product.price * 2:.2f}</span>)' in response.content.decode()
+    assert not [q for q in queries.captured_queries if 'cart_stored' in q['sql']]
+
+
+@pytest.mark.django_db
+def test_cart_revalidate_reprices_and_caps_lines(client, product,
+                                                 django_capture_on_commit_callbacks):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 5, 'update': False})
+    product.price = Decimal('12.50')
+    product.stock = 3
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+
+    response = client.get(reverse('cart:cart_detail'))
+    assert response.status_code == 200
+    item = client.session[settings.CART_SESSION_ID][str(product.id)]
+    assert item == {'quantity': 3, 'price': '12.50'}
+    assert response.context['cart'].get_total_price() == Decimal('37.50')
+    notes = [str(m) for m in get_messages(response.wsgi_request)]
+    assert any('changed from' in note for note in notes)
+    assert any('Only 3 units' in note for note in notes)
+
+
+@pytest.mark.django_db
+def test_cart_revalidate_removes_unavailable_products(client, product,
+                                                      django_capture_on_commit_callbacks):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    product.available = False
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+
+    response = client.post(reverse('shop:order_create'), {})
+    assert response.status_code == 302
+    assert response.url == reverse('shop:product_list')
+    assert str(product.id) not in client.session[settings.CART_SESSION_ID]
+
+
+@pytest.mark.django_db
+def test_cart_revalidate_is_skipped_when_nothing_changed(client, product,
+                                                         django_capture_on_commit_callbacks):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    old_price = product.price
+    product.price = Decimal('11.00')
+    with django_capture_on_commit_callbacks(execute=True):
+        product.save()
+    changes = Cart(client).revalidate()
+    assert changes[str(product.id)]['price'] == (old_price, Decimal('11.00'))
+    client.get(reverse('cart:cart_detail'))
+
+    cart = Cart(client)
+    assert cart.cart
+    with CaptureQueriesContext(connection) as queries:
+        assert cart.revalidate() == {}
+    assert len(queries) == 0
@@ -0,0 +1,175 @@
+import pytest
+from django.core.cache import cache
+from django.urls import reverse
+from decimal import Decimal
+from shop.models import Category, Product, Review
+from shop import caching, facets, ratings
+
+
+@pytest.fixture
+def catalog(db, category):
+    sauces = Category.objects.create(name='Salsas', slug='salsas')
+    items = {
+        'wings': Product.objects.create(category=category, name='Alitas', slug='alitas',
+                                        price=Decimal('5.99'), stock=10),
+        'strips': Product.objects.create(category=category, name='Tiras', slug='tiras',
+                                         price=Decimal('12.00'), stock=0),
+        'ranch': Product.objects.create(category=sauces, name='Ranch', slug='ranch',
+                                        price=Decimal('0.99'), stock=5),
+        'garlic': Product.objects.create(category=sauces, name='Ajo', slug='ajo',
+                                         price=Decimal('1.50'), stock=0),
+    }
+    return category, sauces, items
+
+
+def names(response):
+    return sorted(p.name for p in response.context['products'])
+
+
+@pytest.mark.django_db
+def test_facet_counts(catalog):
+    category, sauces, items = catalog
+    filters = facets.parse_filters({})
+    counts = facets.index.counts(None, filters)
+    assert counts['total'] == 4
+    assert counts['category'] == {category.id: 2, sauces.id: 2}
+    assert counts['price'] == {'0-2': 2, '5-10': 1, '10-': 1}
+    assert counts['in_stock'] == 2
+
+
+@pytest.mark.django_db
+def test_facet_counts_intersect_other_filters(catalog):
+    category, sauces, items = catalog
+    filters = facets.parse_filters({'in_stock': '1'})
+    counts = facets.index.counts(sauces.id, filters)
+    assert counts['total'] == 1
+    assert counts['category'] == {category.id: 1, sauces.id: 1}
+    assert counts['price'] == {'0-2': 1, '5-10': 0, '10-': 0}
+    assert counts['in_stock'] == 1
+
+
+@pytest.mark.django_db
+def test_facets_update_incrementally(catalog, django_capture_on_commit_callbacks,
+                                    django_assert_num_queries):
+    category, sauces, items = catalog
+    facets.index.counts(None, facets.parse_filters({}))
+
+    with django_capture_on_commit_callbacks(execute=True):
+        items['strips'].stock = 3
+        items['strips'].save()
+        items['ranch'].delete()
+        Review.objects.create(product=items['wings'], user=_user(), rating=5)
+
+    # Its own changes do not make the index reload
+    with django_assert_num_queries(0):
+        counts = facets.index.counts(None, facets.parse_filters({}))
+    assert counts['total'] == 3
+    assert counts['in_stock'] == 2
+    assert counts['rating'][4] == 1
+
+
+@pytest.mark.django_db
+def test_facets_reload_after_changes_from_other_processes(catalog):
+    category, sauces, items = catalog
+    facets.index.counts(None, facets.parse_filters({}))
+
+    # Another process sells the last wings and bumps the catalog version
+    Product.objects.filter(pk=items['wings'].pk).update(stock=0)
+    cache.incr(f'catalog:version:{caching.ALL_PRODUCTS}')
+    assert facets.index.counts(None, facets.parse_filters({}))['in_stock'] == 1
+
+    # A bump from this process that the index did not take part in
+    Product.objects.filter(pk=items['ranch'].pk).update(stock=0)
+    caching.bump_now(caching.ALL_PRODUCTS)
+    assert facets.index.counts(None, facets.parse_filters({}))['in_stock'] == 0
+
+
+def _user():
+    from django.contrib.auth import get_user_model
+    return get_user_model().objects.create_user(username='rater', password='x')
+
+
+@pytest.mark.django_db
+def test_product_list_filters(client, catalog):
+    response = client.get(reverse('shop:product_list'), {'price': '0-2'})
+    assert names(response) == ['Ajo', 'Ranch']
+
+    response = client.get(reverse('shop:product_list'), {'price': '0-2', 'in_stock': '1'})
+    assert names(response) == ['Ranch']
+    assert response.context['result_count'] == 1
+
+
+@pytest.mark.django_db
+def test_product_list_rating_filter(client, catalog, user):
+    category, sauces, items = catalog
+    Review.objects.create(product=items['ranch'], user=user, rating=4)
+    response = client.get(reverse('shop:product_list'), {'rating': '4'})
+    assert names(response) == ['Ranch']
+
+
+@pytest.mark.django_db
+def test_facet_links_keep_other_filters(client, catalog):
+    category, sauces, items = catalog
+    response = client.get(reverse('shop:product_list_by_category', args=[sauces.slug]),
+                          {'in_stock': '1'})
+    choices = response.context['facets']
+    assert choices['price'][0]['url'] == '?in_stock=1&price=0-2'
+    assert choices['in_stock']['url'] == sauces.get_absolute_url()
+    assert choices['all_categories']['url'] == reverse('shop:product_list') + '?in_stock=1'
+
+
+@pytest.mark.django_db
+def test_facet_counts_follow_search(client, catalog):
+    category, sauces, items = catalog
+    response = client.get(reverse('shop:product_list'), {'q': 'ranch'})
+    counts = {c['label']: c['count'] for c in response.context['facets']['categories']}
+    assert counts == {'Salsas': 1, 'Test Category': 0}
+    assert response.context['facets']['all_categories']['count'] == 1
+
+
+@pytest.mark.django_db
+def test_search_limit_applies_after_facet_filters(client, category, settings):
+    settings.SEARCH_RESULTS_LIMIT = 2
+    for i in range(4):
+        Product.objects.create(category=category, name=f'Pollo {i}', slug=f'pollo-{i}',
+                               price=Decimal('1.00'))
+    whole = Product.objects.create(category=category, name='Pollo Entero', slug='pollo-entero',
+                                   price=Decimal('15.00'))
+    data = client.get(reverse('shop:product_list_json'), {'q': 'pollo', 'price': '10-'}).json()
+    assert data['count'] == 1
+    assert [p['id'] for p in data['results']] == [whole.id]
+
+
+def test_bitmap():
+    assert facets.bitmap([]) == 0
+    assert facets.bitmap([0, 3, 9]) == 1 | 1 << 3 | 1 << 9
+
+
+@pytest.mark.django_db
+def test_sort_by_best_rated(client, catalog, user, another_user):
+    category, sauces, items = catalog
+    popular, single = items['strips'], items['ranch']
+    for u in (user, another_user):
+        Review.objects.create(product=popular, user=u, rating=5, comment='!')
+    Review.objects.create(product=single, user=user, rating=4, comment='ok')
+
+    response = client.get(reverse('shop:product_list'), {'sort': 'rating'})
+    ranked = [p.name for p in response.context['products']]
+    assert ranked == ['Tiras', 'Ranch', 'Alitas', 'Ajo']
+    assert response.context['facets']['sort'][1]['selected']
+
+    popular.refresh_from_db()
+    assert popular.weighted_rating == ratings.weighted(10, 2)
+    assert popular.rating_distribution()[0] == {'stars': 5, 'count': 2, 'percent': 100}
+
+
+@pytest.mark.django_db
+def test_rating_filter_agrees_with_facet_count(client, catalog):
+    category, sauces, items = catalog
+    # 799 / 200 = 3.995, stored as 4.00
+    for rating in [4] * 199 + [3]:
+        ratings.record(items['ranch'].id, added=rating)
+    response = client.get(reverse('shop:product_list'), {'rating': '4'})
+    assert names(response) == ['Ranch']
+    assert response.context['result_count'] == 1
+    assert facets.index.counts(None, facets.parse_filters({}))['rating'][4] == 1
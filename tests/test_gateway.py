@@ -0,0 +1,94 @@
+import socket
+import pytest
+import requests
+from shop.fake_mercadopago import FakeMercadoPago
+from shop.gateway import CircuitBreaker, GatewayUnavailable, get_gateway
+
+
+@pytest.fixture
+def gateway(settings):
+    settings.MERCADOPAGO_GATEWAY = 'shop.gateway.MercadoPagoGateway'
+    settings.MERCADOPAGO_BREAKER_THRESHOLD = 2
+    settings.MERCADOPAGO_BREAKER_RESET = 60
+    return settings
+
+
+def _closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_gateway_is_shared_and_reuses_connections(gateway):
+    with FakeMercadoPago() as server:
+        gateway.MERCADOPAGO_API_URL = server.url
+        server.payments['7'] = {'id': 7, 'status': 'approved'}
+        assert get_gateway() is get_gateway()
+        for _ in range(5):
+            assert get_gateway().get_payment(7) == {'status': 200,
+                                                    'response': {'id': 7, 'status': 'approved'}}
+        response = get_gateway().create_preference({'items': []})
+        assert response['status'] == 201
+
+    assert len(server.requests) == 6
+    assert len(server.connections) == 1
+    stats = get_gateway().stats()
+    assert stats['calls'] == 6
+    assert stats['failures'] == 0
+    assert stats['max_ms'] >= stats['avg_ms'] > 0
+
+
+def test_gateway_calls_time_out(gateway):
+    gateway.MERCADOPAGO_TIMEOUT = (1, 0.05)
+    with FakeMercadoPago(latency=0.3) as server:
+        gateway.MERCADOPAGO_API_URL = server.url
+        with pytest.raises(requests.Timeout):
+            get_gateway().get_payment(1)
+    assert get_gateway().stats()['failures'] == 1
+
+
+def test_circuit_breaker_fails_fast(gateway):
+    gateway.MERCADOPAGO_API_URL = f'http://127.0.0.1:{_closed_port()}'
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            get_gateway().get_merchant_order(1)
+    with pytest.raises(GatewayUnavailable):
+        get_gateway().get_merchant_order(1)
+
+    stats = get_gateway().stats()
+    assert stats['calls'] == 3
+    assert stats['failures'] == 2
+    assert stats['rejected'] == 1
+
+
+def test_circuit_breaker_probes_after_the_reset_timeout(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr('shop.gateway.time.monotonic', lambda: clock[0])
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+    breaker.record(False)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock[0] += 30
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only one trial call at a time
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_stub_gateway(payment_gateway):
+    payment_gateway.payments['3'] = {'id': 3, 'status': 'approved'}
+    assert payment_gateway.get_payment(3)['response']['status'] == 'approved'
+    assert payment_gateway.get_merchant_order(3)['status'] == 404
+    assert payment_gateway.create_preference({'items': []})['response']['id'] == 'stub-1'
+    assert payment_gateway.stats()['calls'] == 3
@@ -0,0 +1,182 @@
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from shop import inventory
+from shop.models import Order, OrderItem, Product
+
+
+ORDER_DATA = {
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'email': 'john@example.com',
+    'address': '123 Test Street',
+    'celular': '1234567890',
+}
+
+
+def _place_order(client, product, quantity):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': quantity, 'update': False})
+    return client.post(reverse('shop:order_create'), ORDER_DATA)
+
+
+@pytest.mark.django_db
+def test_order_reserves_stock_and_payment_commits_it(client, product):
+    _place_order(client, product, 3)
+    order = Order.objects.get()
+    product.refresh_from_db()
+    assert product.stock == 7
+    assert order.stock_status == Order.STOCK_RESERVED
+    assert order.reserved_until > timezone.now()
+
+    client.get(reverse('shop:payment_success', args=[order.id]))
+    client.get(reverse('shop:payment_success', args=[order.id]))
+    order.refresh_from_db()
+    product.refresh_from_db()
+    assert order.stock_status == Order.STOCK_COMMITTED
+    assert product.stock == 7
+
+
+@pytest.mark.django_db
+def test_payment_failure_releases_stock(client, product):
+    _place_order(client, product, 3)
+    order = Order.objects.get()
+
+    client.get(reverse('shop:payment_failure', args=[order.id]))
+    client.get(reverse('shop:payment_failure', args=[order.id]))
+    product.refresh_from_db()
+    assert product.stock == 10
+    order.refresh_from_db()
+    assert order.stock_status == Order.STOCK_RELEASED
+
+    # A payment that arrives late takes the stock again
+    assert inventory.commit(order)
+    product.refresh_from_db()
+    assert product.stock == 7
+
+
+@pytest.mark.django_db
+def test_payment_failure_only_releases_own_orders(client, product):
+    _place_order(client, product, 3)
+    order = Order.objects.get()
+
+    stranger = Client()
+    assert stranger.get(reverse('shop:payment_failure', args=[order.id])).status_code == 404
+    product.refresh_from_db()
+    assert product.stock == 7
+    order.refresh_from_db()
+    assert order.stock_status == Order.STOCK_RESERVED
+
+
+@pytest.mark.django_db
+def test_order_is_refused_when_stock_ran_out(client, product, category):
+    other = Product.objects.create(category=category, name='Other', slug='other',
+                                   price=Decimal('5.00'), stock=10)
+    client.post(reverse('cart:cart_add', args=[other.id]), {'quantity': 2, 'update': False})
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 4, 'update': False})
+    Product.objects.filter(pk=product.pk).update(stock=3)
+
+    response = client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert response.status_code == 302
+    assert response.url == reverse('cart:cart_detail')
+    assert not Order.objects.exists()
+    other.refresh_from_db()
+    assert other.stock == 10
+
+
+@pytest.mark.django_db
+def test_release_expired_reservations(client, product):
+    _place_order(client, product, 2)
+    order = Order.objects.get()
+    Order.objects.filter(pk=order.pk).update(reserved_until=timezone.now() - timedelta(minutes=1))
+
+    call_command('release_expired_reservations')
+    product.refresh_from_db()
+    assert product.stock == 10
+    assert Order.objects.get().stock_status == Order.STOCK_RELEASED
+
+
+@pytest.mark.django_db
+def test_refused_reservation_leaves_facets_alone(category, django_capture_on_commit_callbacks):
+    from shop import facets
+    wings = Product.objects.create(category=category, name='Wings', slug='wings',
+                                   price=Decimal('8.00'), stock=2)
+    sauce = Product.objects.create(category=category, name='Sauce', slug='sauce',
+                                   price=Decimal('1.00'), stock=1)
+    filters = facets.parse_filters({})
+    assert facets.index.counts(None, filters)['in_stock'] == 2
+
+    with django_capture_on_commit_callbacks(execute=True):
+        with pytest.raises(inventory.InsufficientStock):
+            inventory.reserve(Order(), [(wings.id, 2), (sauce.id, 5)])
+    wings.refresh_from_db()
+    assert wings.stock == 2
+    assert facets.index.counts(None, filters)['in_stock'] == 2
+
+    with django_capture_on_commit_callbacks(execute=True):
+        inventory.reserve(Order(), [(wings.id, 2)])
+    assert facets.index.counts(None, filters)['in_stock'] == 1
+
+
+def _in_thread(work):
+    """
+    Run `work` from a worker thread. The in-memory test database fails
+    writes that collide with another transaction instead of waiting, so
+    those attempts are retried the way a busy timeout would.
+    """
+    def run(_):
+        try:
+            while True:
+                try:
+                    return work()
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    time.sleep(0.001)
+        finally:
+            connection.close()
+    return run
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_reservations_never_oversell(category):
+    product = Product.objects.create(category=category, name='Wings', slug='wings',
+                                     price=Decimal('8.00'), stock=5)
+
+    def reserve():
+        try:
+            inventory.reserve(Order(), [(product.id, 1)])
+            return True
+        except inventory.InsufficientStock:
+            return False
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(_in_thread(reserve), range(30)))
+
+    product.refresh_from_db()
+    assert results.count(True) == 5
+    assert product.stock == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_payment_notifications_commit_once(category):
+    product = Product.objects.create(category=category, name='Wings', slug='wings',
+                                     price=Decimal('8.00'), stock=5)
+    order = Order.objects.create(**ORDER_DATA)
+    OrderItem.objects.create(order=order, product=product, price=product.price, quantity=2)
+
+    def commit():
+        return inventory.commit(Order.objects.get(pk=order.pk))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(_in_thread(commit), range(20)))
+
+    product.refresh_from_db()
+    assert results.count(True) == 1
+    assert product.stock == 3
@@ -0,0 +1,283 @@
+import time
+import pytest
+from datetime import timedelta
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from shop import notifications, tasks
+from shop.gateway import GatewayUnavailable, get_gateway
+from shop.models import Order, PaymentNotification
+from shop.notifications import sign
+
+
+ORDER_DATA = {
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'email': 'john@example.com',
+    'address': '123 Test Street',
+    'celular': '1234567890',
+}
+
+
+@pytest.fixture
+def pending_order(db, product):
+    order = Order.objects.create(**ORDER_DATA)
+    order.items.create(product=product, price=product.price, quantity=2)
+    return order
+
+
+@pytest.fixture
+def queue_only(monkeypatch):
+    """
+    Queue notifications without processing them.
+    """
+    monkeypatch.setattr(tasks, 'submit', lambda func, *args: None)
+
+
+@pytest.mark.django_db
+def test_duplicate_webhooks_are_processed_once(client, signed_webhook, pending_order, product,
+                                               payment_gateway, queue_only,
+                                               django_assert_num_queries):
+    payment_gateway.payments['42'] = {'id': 42, 'status': 'approved',
+                                      'external_reference': str(pending_order.id)}
+
+    assert signed_webhook('42').status_code == 200
+    with django_assert_num_queries(0):
+        for _ in range(4):
+            assert signed_webhook('42').status_code == 200
+    assert notifications.process_pending() == 1
+
+    notification = PaymentNotification.objects.get()
+    assert (notification.topic, notification.resource_id) == ('payment', '42')
+    assert notification.status == PaymentNotification.STATUS_DONE
+    assert notification.order == pending_order
+    assert payment_gateway.requests == [('get_payment', '42')]
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+    assert pending_order.stock_status == Order.STOCK_COMMITTED
+    product.refresh_from_db()
+    assert product.stock == 8
+
+
+@pytest.mark.django_db
+def test_duplicates_are_rejected_by_the_database(signed_webhook, queue_only):
+    signed_webhook('42')
+    notifications.recent.clear()
+    signed_webhook('42')
+    assert PaymentNotification.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_later_notification_reprocesses_the_resource(signed_webhook, pending_order,
+                                                     payment_gateway):
+    payment_gateway.payments['77'] = {'id': 77, 'status': 'in_process',
+                                      'external_reference': str(pending_order.id)}
+    signed_webhook('77')
+    pending_order.refresh_from_db()
+    assert not pending_order.paid
+
+    payment_gateway.payments['77']['status'] = 'approved'
+    signed_webhook('77')
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+    assert payment_gateway.requests == [('get_payment', '77')] * 2
+    assert PaymentNotification.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_notification_during_processing_is_requeued(signed_webhook, pending_order,
+                                                    payment_gateway, queue_only, monkeypatch):
+    payment = {'id': 77, 'status': 'in_process', 'external_reference': str(pending_order.id)}
+
+    def approve_while_fetching(payment_id):
+        response = {'status': 200, 'response': dict(payment)}
+        if payment['status'] != 'approved':
+            payment['status'] = 'approved'
+            signed_webhook('77')
+        return response
+    monkeypatch.setattr(payment_gateway, 'get_payment', approve_while_fetching)
+
+    signed_webhook('77')
+    notifications.process_pending()
+    notification = PaymentNotification.objects.get()
+    assert notification.status == PaymentNotification.STATUS_PENDING
+    assert not notification.dirty
+    pending_order.refresh_from_db()
+    assert not pending_order.paid
+
+    notifications.process_pending()
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+
+
+@pytest.mark.django_db
+def test_stale_claims_are_processed_again(pending_order, payment_gateway):
+    payment_gateway.payments['42'] = {'id': 42, 'status': 'approved',
+                                      'external_reference': str(pending_order.id)}
+    PaymentNotification.objects.create(topic='payment', resource_id='42', claim='lost',
+                                       status=PaymentNotification.STATUS_PROCESSING,
+                                       claimed=timezone.now() - timedelta(seconds=60))
+    assert notifications.process_pending() == 0
+
+    PaymentNotification.objects.update(claimed=timezone.now() - timedelta(hours=1))
+    call_command('process_payment_notifications')
+    assert PaymentNotification.objects.get().status == PaymentNotification.STATUS_DONE
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+
+
+@pytest.mark.django_db
+def test_merchant_order_settles_its_payments(signed_webhook, pending_order, payment_gateway,
+                                             queue_only):
+    payment_gateway.merchant_orders['7'] = {
+        'id': 7, 'external_reference': str(pending_order.id), 'total_amount': 39.98,
+        'payments': [{'id': 42, 'status': 'approved', 'transaction_amount': 39.98}],
+    }
+    signed_webhook('42')
+    signed_webhook('7', topic='merchant_order')
+
+    assert notifications.process_pending() == 2
+    assert payment_gateway.requests == [('get_merchant_order', '7')]
+    assert set(PaymentNotification.objects.values_list('status', flat=True)) == {
+        PaymentNotification.STATUS_DONE}
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+
+
+@pytest.mark.django_db
+def test_failed_notifications_are_retried(signed_webhook, pending_order, settings):
+    settings.MERCADOPAGO_NOTIFICATION_ATTEMPTS = 2
+    payment_gateway = get_gateway()
+    payment_gateway.payments['42'] = {'id': 42, 'status': 'approved',
+                                      'external_reference': str(pending_order.id)}
+    payment_gateway.error = OSError('down')
+    assert signed_webhook('42').status_code == 200
+
+    notification = PaymentNotification.objects.get()
+    assert notification.status == PaymentNotification.STATUS_PENDING
+    assert notification.attempts == 1
+    assert notification.next_attempt > timezone.now()
+
+    # Not retried before its time
+    payment_gateway.error = None
+    call_command('process_payment_notifications')
+    notification.refresh_from_db()
+    assert notification.status == PaymentNotification.STATUS_PENDING
+
+    PaymentNotification.objects.update(next_attempt=timezone.now())
+    call_command('process_payment_notifications')
+    notification.refresh_from_db()
+    assert notification.status == PaymentNotification.STATUS_DONE
+    pending_order.refresh_from_db()
+    assert pending_order.paid
+
+
+@pytest.mark.django_db
+def test_notification_gives_up_after_max_attempts(signed_webhook, settings):
+    settings.MERCADOPAGO_NOTIFICATION_ATTEMPTS = 2
+    payment_gateway = get_gateway()
+    payment_gateway.error = OSError('down')
+    signed_webhook('42')
+    call_command('process_payment_notifications')
+    notification = PaymentNotification.objects.get()
+    assert notification.status == PaymentNotification.STATUS_PENDING
+    assert notification.attempts == 1
+    first_delay = notification.next_attempt - timezone.now()
+
+    PaymentNotification.objects.update(next_attempt=timezone.now())
+    call_command('process_payment_notifications')
+    notification.refresh_from_db()
+    assert notification.status == PaymentNotification.STATUS_FAILED
+    assert notification.attempts == 2
+    assert first_delay > timedelta(seconds=settings.MERCADOPAGO_NOTIFICATION_RETRY_DELAY - 5)
+
+
+@pytest.mark.django_db
+def test_open_circuit_does_not_count_as_an_attempt(signed_webhook, settings):
+    payment_gateway = get_gateway()
+    payment_gateway.error = GatewayUnavailable('open')
+    signed_webhook('42')
+    call_command('process_payment_notifications')
+
+    notification = PaymentNotification.objects.get()
+    assert notification.status == PaymentNotification.STATUS_PENDING
+    assert notification.attempts == 0
+    assert notification.next_attempt > timezone.now()
+
+
+@pytest.mark.django_db
+def test_requests_without_a_resource_are_ignored(client, settings):
+    settings.MERCADOPAGO_WEBHOOK_SECRET = ''
+    assert client.post(reverse('shop:mercadopago_webhook'), data={'type': 'test'},
+                       content_type='application/json').status_code == 200
+    assert client.get(reverse('shop:mercadopago_ipn')).status_code == 200
+    assert client.get(reverse('shop:mercadopago_webhook')).status_code == 405
+    assert not PaymentNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_ipn_requests_are_acknowledged_without_queries(client, payment_gateway,
+                                                       django_assert_num_queries):
+    with django_assert_num_queries(0):
+        for _ in range(5):
+            assert client.get(reverse('shop:mercadopago_ipn'),
+                              {'topic': 'payment', 'id': '42'}).status_code == 200
+        assert client.post(reverse('shop:mercadopago_ipn') +
+                           '?topic=merchant_order&id=7').status_code == 200
+    assert payment_gateway.requests == []
+    assert not PaymentNotification.objects.exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('headers', [
+    {},
+    {'x-signature': 'ts=1,v1=abc'},
+    {'x-signature': f'ts={int(time.time())},v1={"0" * 64}'},
+    {'x-signature': 'garbage'},
+])
+def test_unsigned_webhooks_are_rejected_without_queries(client, payment_gateway, headers,
+                                                        django_assert_num_queries):
+    with django_assert_num_queries(0):
+        response = client.post(reverse('shop:mercadopago_webhook'),
+                               data={'type': 'payment', 'data': {'id': '42'}},
+                               content_type='application/json', headers=headers)
+    assert response.status_code == 401
+    assert payment_gateway.requests == []
+
+
+@pytest.mark.django_db
+def test_signature_covers_the_resource(client, payment_gateway):
+    ts = str(int(time.time()))
+    response = client.post(reverse('shop:mercadopago_webhook'),
+                           data={'type': 'payment', 'data': {'id': '43'}},
+                           content_type='application/json',
+                           headers={'x-request-id': 'abc',
+                                    'x-signature': f'ts={ts},v1={sign("42", "abc", ts)}'})
+    assert response.status_code == 401
+    assert not PaymentNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_replayed_signature_is_dropped(client, payment_gateway, queue_only):
+    ts = str(int(time.time() * 1000))
+    headers = {'x-request-id': 'abc', 'x-signature': f'ts={ts},v1={sign("42", "abc", ts)}'}
+
+    def post():
+        return client.post(reverse('shop:mercadopago_webhook') + '?data.id=42&type=payment',
+                           content_type='application/json', headers=headers)
+
+    assert post().status_code == 200
+    notifications.recent.clear()
+    PaymentNotification.objects.all().delete()
+    assert post().status_code == 200
+    assert not PaymentNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_signature_check_can_be_turned_off(client, settings, queue_only):
+    settings.MERCADOPAGO_WEBHOOK_SECRET = ''
+    response = client.post(reverse('shop:mercadopago_webhook'),
+                           data={'type': 'payment', 'data': {'id': '42'}},
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert PaymentNotification.objects.count() == 1
@@ -1,8 +1,15 @@
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from django.urls import reverse
 from django.core import mail
+from django.db import connection
+from django.utils import timezone
 from decimal import Decimal
-from shop.models import Order, OrderItem, Product
+from shop import coupons
+from shop.models import Order, OrderItem, Product, Coupon, CouponRedemption
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from cart.cart import Cart
 
 
@@ -213,3 +220,200 @@ def test_cart_cleared_after_payment(client, user, product):
 
     cart = Cart(client)
     assert len(cart) == 0
+
+
+ORDER_DATA = {
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'email': 'john@example.com',
+    'address': '123 Test Street',
+    'celular': '1234567890',
+}
+
+
+@pytest.mark.django_db
+def test_coupon_use_is_counted_when_the_order_is_placed(client, product, valid_coupon):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': 'testcode'})
+    valid_coupon.refresh_from_db()
+    assert valid_coupon.used_count == 0
+
+    response = client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert response.status_code == 200
+    valid_coupon.refresh_from_db()
+    assert valid_coupon.used_count == 1
+    order = Order.objects.get()
+    assert order.coupon == valid_coupon
+    assert order.discount == (product.price * 2 * Decimal('0.2')).quantize(Decimal('0.01'))
+    assert order.get_total_cost() == product.price * 2 - order.discount
+
+
+@pytest.mark.django_db
+def test_used_up_coupon_is_rejected_at_checkout(client, product, valid_coupon):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+    Coupon.objects.filter(pk=valid_coupon.pk).update(used_count=valid_coupon.usage_limit)
+
+    response = client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert response.status_code == 302
+    assert response.url == reverse('cart:cart_detail')
+    assert not Order.objects.exists()
+    assert Cart(client).coupon is None
+
+
+@pytest.mark.django_db
+def test_coupon_code_is_normalized(valid_coupon):
+    assert valid_coupon.code_normalized == 'TESTCODE'
+    assert coupons.lookup('  testCode ') == valid_coupon
+    assert coupons.lookup('') is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_redemptions_never_exceed_the_usage_limit():
+    now = timezone.now()
+    coupon = Coupon.objects.create(code='RUSH', discount_percent=10,
+                                   valid_from=now - timedelta(days=1),
+                                   valid_to=now + timedelta(days=1),
+                                   usage_limit=5)
+
+    def redeem(_):
+        try:
+            return coupons.redeem(coupon)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(redeem, range(40)))
+
+    coupon.refresh_from_db()
+    assert results.count(True) == 5
+    assert coupon.used_count == 5
+
+
+@pytest.mark.django_db
+def test_coupon_redemptions_are_recorded(client, user, product, valid_coupon):
+    client.force_login(user)
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+    client.post(reverse('shop:order_create'), dict(ORDER_DATA, email='John@Example.com'))
+
+    redemption = CouponRedemption.objects.get()
+    assert redemption.order == Order.objects.get()
+    assert redemption.user == user
+    assert redemption.email == 'john@example.com'
+
+
+@pytest.mark.django_db
+def test_once_per_customer_coupon(client, user, product, valid_coupon):
+    valid_coupon.once_per_customer = True
+    valid_coupon.save()
+    client.force_login(user)
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+    client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert Order.objects.get().coupon == valid_coupon
+
+    response = client.post(reverse('cart:api_apply_coupon'), {'coupon_code': valid_coupon.code})
+    assert response.status_code == 400
+    assert response.json()['error'] == 'You have already used this coupon.'
+
+
+@pytest.mark.django_db
+def test_once_per_customer_coupon_checks_guest_email(client, product, valid_coupon):
+    valid_coupon.once_per_customer = True
+    valid_coupon.save()
+    for _ in range(2):
+        client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+        client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+        response = client.post(reverse('shop:order_create'), ORDER_DATA)
+
+    assert response.status_code == 302
+    assert response.url == reverse('cart:cart_detail')
+    assert Order.objects.count() == 1
+    valid_coupon.refresh_from_db()
+    assert valid_coupon.used_count == 1
+
+
+@pytest.mark.django_db
+def test_active_coupons_are_cached(valid_coupon, expired_coupon, django_capture_on_commit_callbacks):
+    assert coupons.lookup('testcode') == valid_coupon
+    with CaptureQueriesContext(connection) as queries:
+        assert coupons.lookup('TESTCODE') == valid_coupon
+    assert len(queries) == 0
+    assert coupons.lookup('EXPIRED') == expired_coupon
+
+    valid_coupon.active = False
+    with django_capture_on_commit_callbacks(execute=True):
+        valid_coupon.save()
+    assert 'TESTCODE' not in coupons.active()
+
+
+def _checkout_queries(client, products):
+    for item in products:
+        client.post(reverse('cart:cart_add', args=[item.id]), {'quantity': 1, 'update': False})
+    client.get(reverse('cart:cart_detail'))
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert response.status_code == 200
+    return len(queries)
+
+
+@pytest.mark.django_db
+def test_checkout_query_count_does_not_depend_on_cart_size(client, category, valid_coupon):
+    products = [Product.objects.create(category=category, name=f'Product {n}', slug=f'product-{n}',
+                                       price=Decimal('10.00'), stock=10)
+                for n in range(6)]
+    client.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+    small = _checkout_queries(client, products[:1])
+
+    other = Client()
+    other.post(reverse('cart:apply_coupon'), {'coupon_code': valid_coupon.code})
+    large = _checkout_queries(other, products[1:])
+
+    assert small == large
+    order = Order.objects.order_by('-id').first()
+    assert order.items.count() == 5
+    assert order.get_total_cost() == Decimal('40.00')
+
+
+@pytest.mark.django_db
+def test_checkout_form_issues_an_idempotency_key(client, product):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    first = client.get(reverse('shop:order_create')).context['idempotency_key']
+    second = client.get(reverse('shop:order_create')).context['idempotency_key']
+    assert len(first) >= 16
+    assert first != second
+
+
+@pytest.mark.django_db
+def test_resubmitted_checkout_returns_the_placed_order(client, product, payment_gateway):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+    data = dict(ORDER_DATA, idempotency_key='k' * 32)
+    first = client.post(reverse('shop:order_create'), data)
+
+    with CaptureQueriesContext(connection) as queries:
+        second = client.post(reverse('shop:order_create'), data)
+    assert second.status_code == 200
+    assert second.context['order'].id == first.context['order'].id
+    assert second.context['total'] == product.price * 2
+    assert not [q for q in queries.captured_queries if 'shop_order' in q['sql']]
+    assert Order.objects.count() == 1
+    assert OrderItem.objects.count() == 1
+    assert len(payment_gateway.preferences) == 1
+    product.refresh_from_db()
+    assert product.stock == 8
+
+
+@pytest.mark.django_db
+def test_resubmitted_checkout_falls_back_to_the_database(client, product):
+    from django.core.cache import cache
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    data = dict(ORDER_DATA, idempotency_key='k' * 32)
+    client.post(reverse('shop:order_create'), data)
+    cache.clear()
+
+    response = client.post(reverse('shop:order_create'), data)
+    assert response.status_code == 200
+    assert response.context['order'] == Order.objects.get()
+    assert response.context['total'] == product.price
+    assert Order.objects.count() == 1
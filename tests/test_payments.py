@@ -0,0 +1,119 @@
+import time
+import pytest
+from decimal import Decimal
+from django.test import Client
+from django.urls import reverse
+from shop.fake_mercadopago import FakeMercadoPago
+from shop import payments
+from shop.models import Order, Product
+
+
+ORDER_DATA = {
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'email': 'john@example.com',
+    'address': '123 Test Street',
+    'celular': '1234567890',
+}
+
+
+@pytest.fixture
+def fake_mercadopago(settings):
+    with FakeMercadoPago() as server:
+        settings.MERCADOPAGO_GATEWAY = 'shop.gateway.MercadoPagoGateway'
+        settings.MERCADOPAGO_API_URL = server.url
+        yield server
+
+
+def _wait_for_preference(order_id):
+    for _ in range(200):
+        order = Order.objects.get(pk=order_id)
+        if order.preference_status != Order.PREFERENCE_PENDING:
+            return order
+        time.sleep(0.01)
+    raise AssertionError('The preference was never created')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_checkout_creates_the_preference_in_the_background(client, category, settings,
+                                                           fake_mercadopago):
+    settings.MERCADOPAGO_WORKERS = 2
+    fake_mercadopago.latency = 0.2
+    product = Product.objects.create(category=category, name='Wings', slug='wings',
+                                     price=Decimal('8.00'), stock=5)
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 2, 'update': False})
+
+    start = time.perf_counter()
+    response = client.post(reverse('shop:order_create'), ORDER_DATA)
+    assert time.perf_counter() - start < fake_mercadopago.latency
+    assert response.status_code == 200
+    order = response.context['order']
+    assert order.preference_status == Order.PREFERENCE_PENDING
+    assert 'Preparando el pago' in response.content.decode()
+
+    order = _wait_for_preference(order.id)
+    assert order.preference_status == Order.PREFERENCE_READY
+    preference = fake_mercadopago.preferences[order.preference_id]
+    assert preference['external_reference'] == str(order.id)
+    assert preference['items'] == [{'title': 'Wings', 'quantity': 2, 'unit_price': 8.0}]
+
+    status = client.get(reverse('shop:payment_status', args=[order.id])).json()
+    assert status == {'status': 'ready', 'preference_id': order.preference_id,
+                      'init_point': order.init_point}
+
+
+@pytest.mark.django_db
+def test_failed_preference_is_reported(client, product, payment_gateway):
+    payment_gateway.error = OSError('down')
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    response = client.post(reverse('shop:order_create'), ORDER_DATA)
+
+    order = Order.objects.get()
+    assert order.preference_status == Order.PREFERENCE_FAILED
+    assert 'Error al crear preferencia de pago' in response.content.decode()
+    assert client.get(reverse('shop:payment_status', args=[order.id])).json()['status'] == 'failed'
+
+
+@pytest.mark.django_db
+def test_payment_status_is_private(client, product):
+    client.post(reverse('cart:cart_add', args=[product.id]), {'quantity': 1, 'update': False})
+    client.post(reverse('shop:order_create'), ORDER_DATA)
+    order = Order.objects.get()
+
+    assert client.get(reverse('shop:payment_status', args=[order.id])).status_code == 200
+    assert Client().get(reverse('shop:payment_status', args=[order.id])).status_code == 404
+
+
+@pytest.mark.django_db
+def test_webhook_reads_payments_from_the_fake_api(product, fake_mercadopago, signed_webhook):
+    order = Order.objects.create(**ORDER_DATA)
+    order.items.create(product=product, price=product.price, quantity=1)
+    fake_mercadopago.payments['42'] = {'id': 42, 'status': 'approved',
+                                       'external_reference': str(order.id)}
+
+    response = signed_webhook('42')
+    assert response.status_code == 200
+    order.refresh_from_db()
+    assert order.paid
+    assert ('GET', '/v1/payments/42') in fake_mercadopago.requests
+
+
+@pytest.mark.django_db
+def test_lost_preferences_are_created_again(product, payment_gateway):
+    from datetime import timedelta
+    from django.core.management import call_command
+    from django.utils import timezone
+    order = Order.objects.create(**ORDER_DATA)
+    order.items.create(product=product, price=product.price, quantity=2)
+    fresh = Order.objects.create(**ORDER_DATA)
+    Order.objects.filter(pk=order.pk).update(updated=timezone.now() - timedelta(minutes=10))
+
+    call_command('retry_payment_preferences')
+    order.refresh_from_db()
+    assert order.preference_status == Order.PREFERENCE_READY
+    preference = payment_gateway.preferences[order.preference_id]
+    assert preference['external_reference'] == str(order.id)
+    assert preference['items'] == [{'title': 'Test Product', 'quantity': 2, 'unit_price': 19.99}]
+    fresh.refresh_from_db()
+    assert fresh.preference_status == Order.PREFERENCE_PENDING
+    assert payments.retry_stale() == 0
@@ -84,3 +84,61 @@ def test_product_creation(product, category):
     assert product.category == category
     assert product.available is True
     assert product.stock == 10
+
+
+@pytest.fixture
+def many_products(db, category):
+    return Product.objects.bulk_create([
+        Product(category=category,
+                name=f'Product {i:02d}',
+                slug=f'product-{i:02d}',
+                price=Decimal('1.00'),
+                stock=1)
+        for i in range(30)
+    ])
+
+
+@pytest.mark.django_db
+def test_product_list_is_paginated(client, many_products, settings):
+    settings.PRODUCTS_PER_PAGE = 12
+    response = client.get(reverse('shop:product_list'))
+    page = response.context['page']
+    assert [p.name for p in page] == [f'Product {i:02d}' for i in range(12)]
+    assert page.has_next()
+    assert not page.has_previous()
+
+
+@pytest.mark.django_db
+def test_product_list_cursor_navigation(client, many_products, settings):
+    settings.PRODUCTS_PER_PAGE = 12
+    first = client.get(reverse('shop:product_list')).context['page']
+    second = client.get(reverse('shop:product_list'),
+                        {'cursor': first.next_cursor}).context['page']
+    assert [p.name for p in second] == [f'Product {i:02d}' for i in range(12, 24)]
+    third = client.get(reverse('shop:product_list'),
+                       {'cursor': second.next_cursor}).context['page']
+    assert len(third) == 6
+    assert not third.has_next()
+
+    back = client.get(reverse('shop:product_list'),
+                      {'cursor': third.previous_cursor}).context['page']
+    assert [p.id for p in back] == [p.id for p in second]
+
+
+@pytest.mark.django_db
+def test_product_list_invalid_cursor_shows_first_page(client, many_products):
+    response = client.get(reverse('shop:product_list'), {'cursor': 'not-a-cursor'})
+    assert response.status_code == 200
+    assert not response.context['page'].has_previous()
+
+
+@pytest.mark.django_db
+def test_product_list_json(client, many_products, settings):
+    settings.PRODUCTS_PER_PAGE = 10
+    data = client.get(reverse('shop:product_list_json')).json()
+    assert len(data['results']) == 10
+    assert data['previous'] is None
+
+    data = client.get(reverse('shop:product_list_json'), {'cursor': data['next']}).json()
+    assert data['results'][0]['name'] == 'Product 10'
+    assert data['previous'] is not None
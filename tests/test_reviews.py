@@ -1,7 +1,14 @@
 import pytest
 from django.urls import reverse
 from django.core.exceptions import ValidationError
-from shop.models import Review
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
+from shop import ratings
+from shop.models import Product, Review
 
 
 @pytest.mark.django_db
@@ -91,3 +98,126 @@ def test_review_requires_login(client, product):
         {'rating': 5, 'comment': 'Test review'}
     )
     assert not Review.objects.filter(product=product).exists()
+
+
+@pytest.fixture
+def many_reviews(db, product, settings):
+    settings.REVIEWS_PER_PAGE = 3
+    users = User.objects.bulk_create(
+        [User(username=f'reviewer{i}') for i in range(7)])
+    return Review.objects.bulk_create(
+        [Review(product=product, user=u, rating=(i % 5) + 1, comment=f'Comment {i}')
+         for i, u in enumerate(users)])
+
+
+@pytest.mark.django_db
+def test_product_detail_shows_first_page_of_reviews(client, product, many_reviews):
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse('shop:product_detail', args=[product.id, product.slug]))
+    content = response.content.decode()
+    assert content.count('estrellas</h5>') == 3
+    assert 'Ver más reseñas' in content
+    assert not [q for q in queries.captured_queries if '"auth_user"' in q['sql']
+                and 'shop_review' not in q['sql']]
+
+
+@pytest.mark.django_db
+def test_more_reviews_endpoint_walks_all_reviews(client, product, many_reviews):
+    url = reverse('shop:product_reviews', args=[product.id])
+    seen = []
+    data = client.get(url).json()
+    seen += data['results']
+    while data['next']:
+        data = client.get(url, {'cursor': data['next']}).json()
+        seen += data['results']
+    assert len(seen) == 7
+    assert len({r['id'] for r in seen}) == 7
+    assert [r['created_at'] for r in seen] == sorted((r['created_at'] for r in seen), reverse=True)
+    assert seen[0]['user'].startswith('reviewer')
+
+
+@pytest.mark.django_db
+def test_more_reviews_endpoint_unavailable_product(client, product):
+    product.available = False
+    product.save()
+    response = client.get(reverse('shop:product_reviews', args=[product.id]))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_rating_counters_follow_review_changes(product, user, another_user):
+    first = Review.objects.create(product=product, user=user, rating=5, comment='Great')
+    Review.objects.create(product=product, user=another_user, rating=2, comment='Meh')
+    product.refresh_from_db()
+    assert (product.total_reviews, product.rating_sum) == (2, 7)
+    assert (product.rating_5, product.rating_2) == (1, 1)
+    assert product.average_rating == Decimal('3.50')
+
+    first.rating = 4
+    first.save()
+    product.refresh_from_db()
+    assert (product.total_reviews, product.rating_sum, product.rating_5, product.rating_4) == (2, 6, 0, 1)
+    assert product.average_rating == Decimal('3.00')
+
+    first.delete()
+    Review.objects.get(user=another_user).delete()
+    product.refresh_from_db()
+    assert (product.total_reviews, product.rating_sum, product.rating_2) == (0, 0, 0)
+    assert product.average_rating == Decimal('0.00')
+
+
+@pytest.mark.django_db
+def test_rating_update_does_not_overwrite_stock(product, user):
+    stale = Product.objects.get(pk=product.pk)
+    Product.objects.filter(pk=product.pk).update(stock=3)
+    Review.objects.create(product=stale, user=user, rating=4, comment='Fine')
+    product.refresh_from_db()
+    assert product.stock == 3
+    assert product.total_reviews == 1
+
+
+@pytest.mark.django_db
+def test_reconcile_ratings(product, user, another_user):
+    Review.objects.bulk_create([
+        Review(product=product, user=user, rating=5, comment='a'),
+        Review(product=product, user=another_user, rating=4, comment='b'),
+    ])
+    call_command('reconcile_ratings', stdout=StringIO())
+    product.refresh_from_db()
+    assert (product.total_reviews, product.rating_sum, product.rating_5, product.rating_4) == (2, 9, 1, 1)
+    assert product.average_rating == Decimal('4.50')
+    assert ratings.reconcile() == 0
+
+
+@pytest.mark.django_db
+def test_stored_ratings_are_rounded(product, user, another_user):
+    third = User.objects.create_user(username='third', password='pass')
+    for reviewer, rating in ((user, 5), (another_user, 4), (third, 4)):
+        Review.objects.create(product=product, user=reviewer, rating=rating, comment='ok')
+    row = Product.objects.filter(pk=product.pk).values_list('average_rating',
+                                                            'weighted_rating').get()
+    assert row == (Decimal('4.33'), Decimal('3.5000'))
+    # The stored values compare equal to what is read back
+    assert Product.objects.filter(pk=product.pk, average_rating=row[0],
+                                  weighted_rating=row[1]).exists()
+
+
+@pytest.mark.django_db
+def test_rating_sort_pages_through_equal_scores(client, category, user, settings):
+    settings.PRODUCTS_PER_PAGE = 2
+    products = [Product.objects.create(category=category, name=f'Wings {i}', slug=f'wings-{i}',
+                                       price=Decimal('5.00'), stock=5) for i in range(5)]
+    for product in products:
+        Review.objects.create(product=product, user=user, rating=5, comment='Great')
+
+    seen, cursor = [], None
+    while True:
+        params = {'sort': 'rating'}
+        if cursor:
+            params['cursor'] = cursor
+        page = client.get(reverse('shop:product_list'), params).context['page']
+        seen += [p.id for p in page]
+        if not page.has_next():
+            break
+        cursor = page.next_cursor
+    assert sorted(seen) == [p.id for p in products]
@@ -0,0 +1,283 @@
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from decimal import Decimal
+from shop.models import Category, Product, ProductTrigram
+from shop import caching, search
+
+
+@pytest.fixture
+def menu(db, category):
+    sauces = Category.objects.create(name='Salsas', slug='salsas')
+    wings = Product.objects.create(
+        category=category,
+        name='Alitas Picantes',
+        slug='alitas-picantes',
+        description='Alitas con salsa picante de la casa',
+        price=Decimal('5.99'),
+        stock=10
+    )
+    sauce = Product.objects.create(
+        category=sauces,
+        name='Salsa Ranch',
+        slug='salsa-ranch',
+        description='Ideal para acompañar alitas',
+        price=Decimal('0.99'),
+        stock=10
+    )
+    return wings, sauce
+
+
+@pytest.mark.django_db
+def test_search_ranks_name_matches_first(client, menu):
+    wings, sauce = menu
+    response = client.get(reverse('shop:product_list'), {'q': 'alitas'})
+    assert list(response.context['products']) == [wings, sauce]
+
+
+@pytest.mark.django_db
+def test_search_matches_category_name(client, menu):
+    wings, sauce = menu
+    response = client.get(reverse('shop:product_list'), {'q': 'salsas'})
+    assert list(response.context['products']) == [sauce]
+
+
+@pytest.mark.django_db
+def test_search_prefix_terms(menu):
+    wings, sauce = menu
+    assert search.ranked_ids('alit pica') == [wings.id]
+
+
+@pytest.mark.django_db
+def test_search_index_follows_product_changes(menu):
+    wings, sauce = menu
+    wings.name = 'Muslos Crujientes'
+    wings.save()
+    assert search.ranked_ids('crujientes') == [wings.id]
+
+    wings.delete()
+    assert search.ranked_ids('crujientes') == []
+
+
+@pytest.mark.django_db
+def test_search_index_follows_category_rename(menu):
+    wings, sauce = menu
+    category = sauce.category
+    category.name = 'Aderezos'
+    category.save()
+    assert search.ranked_ids('aderezos') == [sauce.id]
+
+
+@pytest.mark.django_db
+def test_search_page_follows_category_rename(client, menu, django_capture_on_commit_callbacks):
+    wings, sauce = menu
+    assert list(client.get(reverse('shop:product_list'),
+                           {'q': 'aderezos'}).context['products']) == []
+    with django_capture_on_commit_callbacks(execute=True):
+        category = sauce.category
+        category.name = 'Aderezos'
+        category.save()
+    response = client.get(reverse('shop:product_list'), {'q': 'aderezos'})
+    assert list(response.context['products']) == [sauce]
+
+
+@pytest.mark.django_db
+def test_rebuild_search_index_command(menu):
+    wings, sauce = menu
+    call_command('rebuild_search_index')
+    assert set(search.ranked_ids('alitas')) == {wings.id, sauce.id}
+
+
+@pytest.mark.django_db
+def test_rebuild_command_without_fts_rebuilds_trigrams(menu, monkeypatch):
+    wings, sauce = menu
+    monkeypatch.setattr(search, '_fts_enabled', False)
+    monkeypatch.setattr(search, 'create_index', lambda: False)
+    ProductTrigram.objects.all().delete()
+    call_command('rebuild_search_index')
+    assert search.fuzzy_ids('alitsa picanets') == [wings.id]
+
+
+@pytest.mark.django_db
+def test_fuzzy_search_reads_a_bounded_number_of_products(category, settings):
+    settings.SEARCH_TRIGRAM_MAX_PRODUCTS = 3
+    for i in range(6):
+        Product.objects.create(category=category, name=f'Combo {i}',
+                               slug=f'combo-{i}', price=Decimal('1.00'))
+    assert len(search.fuzzy_ids('combi')) == 3
+
+
+@pytest.mark.django_db
+def test_search_ignores_fts_syntax(client, menu):
+    response = client.get(reverse('shop:product_list'), {'q': '"alitas OR NEAR('})
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_search_without_fts_matches_descriptions(client, menu, monkeypatch):
+    wings, sauce = menu
+    monkeypatch.setattr(search, '_fts_enabled', False)
+    response = client.get(reverse('shop:product_list'), {'q': 'acompañar'})
+    assert list(response.context['products']) == [sauce]
+    assert search.matching_ids('alitas') == [wings.id, sauce.id]
+    assert search.matching_ids('salsas') == [sauce.id]
+
+
+@pytest.mark.django_db
+def test_normalize_folds_accents_and_case():
+    assert search.normalize('Salsa "Seúl Nocturno"') == 'salsa seul nocturno'
+    assert search.normalize('Alitas CLÁSICAS (4 uds.)') == 'alitas clasicas 4 uds'
+
+
+@pytest.mark.django_db
+def test_search_without_accents(client, category):
+    product = Product.objects.create(
+        category=category,
+        name='Salsa "Seúl Nocturno"',
+        slug='salsa-seul-nocturno',
+        price=Decimal('0.99'),
+        stock=10
+    )
+    response = client.get(reverse('shop:product_list'), {'q': 'seul'})
+    assert list(response.context['products']) == [product]
+
+
+@pytest.mark.django_db
+def test_search_tolerates_typos(client, category):
+    product = Product.objects.create(
+        category=category,
+        name='Alitas Clásicas (4 uds.)',
+        slug='alitas-clasicas-4',
+        price=Decimal('5.99'),
+        stock=10
+    )
+    response = client.get(reverse('shop:product_list'), {'q': 'clasicsa'})
+    assert list(response.context['products']) == [product]
+
+
+@pytest.mark.django_db
+def test_trigrams_precomputed_on_save(product):
+    assert set(product.trigrams.values_list('trigram', flat=True)) == \
+        search.trigrams(f'{product.name} {product.category.name}')
+
+
+@pytest.mark.django_db
+def test_search_results_are_paginated_by_rank(client, category, settings):
+    settings.PRODUCTS_PER_PAGE = 2
+    for i in range(5):
+        Product.objects.create(category=category, name=f'Combo {i}',
+                               slug=f'combo-{i}', price=Decimal('1.00'))
+    first = client.get(reverse('shop:product_list'), {'q': 'combo'}).context['page']
+    second = client.get(reverse('shop:product_list'),
+                        {'q': 'combo', 'cursor': first.next_cursor}).context['page']
+    ids = [p.id for p in first] + [p.id for p in second]
+    assert len(set(ids)) == 4
+
+
+@pytest.mark.django_db
+def test_search_limit_applies_after_category_and_availability(client, menu, settings):
+    wings, sauce = menu
+    settings.SEARCH_RESULTS_LIMIT = 1
+    Product.objects.create(category=wings.category, name='Alitas BBQ', slug='alitas-bbq',
+                           price=Decimal('5.99'), available=False)
+    data = client.get(reverse('shop:product_list_json_by_category',
+                              args=[sauce.category.slug]), {'q': 'alitas'}).json()
+    assert [p['id'] for p in data['results']] == [sauce.id]
+    # The category facet still counts every available match
+    assert data['facets']['category'] == {str(wings.category_id): 1,
+                                          str(sauce.category_id): 1}
+
+
+@pytest.mark.django_db
+def test_catalog_search_only_ranks_the_page(category, settings):
+    settings.SEARCH_RESULTS_LIMIT = 2
+    for i in range(5):
+        Product.objects.create(category=category, name=f'Combo {i}',
+                               slug=f'combo-{i}', price=Decimal('1.00'))
+    with CaptureQueriesContext(connection) as queries:
+        candidates, page_ids = search.catalog_search('combo')
+    assert candidates.bit_count() == 5
+    assert len(page_ids) == 2
+    ranked = [q['sql'] for q in queries.captured_queries if 'bm25' in q['sql']]
+    assert len(ranked) == 1 and 'LIMIT 2' in ranked[0]
+
+
+@pytest.mark.django_db
+def test_autocomplete_suggests_products_and_categories(client, menu):
+    wings, sauce = menu
+    data = client.get(reverse('shop:autocomplete'), {'q': 'sal'}).json()
+    assert [p['name'] for p in data['products']] == ['Salsa Ranch']
+    assert [c['name'] for c in data['categories']] == ['Salsas']
+    assert data['products'][0]['url'] == sauce.get_absolute_url()
+
+
+@pytest.mark.django_db
+def test_autocomplete_matches_inner_words_without_accents(client, category):
+    Product.objects.create(category=category, name='Papas Rústicas',
+                           slug='papas-rusticas', price=Decimal('2.50'))
+    data = client.get(reverse('shop:autocomplete'), {'q': 'rust'}).json()
+    assert [p['name'] for p in data['products']] == ['Papas Rústicas']
+
+
+@pytest.mark.django_db
+def test_autocomplete_does_not_query_database_when_warm(client, menu,
+                                                        django_assert_num_queries):
+    client.get(reverse('shop:autocomplete'), {'q': 'a'})
+    with django_assert_num_queries(0):
+        client.get(reverse('shop:autocomplete'), {'q': 'alit'})
+
+
+@pytest.mark.django_db
+def test_autocomplete_follows_product_changes(client, menu, django_capture_on_commit_callbacks):
+    wings, sauce = menu
+    client.get(reverse('shop:autocomplete'), {'q': 'a'})
+
+    with django_capture_on_commit_callbacks(execute=True):
+        wings.name = 'Muslo Crujiente'
+        wings.save()
+        sauce.available = False
+        sauce.save()
+        Product.objects.create(category=wings.category, name='Muslo Extra',
+                               slug='muslo-extra', price=Decimal('3.00'))
+
+    data = client.get(reverse('shop:autocomplete'), {'q': 'muslo'}).json()
+    assert [p['name'] for p in data['products']] == ['Muslo Crujiente', 'Muslo Extra']
+    assert client.get(reverse('shop:autocomplete'), {'q': 'alitas'}).json()['products'] == []
+    assert client.get(reverse('shop:autocomplete'), {'q': 'salsa r'}).json()['products'] == []
+
+
+@pytest.mark.django_db
+def test_autocomplete_follows_changes_it_was_not_told_about(client, menu,
+                                                            django_capture_on_commit_callbacks,
+                                                            django_assert_num_queries):
+    wings, sauce = menu
+    client.get(reverse('shop:autocomplete'), {'q': 'a'})
+
+    # Its own changes are applied without reloading
+    with django_capture_on_commit_callbacks(execute=True):
+        wings.name = 'Alitas BBQ'
+        wings.save()
+    with django_assert_num_queries(0):
+        data = client.get(reverse('shop:autocomplete'), {'q': 'alitas'}).json()
+    assert [p['name'] for p in data['products']] == ['Alitas BBQ']
+
+    # Changes that bypass the signals, e.g. made by another process
+    Product.objects.filter(pk=wings.pk).update(available=False)
+    caching.bump_now(caching.ALL_PRODUCTS)
+    assert client.get(reverse('shop:autocomplete'), {'q': 'alitas'}).json()['products'] == []
+
+    Category.objects.filter(pk=sauce.category_id).update(name='Aderezos')
+    caching.bump_now(caching.CATEGORIES)
+    data = client.get(reverse('shop:autocomplete'), {'q': 'aderezos'}).json()
+    assert [c['name'] for c in data['categories']] == ['Aderezos']
+
+
+@pytest.mark.django_db
+def test_autocomplete_limit(client, category):
+    for i in range(5):
+        Product.objects.create(category=category, name=f'Combo {i}',
+                               slug=f'combo-{i}', price=Decimal('1.00'))
+    data = client.get(reverse('shop:autocomplete'), {'q': 'combo', 'limit': 3}).json()
+    assert len(data['products']) == 3
@@ -53,6 +53,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'cart.middleware.CartCookieMiddleware',
 ]
 
 ROOT_URLCONF = 'tienda_online.urls'
@@ -88,6 +89,20 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Any backend works for the catalog cache, e.g. file based:
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+# 'LOCATION': BASE_DIR / 'cache',
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'nam-nam-chicken',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -141,6 +156,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Cart session ID
 CART_SESSION_ID = 'cart'
 
+# Where carts are stored: cart.storage.SessionCartStorage,
+# SignedCookieCartStorage, CacheCartStorage or DatabaseCartStorage
+CART_STORAGE = 'cart.storage.SessionCartStorage'
+
+# Cookie used by the cookie, cache and database cart storages
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 30
+
+# Cache alias used by CacheCartStorage
+CART_CACHE_ALIAS = 'default'
+
 # Auth settings
 LOGIN_REDIRECT_URL = 'shop:product_list'
 LOGOUT_REDIRECT_URL = 'shop:product_list'
@@ -154,3 +180,86 @@ DEFAULT_FROM_EMAIL = 'admin@namnamchicken.com'
 MERCADOPAGO_ACCESS_TOKEN = 'APP_USR-4684010387998759-112413-3c3480210be940419474796c4a29e12e-3010611190'
 MERCADOPAGO_PUBLIC_KEY = 'APP_USR-822c026a-a1ca-4a4e-b0a2-cce382221a05'
 MERCADOPAGO_WEBHOOK_SECRET = '87fbcb2eb66bc2d4b902056cde13faf3505b1f758dc53e9bf5adcdd70fefd8a7'
+
+# Webhooks signed more than this many seconds ago are rejected; an empty
+# MERCADOPAGO_WEBHOOK_SECRET turns signature checks off
+MERCADOPAGO_SIGNATURE_TOLERANCE = 300
+
+# Threads creating checkout preferences in the background; 0 creates them
+# during the checkout request
+MERCADOPAGO_WORKERS = 4
+# Preferences still not created after this many seconds are created again
+# by `python manage.py retry_payment_preferences`
+MERCADOPAGO_PREFERENCE_TIMEOUT = 120
+
+# Client used to call MercadoPago: shop.gateway.MercadoPagoGateway, or
+# shop.gateway.StubGateway to work without the API
+MERCADOPAGO_GATEWAY = 'shop.gateway.MercadoPagoGateway'
+
+# Base URL of the MercadoPago API; None uses the real one. Point it at
+# `python manage.py fake_mercadopago` for local benchmarks
+MERCADOPAGO_API_URL = None
+
+# (connect, read) timeout in seconds and size of the connection pool
+MERCADOPAGO_TIMEOUT = (3.05, 10)
+MERCADOPAGO_POOL_SIZE = 10
+
+# Stop calling MercadoPago for MERCADOPAGO_BREAKER_RESET seconds after
+# MERCADOPAGO_BREAKER_THRESHOLD consecutive failed calls
+MERCADOPAGO_BREAKER_THRESHOLD = 5
+MERCADOPAGO_BREAKER_RESET = 30
+
+# Repeats of a webhook/IPN notification that is still waiting to be
+# processed are dropped in memory for up to this many seconds; up to
+# MERCADOPAGO_NOTIFICATION_CACHE_SIZE resources are remembered. A
+# notification that keeps failing is given up after
+# MERCADOPAGO_NOTIFICATION_ATTEMPTS tries, waiting
+# MERCADOPAGO_NOTIFICATION_RETRY_DELAY seconds after the first failure and
+# twice as long after each of the next ones
+MERCADOPAGO_NOTIFICATION_WINDOW = 60
+MERCADOPAGO_NOTIFICATION_CACHE_SIZE = 10000
+MERCADOPAGO_NOTIFICATION_ATTEMPTS = 5
+MERCADOPAGO_NOTIFICATION_RETRY_DELAY = 30
+# Notifications claimed by a worker that has not finished them after this
+# many seconds (e.g. it was killed) are processed again
+MERCADOPAGO_NOTIFICATION_CLAIM_TIMEOUT = 300
+
+# Maximum number of ranked results returned by a catalog search
+SEARCH_RESULTS_LIMIT = 500
+
+# Share of query trigrams a product must contain to count as a fuzzy match
+SEARCH_TRIGRAM_SIMILARITY = 0.4
+
+# The fuzzy search reads every query trigram for at most this many
+# products, which bounds its cost on large catalogs
+SEARCH_TRIGRAM_MAX_PRODUCTS = 1000
+
+# Products shown per catalog page
+PRODUCTS_PER_PAGE = 12
+
+# Reviews shown on a product page and per "more reviews" request
+REVIEWS_PER_PAGE = 10
+
+# Maximum suggestions per kind returned by the autocomplete endpoint
+AUTOCOMPLETE_LIMIT = 8
+
+# Catalog facets: price ranges (upper bound exclusive, None = open) and minimum ratings
+PRICE_FACETS = [(0, 2), (2, 5), (5, 10), (10, None)]
+RATING_FACETS = [4, 3, 2, 1]
+
+# Bayesian rating used to sort by best rated: every reviewed product counts
+# as if it also had RATING_PRIOR_WEIGHT reviews of RATING_PRIOR_MEAN stars
+RATING_PRIOR_MEAN = 3
+RATING_PRIOR_WEIGHT = 5
+
+# Seconds an unpaid order keeps its stock reserved; expired reservations are
+# given back by the release_expired_reservations command
+STOCK_RESERVATION_TIMEOUT = 60 * 30
+
+# Seconds a placed order is remembered by its checkout idempotency key in the
+# cache; older resubmissions are still answered from the database
+CHECKOUT_IDEMPOTENCY_TIMEOUT = 60 * 10
+
+# Lifetime of cached catalog fragments; entries are invalidated by version
+# counters on every change, so this only bounds memory use
+CATALOG_CACHE_TIMEOUT = 60 * 60